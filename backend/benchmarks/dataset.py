@@ -0,0 +1,62 @@
+import random
+from sqlalchemy import func
+from models import db, Question, Category, bump_data_version, \
+    run_question_hooks
+
+'''
+Synthetic dataset for the benchmarks
+    seed_dataset(app, questions, categories) fills the database with
+    "questions" random questions spread over "categories" categories.
+    The same seed always gives the same data, so two runs (or two
+    machines) benchmark the same thing
+'''
+
+WORDS = (
+    'ancient art astronomy battle blood brazil capital century '
+    'championship city country desert discovery empire football '
+    'galaxy history island king lake language mountain museum music '
+    'ocean olympic painter palace planet player queen river science '
+    'soccer song sport team temple theory tournament war world writer'
+).split()
+
+CATEGORY_NAMES = ['Science', 'Art', 'Geography', 'History',
+                  'Entertainment', 'Sports']
+
+SEARCH_TERMS = ['astronomy', 'world', 'painter river', 'ancient temple']
+
+
+def make_question(generator, categories):
+    words = generator.sample(WORDS, 8)
+    return {
+        'question': 'Which {} of the {} {} is {}?'.format(*words[:4]),
+        'answer': ' '.join(words[4:6]).title(),
+        'category': generator.randint(1, categories),
+        'difficulty': generator.randint(1, 5)
+    }
+
+
+def seed_dataset(app, questions, categories, batch_size=10000,
+                 seed=42):
+    generator = random.Random(seed)
+    with app.app_context():
+        db.session.execute(Category.__table__.insert(), [
+            {'id': number,
+             'type': CATEGORY_NAMES[(number - 1) % len(CATEGORY_NAMES)]
+             if number <= len(CATEGORY_NAMES)
+             else 'Category {}'.format(number)}
+            for number in range(1, categories + 1)])
+
+        # Same executemany as Question.insert_many, but without the
+        # hooks after every batch
+        inserted = 0
+        while inserted < questions:
+            count = min(batch_size, questions - inserted)
+            db.session.execute(Question.__table__.insert(), [
+                make_question(generator, categories)
+                for _ in range(count)])
+            inserted += count
+        db.session.commit()
+
+        bump_data_version()
+        run_question_hooks('reload', None, None)
+        return db.session.query(func.count(Question.id)).scalar()
@@ -0,0 +1,405 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from flaskr import create_app
+from .dataset import seed_dataset, SEARCH_TERMS
+
+'''
+Endpoint benchmarks
+    seeds a synthetic dataset, then calls every route of create_app
+    through the Flask test client and reports, per endpoint, the
+    p50 / p95 / p99 latency, the throughput and the peak memory.
+    A route without a scenario (and not in NOT_BENCHMARKED) stops
+    the run before it starts.
+    The results can be saved as a JSON baseline and compared with a
+    later run. From the backend folder:
+
+    python -m benchmarks.endpoints --questions 100k --output base.json
+    python -m benchmarks.endpoints --questions 100k --compare base.json
+'''
+
+
+def parse_size(value):
+    # 1000, 1k, 100k, 1m
+    value = value.lower()
+    for suffix, factor in (('k', 1000), ('m', 1000000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+# Routes no scenario calls: the static files, and the profiles
+# need PROFILE_TOKEN (the profiler isn't what is measured)
+NOT_BENCHMARKED = {'static', 'admin_profiles'}
+
+
+class Scenario:
+    # One kind of request, "endpoint" is the name of the view in
+    # create_app (to check that every route is covered) and "share"
+    # the fraction of the iterations it runs (the export is slow).
+    # keep(body) is called with the JSON of every 200 response, for
+    # the scenarios that use what an earlier one created
+
+    def __init__(self, endpoint, name, make_request, share=1.0,
+                 keep=None):
+        self.endpoint = endpoint
+        self.name = name
+        self.make_request = make_request
+        self.share = share
+        self.keep = keep
+
+
+def build_scenarios(total_questions, categories):
+    created_ids = []
+    session_ids = []
+    deep_page = max(1, total_questions // 10 // 2)
+    deep_id = total_questions // 2
+
+    def create_question(number):
+        return 'POST', '/questions', {
+            'question': 'Benchmark question {}?'.format(number),
+            'answer': 'Yes', 'difficulty': 1, 'category': 1}
+
+    def delete_question(number):
+        question_id = created_ids.pop() if created_ids else 0
+        return 'DELETE', '/questions/{}'.format(question_id), None
+
+    def bulk_questions(number):
+        return 'POST', '/questions/bulk', [
+            {'question': 'Bulk {} {}?'.format(number, row),
+             'answer': 'Yes', 'difficulty': 1, 'category': 1}
+            for row in range(100)]
+
+    def update_batch(number):
+        # 100 ids spread over the table
+        first = number * 100 % max(1, total_questions - 100) + 1
+        return 'PATCH', '/questions', {
+            'ids': list(range(first, first + 100)),
+            'difficulty': number % 5 + 1}
+
+    def delete_batch(number):
+        # 10 ids of the second half per call, never twice the same
+        first = deep_id + number * 10
+        return 'DELETE', '/questions', {
+            'ids': list(range(first, first + 10))}
+
+    def quiz(number):
+        return 'POST', '/quizzes', {
+            'previous_questions': [],
+            'quiz_category': {'id': number % (categories + 1)}}
+
+    def search(number):
+        return 'POST', '/questions/search', {
+            'search_term': SEARCH_TERMS[number % len(SEARCH_TERMS)]}
+
+    def suggest(number):
+        # The first letters of a search term
+        term = SEARCH_TERMS[number % len(SEARCH_TERMS)]
+        return 'GET', '/questions/suggest?prefix={}'.format(
+            term[:number % 3 + 2]), None
+
+    def start_session(number):
+        return 'POST', '/quizzes/sessions', {
+            'quiz_category': {'id': number % (categories + 1)}}
+
+    def next_in_session(number):
+        # The sessions started by the scenario before
+        session_id = session_ids[number % len(session_ids)] \
+            if session_ids else 'none'
+        return 'POST', '/quizzes/sessions/{}/next'.format(
+            session_id), None
+
+    def end_session(number):
+        session_id = session_ids.pop() if session_ids else 'none'
+        return 'DELETE', '/quizzes/sessions/{}'.format(session_id), None
+
+    return [
+        Scenario('get_categories', 'GET /categories',
+                 lambda number: ('GET', '/categories', None)),
+        Scenario('get_questions', 'GET /questions?page=1',
+                 lambda number: ('GET', '/questions?page=1', None)),
+        Scenario('get_questions', 'GET /questions?page=<deep>',
+                 lambda number: ('GET', '/questions?page={}'.format(
+                     deep_page), None)),
+        Scenario('get_questions', 'GET /questions?after_id=<deep>',
+                 lambda number: ('GET', '/questions?after_id={}'.format(
+                     deep_id), None)),
+        Scenario('get_questions_by_category',
+                 'GET /categories/<id>/questions',
+                 lambda number: ('GET', '/categories/{}/questions'.format(
+                     number % categories + 1), None)),
+        Scenario('get_questions_by_category',
+                 'GET /categories/<id>/questions?stream=true',
+                 lambda number: (
+                     'GET', '/categories/{}/questions?stream=true'.format(
+                         number % categories + 1), None), share=0.05),
+        Scenario('search_questions', 'POST /questions/search', search),
+        Scenario('suggest_questions', 'GET /questions/suggest', suggest),
+        Scenario('play_quiz', 'POST /quizzes', quiz),
+        Scenario('start_quiz_session', 'POST /quizzes/sessions',
+                 start_session,
+                 keep=lambda body: session_ids.append(body['session_id'])),
+        Scenario('next_quiz_question',
+                 'POST /quizzes/sessions/<id>/next', next_in_session),
+        Scenario('end_quiz_session', 'DELETE /quizzes/sessions/<id>',
+                 end_session),
+        Scenario('create_question', 'POST /questions', create_question,
+                 keep=lambda body: created_ids.append(body['created'])),
+        Scenario('delete_questions', 'DELETE /questions/<id>',
+                 delete_question),
+        Scenario('update_questions_batch', 'PATCH /questions (100 ids)',
+                 update_batch, share=0.1),
+        Scenario('delete_questions_batch', 'DELETE /questions (10 ids)',
+                 delete_batch, share=0.1),
+        Scenario('bulk_create_questions', 'POST /questions/bulk (100 rows)',
+                 bulk_questions, share=0.1),
+        Scenario('export_all_questions', 'GET /questions/export',
+                 lambda number: ('GET', '/questions/export', None),
+                 share=0.02),
+        Scenario('get_pool_stats', 'GET /stats/pool',
+                 lambda number: ('GET', '/stats/pool', None)),
+        Scenario('get_search_cache_stats', 'GET /stats/search-cache',
+                 lambda number: ('GET', '/stats/search-cache', None)),
+        Scenario('get_prometheus_metrics', 'GET /metrics',
+                 lambda number: ('GET', '/metrics', None), share=0.1),
+    ]
+
+
+def send(client, method, url, body):
+    response = client.open(url, method=method, json=body)
+    # Reading the body, streamed responses run while we read
+    response.get_data()
+    return response
+
+
+def percentile(sorted_values, fraction):
+    # Nearest rank percentile
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class ThreadClients:
+    # Flask test clients aren't meant to be shared between threads
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def get(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+
+def run_scenario(app, scenario, iterations, warmup, concurrency):
+    count = max(1, int(iterations * scenario.share))
+    client = app.test_client()
+
+    def record(response):
+        # The created questions are the ones DELETE removes, the
+        # started sessions the ones next / DELETE use
+        if scenario.keep is not None and response.status_code == 200:
+            scenario.keep(response.get_json())
+        return response
+
+    for number in range(min(warmup, count)):
+        record(send(client, *scenario.make_request(number)))
+
+    # One test client per thread
+    clients = ThreadClients(app)
+
+    def timed(number):
+        method, url, body = scenario.make_request(number)
+        started = time.perf_counter()
+        response = send(clients.get(), method, url, body)
+        elapsed = time.perf_counter() - started
+        record(response)
+        return elapsed, response.status_code
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(timed, range(count)))
+    else:
+        results = [timed(number) for number in range(count)]
+    wall_time = time.perf_counter() - started
+
+    # A few more requests with tracemalloc on, to see how much the
+    # endpoint allocates (not timed, tracemalloc is slow)
+    tracemalloc.start()
+    for number in range(min(5, count)):
+        record(send(client, *scenario.make_request(count + number)))
+    peak_alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = sorted(elapsed for elapsed, status in results)
+    statuses = {}
+    for elapsed, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'endpoint': scenario.endpoint,
+        'requests': count,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)),
+        'throughput_rps': round(count / wall_time, 1),
+        'statuses': statuses,
+        'peak_alloc_mb': round(peak_alloc / 1024 / 1024, 2),
+        # ru_maxrss is in KB on Linux and only goes up, it is the
+        # peak of the process once this endpoint has run
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    # Prints the change of p95 and throughput against the baseline,
+    # returns the names of the endpoints that got slower
+    regressions = []
+    print('\n{:<48} {:>12} {:>12}'.format(
+        'compared with baseline', 'p95', 'throughput'))
+    for name, current in results['results'].items():
+        before = baseline['results'].get(name)
+        if not before:
+            continue
+        p95 = current['p95_ms'] / before['p95_ms'] - 1 \
+            if before['p95_ms'] else 0
+        rps = current['throughput_rps'] / before['throughput_rps'] - 1 \
+            if before['throughput_rps'] else 0
+        flag = ''
+        if p95 > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<48} {:>+11.1%} {:>+11.1%}{}'.format(
+            name, p95, rps, flag))
+    return regressions
+
+
+def print_results(results):
+    print('{:<48} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+        'endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'rss MB'))
+    for name, result in results['results'].items():
+        print('{:<48} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+            name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['throughput_rps'], result['peak_rss_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks every endpoint on a synthetic dataset')
+    parser.add_argument('--questions', default='1k', type=parse_size,
+                        help='how many questions to seed (1k, 100k, 1m)')
+    parser.add_argument('--categories', default=6, type=int)
+    parser.add_argument('--database', default=None,
+                        help='database URL (an empty one), by default '
+                        'a temporary SQLite file')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='use the data already in --database')
+    parser.add_argument('--iterations', default=200, type=int)
+    parser.add_argument('--warmup', default=10, type=int)
+    parser.add_argument('--concurrency', default=1, type=int)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn the response cache off')
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--output', help='save the results (JSON)')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    parser.add_argument('--threshold', default=0.2, type=float,
+                        help='p95 increase that counts as a regression')
+    args = parser.parse_args(argv)
+
+    folder = None
+    database = args.database
+    if database is None:
+        folder = tempfile.mkdtemp()
+        database = 'sqlite:///' + os.path.join(folder, 'bench.db')
+
+    try:
+        app = create_app({
+            'DATABASE_PATH': database,
+            'CREATE_SCHEMA_ON_START': True,
+            'DEBUG': False,
+            'CACHE_MAX_ENTRIES': 0 if args.no_cache else 1024,
+            # One client sending as fast as it can, the limits would
+            # refuse most of it
+            'RATE_LIMIT_ENABLED': False,
+        })
+        started = time.perf_counter()
+        if not args.no_seed:
+            total = seed_dataset(app, args.questions, args.categories,
+                                 seed=args.seed)
+        else:
+            with app.app_context():
+                from models import Question
+                total = Question.query.count()
+        seed_time = time.perf_counter() - started
+        print('{} questions in {} categories ({:.1f}s to seed)\n'.format(
+            total, args.categories, seed_time))
+
+        scenarios = build_scenarios(total, args.categories)
+        covered = {scenario.endpoint for scenario in scenarios} | \
+            NOT_BENCHMARKED
+        missing = [rule for rule in app.url_map.iter_rules()
+                   if rule.endpoint not in covered]
+        for rule in missing:
+            print('error: no scenario for {} ({})'.format(
+                rule.rule, rule.endpoint))
+        if missing:
+            return 2
+
+        results = {
+            'meta': {
+                'questions': total,
+                'categories': args.categories,
+                'database': database.split(':')[0],
+                'iterations': args.iterations,
+                'concurrency': args.concurrency,
+                'cache': not args.no_cache,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'date': datetime.now(timezone.utc).isoformat(),
+            },
+            'results': {},
+        }
+        for scenario in scenarios:
+            results['results'][scenario.name] = run_scenario(
+                app, scenario, args.iterations, args.warmup,
+                args.concurrency)
+    finally:
+        if folder:
+            shutil.rmtree(folder)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print('\nsaved to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
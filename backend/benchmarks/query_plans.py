@@ -0,0 +1,177 @@
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+from flaskr.migrations import migrate
+from .dataset import make_question, CATEGORY_NAMES
+from .endpoints import parse_size
+
+'''
+Query plans before / after the category migration
+    builds the old schema (questions.category as a String, no
+    index, no foreign key), seeds it, prints the plan and the median
+    time of the category queries, runs the migrations (see
+    flaskr/migrations.py) and does it again. From the backend folder:
+
+    python -m benchmarks.query_plans --questions 100k --categories 20
+'''
+
+OLD_SCHEMA = [
+    "CREATE TABLE categories (id INTEGER NOT NULL PRIMARY KEY, "
+    "type VARCHAR)",
+    "CREATE TABLE questions (id INTEGER NOT NULL PRIMARY KEY, "
+    "question VARCHAR, answer VARCHAR, category VARCHAR, "
+    "difficulty INTEGER)",
+]
+
+# The statements of GET /categories/<id>/questions (a deep page,
+# the keyset page, the total) and the scan of the quiz index
+QUERIES = [
+    ('category page (OFFSET)',
+     "SELECT id, question, answer, category, difficulty FROM questions "
+     "WHERE category = :category ORDER BY id LIMIT 10 OFFSET :offset"),
+    ('category page (after_id)',
+     "SELECT id, question, answer, category, difficulty FROM questions "
+     "WHERE category = :category AND id > :after_id "
+     "ORDER BY id LIMIT 11"),
+    ('category total',
+     "SELECT count(id) FROM questions WHERE category = :category"),
+    ('quiz index build',
+     "SELECT id, category FROM questions"),
+]
+
+
+def seed(engine, questions, categories, seed_value):
+    generator = random.Random(seed_value)
+    with engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text(
+            "INSERT INTO categories (id, type) VALUES (:id, :type)"),
+            [{'id': number,
+              'type': CATEGORY_NAMES[(number - 1) % len(CATEGORY_NAMES)]}
+             for number in range(1, categories + 1)])
+        rows = []
+        for _ in range(questions):
+            row = make_question(generator, categories)
+            # The old column held text
+            row['category'] = str(row['category'])
+            rows.append(row)
+            if len(rows) == 10000:
+                insert_questions(connection, rows)
+                rows = []
+        if rows:
+            insert_questions(connection, rows)
+        if engine.dialect.name == 'postgresql':
+            connection.execute(text("ANALYZE"))
+
+
+def insert_questions(connection, rows):
+    connection.execute(text(
+        "INSERT INTO questions (question, answer, category, difficulty) "
+        "VALUES (:question, :answer, :category, :difficulty)"), rows)
+
+
+def plan(connection, statement, parameters):
+    if connection.dialect.name == 'postgresql':
+        return [row[0] for row in connection.execute(
+            text('EXPLAIN ' + statement), parameters)]
+    return [row[-1] for row in connection.execute(
+        text('EXPLAIN QUERY PLAN ' + statement), parameters)]
+
+
+def median_ms(connection, statement, parameters, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        connection.execute(text(statement), parameters).fetchall()
+        timings.append(time.perf_counter() - started)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+def measure(engine, category, parameters, iterations):
+    results = {}
+    with engine.connect() as connection:
+        for name, statement in QUERIES:
+            values = dict(parameters, category=category)
+            results[name] = {
+                'plan': plan(connection, statement, values),
+                'median_ms': median_ms(connection, statement, values,
+                                       iterations)}
+    return results
+
+
+def print_results(title, results):
+    print(title)
+    for name, result in results.items():
+        print('  {:<28} {:>10} ms'.format(name, result['median_ms']))
+        for line in result['plan']:
+            print('      ' + line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Query plans of the category queries before and '
+        'after the category migration')
+    parser.add_argument('--questions', default='100k',
+                        help='how many questions to seed (1k, 100k, 1m)')
+    parser.add_argument('--categories', default=20, type=int)
+    parser.add_argument('--database', default=None,
+                        help='URL of an empty database, by default a '
+                        'temporary SQLite file')
+    parser.add_argument('--iterations', default=20, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    args = parser.parse_args(argv)
+
+    questions = parse_size(args.questions)
+
+    folder = None
+    database = args.database
+    if database is None:
+        folder = tempfile.mkdtemp()
+        database = 'sqlite:///' + os.path.join(folder, 'plans.db')
+    try:
+        engine = create_engine(database)
+        started = time.perf_counter()
+        seed(engine, questions, args.categories, args.seed)
+        print('{} questions in {} categories ({:.1f}s to seed)\n'.format(
+            questions, args.categories, time.perf_counter() - started))
+
+        category = args.categories // 2 or 1
+        per_category = questions // args.categories
+        parameters = {'offset': per_category // 2,
+                      'after_id': questions // 2}
+
+        before = measure(engine, str(category), parameters,
+                         args.iterations)
+        print_results('before (category VARCHAR, no index)', before)
+
+        started = time.perf_counter()
+        migrate(engine)
+        print('\nmigrated in {:.1f}s\n'.format(
+            time.perf_counter() - started))
+
+        after = measure(engine, category, parameters, args.iterations)
+        print_results('after (category INTEGER FK, index on '
+                      '(category, id))', after)
+
+        print('\n{:<28} {:>10}'.format('', 'speedup'))
+        for name in before:
+            print('{:<28} {:>9.1f}x'.format(
+                name, before[name]['median_ms'] /
+                max(after[name]['median_ms'], 0.001)))
+        engine.dispose()
+    finally:
+        if folder:
+            shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
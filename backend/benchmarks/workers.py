@@ -0,0 +1,252 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from flaskr import create_app
+from .dataset import seed_dataset, SEARCH_TERMS
+from .endpoints import parse_size, percentile
+
+'''
+Worker scaling benchmark
+    seeds a synthetic dataset, then for every worker count starts
+    gunicorn with gunicorn.conf.py (preload, warm-up, ...) and sends
+    it a mix of read requests over HTTP (pages of questions, category
+    listings, search, quizzes) from --clients processes with
+    --connections keep-alive connections each, for --duration seconds.
+    It prints the throughput and the latency for each worker count.
+    The load comes from the same machine, leave it some cores (the
+    throughput stops growing once the cores are all busy anyway).
+    From the backend folder:
+
+    python -m benchmarks.workers --questions 10k --workers 1,2,4,8
+'''
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_request(generator, total_questions, categories):
+    # (method, path, body) of one request of the mix
+    kind = generator.random()
+    if kind < 0.4:
+        pages = max(1, total_questions // 10)
+        return 'GET', '/questions?page={}'.format(
+            generator.randint(1, pages)), None
+    if kind < 0.6:
+        return 'GET', '/categories/{}/questions'.format(
+            generator.randint(1, categories)), None
+    if kind < 0.8:
+        return 'POST', '/quizzes', {
+            'previous_questions': [],
+            'quiz_category': {'id': generator.randint(0, categories)}}
+    return 'POST', '/questions/search', {
+        'search_term': generator.choice(SEARCH_TERMS)}
+
+
+def client_process(port, connections, warmup, duration, total_questions,
+                   categories, seed):
+    # One load process: threads with a keep-alive connection each,
+    # returns (latencies of the measured requests, errors)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    def run(thread_seed):
+        generator = random.Random(thread_seed)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        own = []
+        failed = 0
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                break
+            method, path, body = make_request(
+                generator, total_questions, categories)
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status < 500
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+                ok = False
+            if now >= measure_from:
+                own.append(time.perf_counter() - now)
+                if not ok:
+                    failed += 1
+        connection.close()
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=run, args=(seed * 1000 + number,))
+               for number in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def start_server(workers, threads, port, settings_path):
+    environment = dict(os.environ, TRIVIA_WORKERS=str(workers),
+                       TRIVIA_THREADS=str(threads),
+                       TRIVIA_BIND='127.0.0.1:{}'.format(port),
+                       TRIVIA_SETTINGS=settings_path)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--log-level', 'warning'],
+        cwd=BACKEND, env=environment)
+    # Ready when every worker answers, it has warmed up by then
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with {}'.format(
+                server.returncode))
+        try:
+            connection = http.client.HTTPConnection(
+                '127.0.0.1', port, timeout=1)
+            connection.request('GET', '/categories')
+            if connection.getresponse().status == 200:
+                connection.close()
+                return server
+        except OSError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def run_workers(workers, args, settings_path, total_questions):
+    port = free_port()
+    server = start_server(workers, args.threads, port, settings_path)
+    try:
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.starmap(client_process, [
+                (port, args.connections, args.warmup, args.duration,
+                 total_questions, args.categories, args.seed + number)
+                for number in range(args.clients)])
+    finally:
+        stop_server(server)
+
+    latencies = sorted(latency for own, _ in results for latency in own)
+    errors = sum(failed for _, failed in results)
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'workers': workers,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / args.duration, 1),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+    }
+
+
+def print_results(results):
+    print('{:>8} {:>10} {:>9} {:>9} {:>9} {:>7} {:>8}'.format(
+        'workers', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors',
+        'speedup'))
+    base = results[0]['throughput_rps'] or 1
+    for result in results:
+        print('{:>8} {:>10} {:>9} {:>9} {:>9} {:>7} {:>7.2f}x'.format(
+            result['workers'], result['throughput_rps'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['errors'], result['throughput_rps'] / base))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Throughput of the gunicorn deployment by number '
+        'of workers')
+    parser.add_argument('--questions', default='10k',
+                        help='how many questions to seed (1k, 100k, 1m)')
+    parser.add_argument('--categories', default=20, type=int)
+    parser.add_argument('--database', default=None,
+                        help='URL of an empty database, by default a '
+                        'temporary SQLite file')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='worker counts to try, comma separated')
+    parser.add_argument('--threads', default=4, type=int,
+                        help='threads per worker')
+    parser.add_argument('--clients', default=2, type=int,
+                        help='load generating processes')
+    parser.add_argument('--connections', default=8, type=int,
+                        help='connections per load process')
+    parser.add_argument('--duration', default=10.0, type=float)
+    parser.add_argument('--warmup', default=2.0, type=float)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp()
+    database = args.database or 'sqlite:///' + os.path.join(
+        folder, 'workers.db')
+    try:
+        app = create_app({'DATABASE_PATH': database,
+                          'CREATE_SCHEMA_ON_START': True,
+                          'DEBUG': False})
+        total = seed_dataset(app, parse_size(args.questions),
+                             args.categories, seed=args.seed)
+        print('{} questions in {} categories, {} load processes x {} '
+              'connections, {} threads per worker\n'.format(
+                  total, args.categories, args.clients,
+                  args.connections, args.threads))
+
+        # What wsgi.py reads, the rate limits would refuse most of a
+        # load coming from one address
+        settings_path = os.path.join(folder, 'settings.py')
+        with open(settings_path, 'w') as settings:
+            settings.write('DATABASE_PATH = {!r}\n'.format(database))
+            settings.write('RATE_LIMIT_ENABLED = False\n')
+
+        results = [run_workers(int(workers), args, settings_path, total)
+                   for workers in args.workers.split(',')]
+        print_results(results)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump({'cpu_count': multiprocessing.cpu_count(),
+                           'args': vars(args), 'results': results},
+                          output, indent=2)
+    finally:
+        shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,38 @@
 import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, abort, stream_with_context
 from flask_cors import CORS
-import random
-from werkzeug.urls import url_quote
-from werkzeug.wrappers import Request, Response
+from werkzeug.wrappers import Response
 from models import *
 from config import *
-import unittest
+import config
+from .quiz_index import init_quiz_index, get_quiz_index
+from .quiz_sessions import init_quiz_sessions, get_quiz_sessions, \
+    next_question
+from .search import search_questions_page
+from .cache import init_cache, get_cache
+from .suggest import init_suggest_index, get_suggest_index
+from .search_cache import init_search_cache, get_search_cache, \
+    normalize_search_term
+from .conditional import conditional
+from .replica import read_only
+from .bulk import ingest_questions, export_questions, \
+    stream_category_questions, read_ids, read_changes, \
+    delete_question_ids, update_question_ids
+from .commands import register_commands, init_db
+from .metrics import init_metrics, get_metrics
+from .profiler import init_profiler
+from .sampling import init_sampling, get_sampling_profiler
+from .json_provider import init_json_provider, jsonify
+from .compression import init_compression
+from .admission import init_admission, retry_after_headers
+from .counts import init_counts, read_counts, total_questions, \
+    category_total
+from .external_writes import init_external_writes
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+# The most questions POST /quizzes sends back in one batch
+MAX_QUIZ_BATCH = 50
 
 # EVERY FUNCTION AND METHOD HAS ITS RESOURCES ATTACHED ABOVE
 # IT IN A COMMENT♥
@@ -19,6 +42,34 @@ QUESTIONS_PER_PAGE = 10
 # --in-place --aggressive --aggressive <yourfile.py>
 
 
+def get_per_page(request):
+    # ?per_page= lets the client pick the page size, but it is
+    # clamped between 1 and MAX_QUESTIONS_PER_PAGE so nobody can
+    # ask for the whole table in one request
+    per_page = request.args.get(
+        'per_page', QUESTIONS_PER_PAGE, type=int)
+    return max(1, min(per_page, MAX_QUESTIONS_PER_PAGE))
+
+
+def get_page(request):
+    # ?page= starts at 1, a smaller one is a bad request. The views
+    # call it before their try, whose except turns every error
+    # (400 included) into a 422 or a 404
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
+    return page
+
+
+def get_quiz_count(body):
+    # "count" asks POST /quizzes for a batch of questions, clamped
+    # between 1 and MAX_QUIZ_BATCH like per_page, None without it
+    count = body.get('count')
+    if count is None:
+        return None
+    return max(1, min(int(count), MAX_QUIZ_BATCH))
+
+
 def paginate_questions(request, selection):
     # This code is inspired from: Lesson 3: Endpoints and Payloads (Concept 5. Flask Part II)
     # First: we request the page
@@ -26,20 +77,58 @@ def paginate_questions(request, selection):
     # So, if there isn't a given page, It's gonna be page 1 by default
     # To know more:
     # https://flask.palletsprojects.com/en/1.1.x/api/#flask.Request.args
-    page = request.args.get('page', 1, type=int)
+    page = get_page(request)
+    per_page = get_per_page(request)
+
+    start = (page - 1) * per_page
 
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    # "selection" is a query (not a list), so the paging happens
+    # in the database with LIMIT / OFFSET and only the rows of the
+    # current page are loaded and formatted
+    # https://docs.sqlalchemy.org/en/13/orm/query.html#sqlalchemy.orm.query.Query.limit
+    current_page = selection.offset(start).limit(per_page).all()
 
     # Formatting questions https://www.geeksforgeeks.org/python-format-function/
     # and looping through questions that we intend to paginate using for-in loop
     # https://www.w3schools.com/python/python_for_loops.asp
-    questions = [question.format()
-                 for question in selection]
-    current_page = questions[start:end]
+    # The rows are tuples of QUESTION_COLUMNS, not Question objects
+    questions = [format_question_row(question)
+                 for question in current_page]
 
     # Returns the paginated questions
-    return current_page
+    return questions
+
+
+def paginate_questions_after(request, selection, after_id):
+    # Keyset (cursor) pagination: instead of skipping OFFSET rows
+    # we continue right after the last id the client has seen,
+    # so page 10000 costs the same as page 1 (it's an index range
+    # scan on the primary key)
+    # https://use-the-index-luke.com/no-offset
+    per_page = get_per_page(request)
+
+    # We ask for one extra row to know if there is a next page
+    rows = selection.filter(Question.id > after_id).order_by(
+        Question.id).limit(per_page + 1).all()
+    current_page = rows[:per_page]
+
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = current_page[-1].id
+
+    return [format_question_row(question)
+            for question in current_page], next_cursor
+
+
+def get_category_map():
+    # {id: type} of all the categories ordered by type, it
+    # changes so rarely that it is served from the cache
+    return get_cache().get_or_set(
+        ('categories',),
+        lambda: {category_id: category_type
+                 for category_id, category_type in db.session.query(
+                     Category.id, Category.type).order_by(
+                     Category.type)})
 
 
 # test_config=None explained in the flask documentation:
@@ -51,7 +140,41 @@ def create_app(test_config=None):
     # To know more read the Quick start section :
     # https://flask.palletsprojects.com/en/1.1.x/quickstart/
     app = Flask(__name__)
-    setup_db(app)
+    # The settings come from config.py, test_config (a dict) can
+    # override any of them, for example the tests use
+    # {'DATABASE_PATH': 'sqlite://', 'CREATE_SCHEMA_ON_START': True}
+    # https://flask.palletsprojects.com/en/1.1.x/config/
+    app.config.from_object(config)
+    if test_config is not None:
+        app.config.update(test_config)
+
+    # No query runs here: the tables are created by "flask init-db"
+    # (see commands.py), unless CREATE_SCHEMA_ON_START is set
+    setup_db(app, app.config['DATABASE_PATH'])
+    if app.config['CREATE_SCHEMA_ON_START']:
+        init_db(app)
+    register_commands(app)
+    init_json_provider(app)
+    init_quiz_index(app)
+    init_suggest_index(app)
+    init_quiz_sessions(app)
+    init_cache(app, app.config['CACHE_MAX_ENTRIES'])
+    init_search_cache(app)
+    init_counts(app)
+    init_external_writes(app)
+    if app.config['METRICS_ENABLED']:
+        init_metrics(app)
+    # After the metrics, so the refused requests are in them too
+    if app.config['RATE_LIMIT_ENABLED']:
+        init_admission(app)
+    # Following the DEBUG of this app, not the one of config.py
+    if app.config['QUERY_PROFILER'] is None:
+        app.config['QUERY_PROFILER'] = app.config['DEBUG']
+    if app.config['QUERY_PROFILER']:
+        init_profiler(app)
+    init_sampling(app)
+    if app.config['COMPRESSION_ENABLED']:
+        init_compression(app)
     '''
    @TODO (Done): Set up CORS. Allow '*' for origins.
     Delete the sample route after completing the TODOs
@@ -79,7 +202,7 @@ def create_app(test_config=None):
 
         response.headers.add(
             'Access-Control-Allow-Methods',
-            'GET,POST,DELETE,UPDATE,OPTIONS,PUT')
+            'GET,POST,DELETE,UPDATE,OPTIONS,PUT,PATCH')
 
         return response
 
@@ -90,22 +213,26 @@ def create_app(test_config=None):
     '''
 
     @app.route('/categories', methods=['GET'])
+    @read_only
+    @conditional
     def get_categories():
-        # Using SQLAlchemy for creating a list of categories
-        # and ordering (Arranging them ) by type
-        categories = Category.query.order_by(
-            Category.type).all()
+        # The categories {id: type} come from the cache, they are
+        # only queried again after a write (see cache.py)
+        categories = get_category_map()
 
         # If there are no categories, abort 404 ( Category
         # not found )
         if not categories:
             abort(404)
+        # How many questions each category has, for the sidebar
+        # (maintained by the database, see counts.py)
+        counts = read_counts()
         # Return the categories
         return jsonify({
             'success': True,
-            'categories':
-            {category.id: category.type
-             for category in categories}
+            'categories': categories,
+            'question_counts': {category_id: counts.get(category_id, 0)
+                                for category_id in categories}
         })
 
     '''
@@ -122,21 +249,41 @@ def create_app(test_config=None):
     '''
 
     @app.route('/questions', methods=['GET'])
+    @read_only
+    @conditional
     def get_questions():
+        page = get_page(request)
         try:
-            # Querying all questions available in the Question table in db using query.
-            # https://flask-sqlalchemy.palletsprojects.com/en/2.x/queries/
-            all_questions = Question.query.order_by(
-                Question.id).all()
-            # Getting available categories from Category
-            # table in db and ordering them by type
-            categories = Category.query.order_by(
-                Category.type).all()
-            questions_list = paginate_questions(request, all_questions)
+            cache = get_cache()
+            per_page = get_per_page(request)
+
+            # ?after_id= switches to keyset pagination, the
+            # response then carries the next_cursor to send back
+            after_id = request.args.get('after_id', None, type=int)
+            if after_id is None:
+                # Building the query of all questions available in the Question table
+                # https://flask-sqlalchemy.palletsprojects.com/en/2.x/queries/
+                # Nothing is loaded here, paginate_questions adds
+                # LIMIT / OFFSET so only one page hits python
+                all_questions = db.session.query(
+                    *QUESTION_COLUMNS).order_by(Question.id)
+                questions_list, next_cursor = cache.get_or_set(
+                    ('questions', page, per_page),
+                    lambda: (paginate_questions(
+                        request, all_questions), None))
+            else:
+                questions_list, next_cursor = cache.get_or_set(
+                    ('questions_after', after_id, per_page),
+                    lambda: paginate_questions_after(
+                        request, db.session.query(*QUESTION_COLUMNS),
+                        after_id))
             if len(questions_list) == 0:
                 abort(404)
-                
-            all_categories = [category.format() for category in categories]
+
+            # The counts the database keeps (see counts.py) instead
+            # of a COUNT(*) of the whole table
+            total = total_questions()
+
             """
              Reviewer's feedback: 
              Endpoint to handle GET requests for questions,
@@ -145,15 +292,16 @@ def create_app(test_config=None):
              number of total questions,
              current category, categories.
             """
-            return jsonify({
+            result = {
                 'success': True,
                 'questions_list': questions_list,
-                'categories':
-                {category.id: category.type
-                 for category in categories},
-                'total_questions': len(all_questions),
+                'categories': get_category_map(),
+                'total_questions': total,
                 'current_category': None
-            })
+            }
+            if after_id is not None:
+                result['next_cursor'] = next_cursor
+            return jsonify(result)
         except BaseException:
             abort(422)
 
@@ -226,7 +374,7 @@ def create_app(test_config=None):
             question = Question(question=add_question,
                                 answer=add_answer,
                                 difficulty=add_difficulty,
-                                category=add_category)
+                                category=int(add_category))
 
             question.insert()
 
@@ -236,7 +384,95 @@ def create_app(test_config=None):
         except BaseException:
             # If anything went wrong, handle the 422 error
             abort(422)
-        '''
+    # Loading a lot of questions at once: a JSON array or NDJSON
+    # (Content-Type: application/x-ndjson), the rows are checked
+    # like in create_question and inserted in batches of
+    # BULK_BATCH_SIZE, one transaction per batch (see bulk.py)
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_create_questions():
+        try:
+            created, errors = ingest_questions(
+                request, app.config['BULK_BATCH_SIZE'])
+        except ValueError:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'created': created,
+            'errors': errors
+        })
+
+    # The whole questions table as NDJSON, one question per line,
+    # streamed from a server side cursor
+    # https://flask.palletsprojects.com/en/1.1.x/patterns/streaming/
+    @app.route('/questions/export', methods=['GET'])
+    def export_all_questions():
+        return Response(
+            stream_with_context(export_questions(
+                app.config['BULK_BATCH_SIZE'])),
+            mimetype='application/x-ndjson')
+
+    # Deleting / changing many questions at once: {"ids": [...]}
+    # (plus "category" and / or "difficulty" for PATCH), one SQL
+    # statement and one transaction for all of them, and the
+    # outcome of every id ("deleted" / "updated" or "not_found")
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_batch():
+        try:
+            ids = read_ids(request.get_json(silent=True))
+        except ValueError:
+            abort(400)
+
+        results = delete_question_ids(ids)
+        return jsonify({
+            'success': True,
+            'deleted': sum(result['status'] == 'deleted'
+                           for result in results),
+            'results': results
+        })
+
+    @app.route('/questions', methods=['PATCH'])
+    def update_questions_batch():
+        body = request.get_json(silent=True)
+        try:
+            ids = read_ids(body)
+        except ValueError:
+            abort(400)
+        changes = read_changes(body)
+        if changes is None:
+            # Nothing to change, a category that doesn't exist or a
+            # value that isn't a number
+            abort(422)
+
+        results = update_question_ids(ids, changes)
+        return jsonify({
+            'success': True,
+            'updated': sum(result['status'] == 'updated'
+                           for result in results),
+            'results': results
+        })
+
+    # Type-ahead: the questions with words that start with the
+    # words of ?prefix=, from an in-memory trie, no query (see
+    # suggest.py). ?limit= is clamped between 1 and SUGGEST_TOP_K
+    @app.route('/questions/suggest', methods=['GET'])
+    @conditional
+    def suggest_questions():
+        prefix = request.args.get('prefix', '')
+        if not prefix.strip():
+            abort(400)
+        limit = request.args.get(
+            'limit', app.config['SUGGEST_LIMIT'], type=int)
+        limit = max(1, min(limit, app.config['SUGGEST_TOP_K']))
+        return jsonify({
+            'success': True,
+            'suggestions': [
+                {'id': question_id, 'question': question}
+                for question_id, question in
+                get_suggest_index().suggest(prefix, limit)],
+        })
+
+    '''
     @TODO(Done):
     Create a POST endpoint to get questions based on a search term.
     It should return any questions for whom the search term
@@ -244,16 +480,31 @@ def create_app(test_config=None):
     '''
 
     @app.route('/questions/search', methods=['POST'])
+    @read_only
     def search_questions():
         body = request.get_json()
         search_term = body.get('search_term')
-        print(search_term)
 
         if search_term:
-            search_results = Question.query.filter(
-                # Learn about like operator:
-                # https://www.postgresqltutorial.com/postgresql-like/
-                Question.question.like(f'%{search_term}%')).all()
+            # Full text search (tsvector + GIN on PostgreSQL, FTS5
+            # on SQLite) over the question and the answer, ranked
+            # by relevance and paginated like GET /questions
+            # (see search.py)
+            page = get_page(request)
+            per_page = get_per_page(request)
+            # The pages of the popular terms come from the search
+            # cache, and the same search running already is waited
+            # for, not run twice (see search_cache.py)
+            term = normalize_search_term(search_term)
+
+            def search():
+                results, total = search_questions_page(
+                    term, per_page, (page - 1) * per_page)
+                return [format_question_row(question)
+                        for question in results], total
+
+            search_results, total_questions = get_search_cache().search(
+                (term, page, per_page), search)
             if len(search_results) == 0:
                 # Learn more about raising exceptions:
                 # https://docs.python.org/3/tutorial/errors.html
@@ -265,9 +516,8 @@ def create_app(test_config=None):
             return jsonify(
                 {
                     'success': True,
-                    'questions': [
-                        question.format() for question in search_results],
-                    'total_questions': len(search_results),
+                    'questions': search_results,
+                    'total_questions': total_questions,
                 })
 
         abort(404)  # Search term not found
@@ -290,23 +540,65 @@ def create_app(test_config=None):
     Thanks in advance ♥ <3 :D
     p.S: I editted it to POST anyway
     """
+    # GET is what the frontend calls (and what can be answered
+    # with 304 Not Modified), POST is kept for the old clients
     @app.route('/categories/<int:category_id>/questions',
-               methods=['POST'])
+               methods=['GET', 'POST'])
+    @conditional
     def get_questions_by_category(category_id):
+        # ?stream=true sends the whole category, the JSON is
+        # written while the rows are read from the database so it
+        # never sits in memory (see bulk.py). A category without
+        # questions is a 404 like in the paginated mode, checked
+        # before the 200 is sent
+        if request.args.get('stream', '').lower() in ('1', 'true'):
+            if db.session.query(Question.id).filter(
+                    Question.category == category_id).first() is None:
+                abort(404)
+            return Response(stream_with_context(
+                stream_category_questions(
+                    category_id, app.config['BULK_BATCH_SIZE'])),
+                mimetype='application/json')
+
+        page = get_page(request)
         try:
-            # Creating a list (Query) of all the questions
-            # in a category
-            questions = Question.query.filter(
-                Question.category == category_id).all()
+            # Creating a query of the questions in a category,
+            # paginated like GET /questions (page / per_page or
+            # after_id), every page is formatted once and then kept
+            # in the cache until the next write
+            cache = get_cache()
+            category_questions = db.session.query(
+                *QUESTION_COLUMNS).filter(
+                Question.category == category_id)
+            per_page = get_per_page(request)
+            after_id = request.args.get('after_id', None, type=int)
+            if after_id is None:
+                questions, next_cursor = cache.get_or_set(
+                    ('category_questions', category_id,
+                     page, per_page),
+                    lambda: (paginate_questions(
+                        request, category_questions.order_by(
+                            Question.id)), None))
+            else:
+                questions, next_cursor = cache.get_or_set(
+                    ('category_questions_after', category_id,
+                     after_id, per_page),
+                    lambda: paginate_questions_after(
+                        request, category_questions, after_id))
+            if len(questions) == 0:
+                abort(404)
+
+            total_questions = category_total(category_id)
 
             # Returning the questions in a category
-            return jsonify(
-                {
-                    'success': True,
-                    'questions': [
-                        question.format() for question in questions],
-                    'total_questions': len(questions),
-                    'current_category': category_id})
+            result = {
+                'success': True,
+                'questions': questions,
+                'total_questions': total_questions,
+                'current_category': category_id}
+            if after_id is not None:
+                result['next_cursor'] = next_cursor
+            return jsonify(result)
         except BaseException:
             # Handling 404 error
             # Or if len(questions) == 0: abort(404)
@@ -330,6 +622,7 @@ def create_app(test_config=None):
   '''
 
     @app.route('/quizzes', methods=['POST'])
+    @read_only
     def play_quiz():
         try:
             # To parse data as JSON we use get_json, To know
@@ -340,31 +633,30 @@ def create_app(test_config=None):
             # setting None as the default value as it was
             # explained in the lessons
             previous_questions = body.get(
-                'previous_questions', None)
+                'previous_questions', None) or []
             quiz_category = body.get('quiz_category')['id']
+            count = get_quiz_count(body)
+
+            # With "count" the client prefetches the next questions
+            # of the quiz in one round trip: distinct ids drawn from
+            # the quiz index and loaded with a single IN query
+            if count is not None:
+                questions = get_quiz_index().draw_many(
+                    int(quiz_category), previous_questions, count)
+                return jsonify({
+                    'success': True,
+                    'questions': [format_question_row(question)
+                                  for question in questions]
+                })
 
-            if (quiz_category == 0):
-                questions = Question.query.all()
-            else:
-                questions = Question.query.filter(
-                    Question.category == quiz_category).all()
-
-            # In order to remove the previous questions
-            questions = Question.query.filter(
-                Question.id.in_(previous_questions)).all()
-            # Another way by using " notin" instead of "in":
-            # Question.query.filter_by(category=category['id'])
-            # .filter(Question.id.notin_((previous_questions))).all()
-
-            if (len(questions) > 0):
-                # For creating random questions
-                # randit: Return random questions.
-                # https://docs.python.org/3/library/random.html#functions-for-integers
-                # (Functions for integers¶)
-                question = questions[random.randint(
-                    0, len(questions))].format()
-            else:
-                question = None
+            # Instead of loading the whole category (or table) on
+            # every call, the quiz index keeps the ids per category
+            # in memory and only the chosen question is loaded
+            # (see quiz_index.py)
+            question = get_quiz_index().draw(
+                int(quiz_category), previous_questions)
+            if question is not None:
+                question = format_question_row(question)
 
             return jsonify(
                 {'success': True, 'question': question})
@@ -372,6 +664,107 @@ def create_app(test_config=None):
         except BaseException:
             abort(422)  # unprocessable
 
+    # Server side quizzes: the deck of the category is drawn once,
+    # then every call pops the next question, the client doesn't
+    # send previous_questions (see quiz_sessions.py)
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @read_only
+    def start_quiz_session():
+        body = request.get_json(silent=True) or {}
+        try:
+            quiz_category = int(body['quiz_category']['id'])
+        except (KeyError, TypeError, ValueError):
+            abort(422)
+
+        store = get_quiz_sessions()
+        session_id, questions_left = store.start(
+            quiz_category,
+            get_quiz_index().sample(quiz_category, store.deck_size))
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'quiz_category': quiz_category,
+            'questions_left': questions_left
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @read_only
+    def next_quiz_question(session_id):
+        store = get_quiz_sessions()
+        # Unknown or expired session
+        if store.get(session_id) is None:
+            abort(404)
+        try:
+            question, questions_left = next_question(store, session_id)
+        except KeyError:
+            # It expired in between
+            abort(404)
+
+        if question is not None:
+            question = format_question_row(question)
+        return jsonify({
+            'success': True,
+            'question': question,
+            'questions_left': questions_left
+        })
+
+    @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+    def end_quiz_session(session_id):
+        if not get_quiz_sessions().end(session_id):
+            abort(404)
+        return jsonify({'success': True, 'ended': session_id})
+
+    # What the database connection pools are doing (connections
+    # in use, idle, overflow) for the primary and the replica
+    @app.route('/stats/pool', methods=['GET'])
+    def get_pool_stats():
+        return jsonify({
+            'success': True,
+            'pools': pool_stats(app)
+        })
+
+    # Hits, misses and hit rate of the search cache
+    # (see search_cache.py)
+    @app.route('/stats/search-cache', methods=['GET'])
+    def get_search_cache_stats():
+        return jsonify({
+            'success': True,
+            'search_cache': get_search_cache().stats()
+        })
+
+    # Latency, status codes and SQL statements of every route in
+    # the Prometheus text format (see metrics.py)
+    @app.route('/metrics', methods=['GET'])
+    def get_prometheus_metrics():
+        if not app.config['METRICS_ENABLED']:
+            abort(404)
+        return Response(get_metrics().render(),
+                        content_type='text/plain; version=0.0.4')
+
+    # cProfile stats of the sampled requests by endpoint (see
+    # sampling.py), ?sort=cumulative|tottime|calls&limit=20
+    # DELETE starts again from nothing
+    @app.route('/admin/profiles', methods=['GET', 'DELETE'])
+    def admin_profiles():
+        profiler = get_sampling_profiler()
+        if not profiler.token:
+            abort(404)
+        if not profiler.authorized():
+            abort(403)
+        if request.method == 'DELETE':
+            profiler.reset()
+            return jsonify({'success': True})
+
+        sort = request.args.get('sort', 'cumulative')
+        limit = request.args.get('limit', 20, type=int)
+        if sort not in ('cumulative', 'tottime', 'calls') or limit < 1:
+            abort(400)
+        return jsonify({
+            'success': True,
+            'sample_rate': profiler.sample_rate,
+            'profiles': profiler.summary(sort, limit)
+        })
+
     # @TODO(Done): Create error handlers for all expected errors including 404 and 422.
     # To know more about errors check this https://httpstatusdogs.com/
     # https://www.flickr.com/photos/girliemac/sets/72157628409467125-------#
@@ -385,6 +778,14 @@ def create_app(test_config=None):
             "message": "bad request"
         }), 400
 
+    @app.errorhandler(403)
+    def forbidden(error):
+        return jsonify({
+            "success": False,
+            "error": 403,
+            "message": "forbidden"
+        }), 403
+
     @app.errorhandler(404)
     def ressource_not_found(error):
         return jsonify({
@@ -409,6 +810,24 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 422
 
+    # Refused by the admission control (see admission.py), the
+    # client is told when to come back
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+        }), 429, retry_after_headers(error)
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503, retry_after_headers(error)
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -0,0 +1,189 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, current_app
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+
+'''
+Admission control (RATE_LIMIT_* and ADMISSION_* in config.py)
+    a request is refused early, before it reaches the database, when
+    - its client used up its token bucket (RATE_LIMIT_CLIENT, for
+      all the routes) or the route used up its own one, shared by
+      every client (RATE_LIMIT_ROUTES): 429 Too Many Requests
+    - it is one of the ADMISSION_EXPENSIVE_ROUTES and
+      ADMISSION_MAX_CONCURRENT of them are already running in this
+      process, and no slot frees up within ADMISSION_WAIT seconds:
+      503 Service Unavailable, so the requests don't pile up on the
+      database connection pool without any limit
+    Both come with a Retry-After header (the seconds ride on the
+    exception as retry_after, Werkzeug 0.15 doesn't take them as an
+    argument), and the refused requests are counted per reason and
+    endpoint (trivia_admission_rejected_total in GET /metrics)
+    Behind a proxy or a load balancer every request comes from its
+    address, all the users would share one client bucket: set
+    RATE_LIMIT_CLIENT_HEADER and RATE_LIMIT_TRUSTED_PROXIES
+    The buckets live in a backend. "memory" keeps them in this process,
+    another one (a store shared by the workers) is added with
+    register_rate_limit_backend(name, factory) and picked with
+    RATE_LIMIT_BACKEND, see MemoryBackend.take for what it must do.
+    The concurrency cap is always per process, like the connection
+    pool it protects
+    https://en.wikipedia.org/wiki/Token_bucket
+    https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Retry-After
+'''
+
+
+class MemoryBackend:
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # key -> (tokens, monotonic time of the last update), least
+        # recently used first. A bucket dropped to stay under
+        # max_keys comes back full, which only lets the client in
+        self.buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        # Takes a token from the bucket key (refilled with rate tokens
+        # per second, it holds at most burst). Returns 0 when there
+        # was one, or else the seconds until there is one (nothing is
+        # taken then). A shared backend has to do the same atomically
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+# name -> factory(app) returning a backend
+rate_limit_backends = {
+    'memory': lambda app: MemoryBackend(app.config['RATE_LIMIT_MAX_KEYS'])
+}
+
+
+def register_rate_limit_backend(name, factory):
+    rate_limit_backends[name] = factory
+
+
+def retry_after(seconds):
+    # Retry-After takes whole seconds
+    return max(1, int(math.ceil(seconds)))
+
+
+def refused(error_class, seconds):
+    error = error_class()
+    error.retry_after = retry_after(seconds)
+    return error
+
+
+class AdmissionControl:
+
+    def __init__(self, app, backend):
+        self.backend = backend
+        self.client_limit = app.config['RATE_LIMIT_CLIENT']
+        self.route_limits = app.config['RATE_LIMIT_ROUTES']
+        self.client_header = app.config['RATE_LIMIT_CLIENT_HEADER']
+        self.trusted_proxies = app.config['RATE_LIMIT_TRUSTED_PROXIES']
+        self.exempt = set(app.config['RATE_LIMIT_EXEMPT'])
+        self.expensive = set(app.config['ADMISSION_EXPENSIVE_ROUTES'])
+        self.max_concurrent = app.config['ADMISSION_MAX_CONCURRENT']
+        self.wait = app.config['ADMISSION_WAIT']
+        self.slots = threading.BoundedSemaphore(self.max_concurrent)
+        self.lock = threading.Lock()
+        # (reason, endpoint) -> refused requests
+        self.rejected = {}
+        self.running = 0
+
+    def client(self):
+        # Behind a proxy every request comes from the proxy. Each
+        # proxy appends the address it got the request from to
+        # RATE_LIMIT_CLIENT_HEADER, so the client is the one added by
+        # the outermost of our RATE_LIMIT_TRUSTED_PROXIES proxies. The
+        # ones before it are whatever the client sent
+        if self.client_header and self.client_header in request.headers:
+            addresses = [address.strip() for address in
+                         request.headers[self.client_header].split(',')]
+            if len(addresses) >= self.trusted_proxies:
+                return addresses[-self.trusted_proxies]
+        return request.remote_addr or 'unknown'
+
+    def reject(self, reason, endpoint):
+        with self.lock:
+            key = (reason, endpoint)
+            self.rejected[key] = self.rejected.get(key, 0) + 1
+
+    def admit(self, endpoint):
+        # Raises a 429 / 503 or returns, with a slot taken when the
+        # endpoint is an expensive one (g.admission_slot)
+        if self.client_limit:
+            wait = self.backend.take(
+                'client:' + self.client(), *self.client_limit)
+            if wait:
+                self.reject('client_rate', endpoint)
+                raise refused(TooManyRequests, wait)
+        if endpoint in self.route_limits:
+            wait = self.backend.take(
+                'route:' + endpoint, *self.route_limits[endpoint])
+            if wait:
+                self.reject('route_rate', endpoint)
+                raise refused(TooManyRequests, wait)
+        if endpoint in self.expensive:
+            if not self.slots.acquire(timeout=self.wait):
+                self.reject('concurrency', endpoint)
+                raise refused(ServiceUnavailable, 1)
+            g.admission_slot = True
+            with self.lock:
+                self.running += 1
+
+    def release(self):
+        if g.pop('admission_slot', False):
+            with self.lock:
+                self.running -= 1
+            self.slots.release()
+
+
+def init_admission(app):
+    name = app.config['RATE_LIMIT_BACKEND']
+    if name not in rate_limit_backends:
+        app.logger.warning('Rate limit backend %s is not available, '
+                           'using memory', name)
+        name = 'memory'
+    admission = AdmissionControl(app, rate_limit_backends[name](app))
+    if not app.config['RATE_LIMIT_CLIENT_HEADER'] and not app.debug:
+        app.logger.warning(
+            'RATE_LIMIT_CLIENT_HEADER is not set: behind a proxy all '
+            'the clients share one rate limit bucket')
+    app.extensions['admission'] = admission
+
+    @app.before_request
+    def admit_request():
+        # Unknown URLs (404) and the CORS preflights go through
+        if request.endpoint is None or request.method == 'OPTIONS' \
+                or request.endpoint in admission.exempt:
+            return
+        admission.admit(request.endpoint)
+
+    @app.teardown_request
+    def release_admission_slot(error):
+        admission.release()
+
+    return admission
+
+
+def get_admission():
+    return current_app.extensions['admission']
+
+
+def retry_after_headers(error):
+    # The Retry-After header of a 429 / 503 for the error handlers
+    seconds = getattr(error, 'retry_after', None)
+    return {'Retry-After': str(seconds)} if seconds else {}
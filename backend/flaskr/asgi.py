@@ -0,0 +1,641 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import timezone
+from functools import wraps
+from sqlalchemy import select, func, text, or_
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.http import parse_etags, parse_date, http_date, quote_etag
+import config
+from models import Question, Category, engine_options, \
+    bump_data_version, get_data_version, get_data_modified, \
+    run_question_hooks, QUESTION_COLUMNS, format_question_row
+from . import QUESTIONS_PER_PAGE, MAX_QUESTIONS_PER_PAGE, get_quiz_count
+from .quiz_index import QuizIndex
+from .cache import ResponseCache
+from .search_cache import SearchCache, normalize_search_term
+from .conditional import current_etag, settled
+from .bulk import clean_question
+from .counts import question_counts, COUNT_QUESTIONS
+from .json_provider import json_providers, stdlib_dumps
+from .search import PG_SEARCH, PG_COUNT, SQLITE_SEARCH, SQLITE_COUNT, \
+    sqlite_match_query, pg_match_query
+
+'''
+Async (ASGI) flavor of the API
+    the same routes, JSON and errors as create_app, but the views are
+    coroutines and the database is reached through an async
+    SQLAlchemy engine (asyncpg for PostgreSQL, aiosqlite for SQLite),
+    so one process keeps answering other requests while a query
+    waits on the database. Run it with an ASGI server, as a single
+    process (the async views are what lets it serve many requests):
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+
+    Its caches, quiz index, ETag and Last-Modified follow the data
+    version of this process only (models.data_version), nothing tells
+    it about a write made by another process. So no "--workers N",
+    and no other app (the Flask app, "flask load-trivia", ...)
+    writing to its database while it runs, or it would keep serving
+    stale bodies and 304s. Restart it after such a write
+    It has the read / write routes of the frontend (categories,
+    questions, search, category questions, quizzes). Bulk ingest,
+    export, streaming, metrics and the profilers are only in the
+    Flask app, give it its own database
+    https://docs.sqlalchemy.org/en/14/orm/extensions/asyncio.html
+    https://www.starlette.io/
+'''
+
+questions = Question.__table__
+categories = Category.__table__
+
+# Same messages as the error handlers of create_app
+ERROR_MESSAGES = {
+    400: 'bad request',
+    403: 'forbidden',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+    500: 'internal server error',
+}
+
+
+def async_database_url(database_path):
+    # The async drivers of the same databases
+    # https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#aiosqlite
+    # https://docs.sqlalchemy.org/en/14/dialects/postgresql.html#asyncpg
+    scheme, rest = database_path.split(':', 1)
+    if scheme == 'sqlite':
+        return 'sqlite+aiosqlite:' + rest
+    if scheme in ('postgres', 'postgresql'):
+        return 'postgresql+asyncpg:' + rest
+    return database_path
+
+
+def create_engine(database_path, settings):
+    # The pool settings of models.engine_options, adapted to the
+    # async drivers
+    options = engine_options(database_path, settings)
+    if 'connect_args' in options:
+        # asyncpg takes the statement_timeout as a server setting
+        options['connect_args'] = {'server_settings': {
+            'statement_timeout': str(
+                settings['DATABASE_STATEMENT_TIMEOUT'])}}
+    if database_path in ('sqlite://', 'sqlite:///:memory:'):
+        # Every aiosqlite connection would get its own empty
+        # in-memory database, they have to share one
+        options['poolclass'] = StaticPool
+    return create_async_engine(async_database_url(database_path),
+                               **options)
+
+
+def jsonify(request, data, status_code=200):
+    # Same JSON as flask.jsonify: sorted keys, compact, encoded by
+    # the JSON_PROVIDER (see json_provider.py)
+    return Response(request.app.state.json_dumps(data) + b'\n',
+                    status_code, media_type='application/json')
+
+
+def abort(status_code):
+    raise HTTPException(status_code)
+
+
+def arg_int(request, name, default=None):
+    # request.args.get(name, default, type=int)
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def get_per_page(request):
+    per_page = arg_int(request, 'per_page', QUESTIONS_PER_PAGE)
+    return max(1, min(per_page, MAX_QUESTIONS_PER_PAGE))
+
+
+def get_page(request):
+    # Same as in create_app, before the try of the view
+    page = arg_int(request, 'page', 1)
+    if page < 1:
+        abort(400)
+    return page
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        abort(400)
+
+
+def read_engine(request):
+    # The read only routes go to the replica when there is one
+    state = request.app.state
+    return state.replica or state.engine
+
+
+async def cached(cache, key, compute):
+    # ResponseCache.get_or_set for a coroutine
+    value = cache.get(key)
+    if value is None:
+        version = get_data_version()
+        value = await compute()
+        cache.set(key, value, version)
+    return value
+
+
+def written(request, action, question_id, category):
+    # What Question.insert / delete do after their commit
+    bump_data_version([(action, question_id, category)])
+    index = request.app.state.quiz_index
+    if index.built:
+        if action == 'insert':
+            index.add(question_id, category)
+        else:
+            index.remove(question_id, category)
+    run_question_hooks(action, question_id, category)
+
+
+def conditional(view):
+    # conditional.py for the async views
+    @wraps(view)
+    async def wrapper(request):
+        if request.method not in ('GET', 'HEAD'):
+            return await view(request)
+
+        etag = current_etag()
+        last_modified = get_data_modified()
+
+        if not_modified(request, etag, last_modified):
+            return set_validators(Response(status_code=304),
+                                  etag, last_modified)
+
+        response = await view(request)
+        if response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+
+    return wrapper
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = parse_etags(request.headers.get('if-none-match'))
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if_modified_since = parse_date(
+        request.headers.get('if-modified-since'))
+    if if_modified_since:
+        # Older Werkzeug versions return a naive UTC datetime
+        if if_modified_since.tzinfo is None:
+            if_modified_since = if_modified_since.replace(
+                tzinfo=timezone.utc)
+        return settled(last_modified) and \
+            last_modified <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.headers['ETag'] = quote_etag(etag)
+    if settled(last_modified):
+        response.headers['Last-Modified'] = http_date(last_modified)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+async def page_of(connection, query, page, per_page):
+    # paginate_questions: LIMIT / OFFSET in the database
+    result = await connection.execute(
+        query.order_by(questions.c.id).offset(
+            (page - 1) * per_page).limit(per_page))
+    return [format_question_row(row) for row in result], None
+
+
+async def page_after(connection, query, after_id, per_page):
+    # paginate_questions_after: keyset pagination on the id
+    result = await connection.execute(
+        query.where(questions.c.id > after_id).order_by(
+            questions.c.id).limit(per_page + 1))
+    rows = [format_question_row(row) for row in result]
+    current_page = rows[:per_page]
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = current_page[-1]['id']
+    return current_page, next_cursor
+
+
+async def scalar(connection, query, parameters=None):
+    result = await connection.execute(query, parameters or {})
+    return result.scalar()
+
+
+async def category_map(request, connection):
+    async def load():
+        result = await connection.execute(
+            select(categories.c.id, categories.c.type).order_by(
+                categories.c.type))
+        return {category_id: category_type
+                for category_id, category_type in result}
+    return await cached(request.app.state.cache, ('categories',), load)
+
+
+async def read_counts(request, connection):
+    # counts.read_counts with the async connection
+    async def load():
+        try:
+            result = await connection.execute(select(
+                question_counts.c.category, question_counts.c.questions))
+        except (OperationalError, ProgrammingError):
+            # No question_counts table yet, see counts.load_counts
+            await connection.rollback()
+            result = await connection.execute(text(COUNT_QUESTIONS))
+        return dict(result.all())
+    return await cached(request.app.state.cache, ('question_counts',),
+                        load)
+
+
+@conditional
+async def get_categories(request):
+    async with read_engine(request).connect() as connection:
+        categories_map = await category_map(request, connection)
+        counts = await read_counts(request, connection)
+    if not categories_map:
+        abort(404)
+    return jsonify(request, {
+        'success': True,
+        'categories': categories_map,
+        'question_counts': {category_id: counts.get(category_id, 0)
+                            for category_id in categories_map}
+    })
+
+
+async def paginated(request, connection, query, key):
+    # The page / per_page or after_id page of a query, cached like
+    # in create_app, returns (questions, next_cursor, after_id)
+    cache = request.app.state.cache
+    page = get_page(request)
+    per_page = get_per_page(request)
+    after_id = arg_int(request, 'after_id')
+    if after_id is None:
+        questions_list, next_cursor = await cached(
+            cache, key + (page, per_page),
+            lambda: page_of(connection, query, page, per_page))
+    else:
+        questions_list, next_cursor = await cached(
+            cache, key + ('after', after_id, per_page),
+            lambda: page_after(connection, query, after_id, per_page))
+    return questions_list, next_cursor, after_id
+
+
+@conditional
+async def get_questions(request):
+    # Every error is a 422 here, like in create_app (Exception and
+    # not BaseException, a cancelled request has to stay cancelled)
+    get_page(request)
+    try:
+        async with read_engine(request).connect() as connection:
+            questions_list, next_cursor, after_id = await paginated(
+                request, connection, select(*QUESTION_COLUMNS),
+                ('questions',))
+            if len(questions_list) == 0:
+                abort(404)
+            total_questions = sum(
+                (await read_counts(request, connection)).values())
+            categories_map = await category_map(request, connection)
+
+        result = {
+            'success': True,
+            'questions_list': questions_list,
+            'categories': categories_map,
+            'total_questions': total_questions,
+            'current_category': None
+        }
+        if after_id is not None:
+            result['next_cursor'] = next_cursor
+        return jsonify(request, result)
+    except Exception:
+        abort(422)
+
+
+async def delete_questions(request):
+    question_id = request.path_params['question_id']
+    state = request.app.state
+    # By id: a question without a category (NULL) exists too
+    async with state.engine.connect() as connection:
+        row = (await connection.execute(select(
+            questions.c.id, questions.c.category).where(
+            questions.c.id == question_id))).first()
+    if row is None:
+        abort(404)
+    category = row.category
+
+    try:
+        async with state.engine.begin() as connection:
+            await connection.execute(questions.delete().where(
+                questions.c.id == question_id))
+    except Exception:
+        abort(422)
+    written(request, 'delete', question_id, category)
+    return jsonify(request, {
+        'success': True,
+        'deleted': question_id
+    })
+
+
+async def create_question(request):
+    body = await read_json(request)
+    if not all(body.get(field) for field in
+               ('question', 'answer', 'difficulty', 'category')):
+        abort(400)
+
+    try:
+        # asyncpg doesn't convert the types like psycopg2 does
+        row = clean_question(body)
+        async with request.app.state.engine.begin() as connection:
+            result = await connection.execute(
+                questions.insert().values(**row))
+            question_id = result.inserted_primary_key[0]
+    except Exception:
+        abort(422)
+    written(request, 'insert', question_id, row['category'])
+    return jsonify(request, {'success': True, 'created': question_id})
+
+
+async def search_question_ids(connection, search_term, limit, offset):
+    # search.search_question_ids on the async connection
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        term = pg_match_query(search_term)
+        search, count = PG_SEARCH, PG_COUNT
+    elif dialect == 'sqlite':
+        term = sqlite_match_query(search_term)
+        search, count = SQLITE_SEARCH, SQLITE_COUNT
+    else:
+        pattern = '%{}%'.format(search_term)
+        matches = or_(questions.c.question.ilike(pattern),
+                      questions.c.answer.ilike(pattern))
+        result = await connection.execute(
+            select(questions.c.id).where(matches).order_by(
+                questions.c.id).limit(limit).offset(offset))
+        total = await scalar(connection, select(
+            func.count(questions.c.id)).where(matches))
+        return [row[0] for row in result], total
+    if not term:
+        return [], 0
+
+    result = await connection.execute(
+        text(search), {'term': term, 'limit': limit, 'offset': offset})
+    ids = [row[0] for row in result]
+    return ids, await scalar(connection, text(count), {'term': term})
+
+
+async def search_once(cache, key, search):
+    # SearchCache.search for a coroutine, the flight is a Future
+    loop = asyncio.get_running_loop()
+    value, flight, version = cache.join(key, loop.create_future)
+    if flight is None:
+        return value
+    if version is None:
+        # shield: a waiter that goes away doesn't cancel the flight
+        return await asyncio.shield(flight)
+    value = None
+    try:
+        value = await search()
+    except Exception as error:
+        flight.set_exception(error)
+        # Read once, or asyncio complains when nobody waited
+        flight.exception()
+        raise
+    except BaseException:
+        flight.cancel()
+        raise
+    finally:
+        cache.finish(key, value, version)
+    flight.set_result(value)
+    return value
+
+
+async def search_questions(request):
+    body = await read_json(request)
+    search_term = body.get('search_term')
+    if not search_term:
+        abort(404)
+
+    page = get_page(request)
+    per_page = get_per_page(request)
+    term = normalize_search_term(search_term)
+
+    async def search():
+        async with read_engine(request).connect() as connection:
+            ids, total = await search_question_ids(
+                connection, term, per_page, (page - 1) * per_page)
+            rows = {}
+            if ids:
+                result = await connection.execute(select(
+                    *QUESTION_COLUMNS).where(questions.c.id.in_(ids)))
+                rows = {row.id: format_question_row(row)
+                        for row in result}
+        return [rows[question_id] for question_id in ids
+                if question_id in rows], total
+
+    search_results, total_questions = await search_once(
+        request.app.state.search_cache, (term, page, per_page), search)
+    if len(search_results) == 0:
+        # Like create_app, an unknown term is a 500
+        raise Exception("Oops! Search term not found, Try something "
+                        "else or write fewer words ")
+
+    return jsonify(request, {
+        'success': True,
+        'questions': search_results,
+        'total_questions': total_questions,
+    })
+
+
+@conditional
+async def get_questions_by_category(request):
+    category_id = request.path_params['category_id']
+    get_page(request)
+    try:
+        in_category = questions.c.category == category_id
+        async with read_engine(request).connect() as connection:
+            category_questions, next_cursor, after_id = await paginated(
+                request, connection,
+                select(*QUESTION_COLUMNS).where(in_category),
+                ('category_questions', category_id))
+            if len(category_questions) == 0:
+                abort(404)
+            total_questions = (await read_counts(
+                request, connection)).get(category_id, 0)
+
+        result = {
+            'success': True,
+            'questions': category_questions,
+            'total_questions': total_questions,
+            'current_category': category_id}
+        if after_id is not None:
+            result['next_cursor'] = next_cursor
+        return jsonify(request, result)
+    except Exception:
+        abort(404)
+
+
+async def load_quiz_index(request, connection):
+    index = request.app.state.quiz_index
+    if not index.current() and not (index.built and index.catch_up()):
+        version = get_data_version()
+        result = await connection.execute(
+            select(questions.c.id, questions.c.category))
+        index.load(result.fetchall(), version)
+    return index
+
+
+async def draw_question(request, quiz_category, previous_questions):
+    # QuizIndex.draw with the async connection
+    async with read_engine(request).connect() as connection:
+        index = await load_quiz_index(request, connection)
+        while True:
+            question_id = index.draw_id(quiz_category, previous_questions)
+            if question_id is None:
+                return None
+            result = await connection.execute(
+                select(*QUESTION_COLUMNS).where(
+                    questions.c.id == question_id))
+            row = result.first()
+            if row is not None:
+                return format_question_row(row)
+            index.forget(question_id)
+
+
+async def draw_questions(request, quiz_category, previous_questions,
+                         count):
+    # QuizIndex.draw_many with the async connection
+    async with read_engine(request).connect() as connection:
+        index = await load_quiz_index(request, connection)
+        excluded = list(previous_questions)
+        drawn_questions = []
+        while len(drawn_questions) < count:
+            drawn = index.draw_ids(
+                quiz_category, excluded, count - len(drawn_questions))
+            if not drawn:
+                break
+            result = await connection.execute(
+                select(*QUESTION_COLUMNS).where(
+                    questions.c.id.in_(drawn)))
+            rows = {row.id: row for row in result}
+            for question_id in drawn:
+                if question_id in rows:
+                    drawn_questions.append(
+                        format_question_row(rows[question_id]))
+                else:
+                    index.forget(question_id)
+            excluded.extend(drawn)
+        return drawn_questions
+
+
+async def play_quiz(request):
+    try:
+        body = await request.json()
+        previous_questions = body.get('previous_questions', None) or []
+        quiz_category = body.get('quiz_category')['id']
+        count = get_quiz_count(body)
+        if count is not None:
+            drawn_questions = await draw_questions(
+                request, int(quiz_category), previous_questions, count)
+            return jsonify(request, {'success': True,
+                                     'questions': drawn_questions})
+        question = await draw_question(
+            request, int(quiz_category), previous_questions)
+        return jsonify(request, {'success': True, 'question': question})
+    except Exception:
+        abort(422)
+
+
+async def http_error(request, error):
+    status_code = getattr(error, 'status_code', 500)
+    return jsonify(request, {
+        'success': False,
+        'error': status_code,
+        'message': ERROR_MESSAGES.get(status_code, 'error')
+    }, status_code)
+
+
+class AccessControlHeaders:
+    # The headers set_access_allow_control adds in create_app
+    HEADERS = [
+        (b'access-control-allow-headers',
+         b'ContentType,Authorization, True'),
+        (b'access-control-allow-methods',
+         b'GET,POST,DELETE,UPDATE,OPTIONS,PUT,PATCH'),
+    ]
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(
+                    message.get('headers', [])) + self.HEADERS
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+def create_asgi_app(test_config=None):
+    # Same settings as create_app: config.py, then test_config
+    settings = {name: getattr(config, name) for name in dir(config)
+                if name.isupper()}
+    if test_config is not None:
+        settings.update(test_config)
+
+    engine = create_engine(settings['DATABASE_PATH'], settings)
+    replica = None
+    if settings['DATABASE_REPLICA_PATH']:
+        replica = create_engine(settings['DATABASE_REPLICA_PATH'],
+                                settings)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await engine.dispose()
+        if replica is not None:
+            await replica.dispose()
+
+    app = Starlette(
+        debug=False,
+        routes=[
+            Route('/categories', get_categories, methods=['GET']),
+            Route('/questions', get_questions, methods=['GET']),
+            Route('/questions', create_question, methods=['POST']),
+            Route('/questions/{question_id:int}', delete_questions,
+                  methods=['DELETE']),
+            Route('/questions/search', search_questions,
+                  methods=['POST']),
+            Route('/categories/{category_id:int}/questions',
+                  get_questions_by_category, methods=['GET', 'POST']),
+            Route('/quizzes', play_quiz, methods=['POST']),
+        ],
+        exception_handlers={
+            HTTPException: http_error,
+            Exception: http_error,
+        },
+        lifespan=lifespan)
+    app.state.settings = settings
+    app.state.json_dumps = json_providers.get(
+        settings['JSON_PROVIDER']) or stdlib_dumps
+    app.state.engine = engine
+    app.state.replica = replica
+    app.state.cache = ResponseCache(settings['CACHE_MAX_ENTRIES'])
+    app.state.search_cache = SearchCache(
+        settings['SEARCH_CACHE_MAX_ENTRIES'], settings['SEARCH_CACHE_TTL'])
+    app.state.quiz_index = QuizIndex()
+    app.add_middleware(AccessControlHeaders)
+    return app
@@ -0,0 +1,191 @@
+import json
+from models import db, Question, Category, QUESTION_COLUMNS, \
+    format_question_row
+
+'''
+Bulk ingest and export of questions
+    POST /questions/bulk takes a JSON array or NDJSON (one JSON
+    object per line) and inserts the valid rows in batches,
+    GET /questions/export streams the whole table as NDJSON
+    DELETE /questions and PATCH /questions take a list of ids and
+    run one DELETE / UPDATE ... WHERE id IN (...) in one transaction
+    (Question.delete_many / update_many), with the outcome of each id
+'''
+
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+# Ids in one DELETE / PATCH /questions, every id is a bound parameter
+# and old SQLite builds accept 999 of them in a statement
+MAX_BATCH_IDS = 500
+# What PATCH /questions can change
+BATCH_UPDATE_FIELDS = ('category', 'difficulty')
+
+
+def read_rows(request):
+    # Yields (row number, row or None, error or None), for NDJSON
+    # the body is read line by line and never loaded whole
+    if request.mimetype in ('application/x-ndjson',
+                            'application/jsonlines'):
+        for number, line in enumerate(request.stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield number, json.loads(line), None
+            except ValueError:
+                yield number, None, 'invalid JSON'
+        return
+
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        raise ValueError('expected a JSON array or NDJSON')
+    for number, row in enumerate(rows, start=1):
+        yield number, row, None
+
+
+def validate_question(row):
+    # Same rules as POST /questions, plus the types the database
+    # needs, so one bad row doesn't fail its whole batch
+    if not isinstance(row, dict):
+        return 'expected a JSON object'
+    if not all(row.get(field) for field in QUESTION_FIELDS):
+        return 'Please, Fill all the required fields'
+    for field in ('category', 'difficulty'):
+        try:
+            int(row[field])
+        except (TypeError, ValueError):
+            return '{} must be a number'.format(field)
+    return None
+
+
+def clean_question(row):
+    return {
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': int(row['category']),
+        'difficulty': int(row['difficulty'])
+    }
+
+
+def insert_batch(batch, errors):
+    # batch is a list of (row number, clean row), returns how many
+    # rows were inserted. If the batch fails we retry its rows one
+    # by one to find out which ones are wrong
+    try:
+        Question.insert_many([row for number, row in batch])
+        return len(batch)
+    except Exception:
+        db.session.rollback()
+
+    created = 0
+    for number, row in batch:
+        try:
+            Question.insert_many([row], notify=False)
+            created += 1
+        except Exception as error:
+            db.session.rollback()
+            errors.append({'row': number, 'error': str(error)})
+    # One version and one reload for the whole batch, not one a row
+    if created:
+        Question.inserted_many()
+    return created
+
+
+def ingest_questions(request, batch_size):
+    created = 0
+    errors = []
+    batch = []
+    for number, row, error in read_rows(request):
+        error = error or validate_question(row)
+        if error:
+            errors.append({'row': number, 'error': error})
+            continue
+        batch.append((number, clean_question(row)))
+        if len(batch) >= batch_size:
+            created += insert_batch(batch, errors)
+            batch = []
+    if batch:
+        created += insert_batch(batch, errors)
+    return created, errors
+
+
+def iter_questions(batch_size, *criteria):
+    # Yields the questions (already as dicts, like format()) that
+    # match the filters, ordered by id.
+    # stream_results asks the driver for a server side cursor
+    # (psycopg2 named cursor) and yield_per fetches batch_size rows
+    # at a time, so memory stays flat whatever the table size
+    # https://docs.sqlalchemy.org/en/13/orm/query.html#sqlalchemy.orm.query.Query.yield_per
+    rows = db.session.query(*QUESTION_COLUMNS).filter(
+        *criteria).order_by(Question.id).execution_options(
+        stream_results=True).yield_per(batch_size)
+    for row in rows:
+        yield format_question_row(row)
+
+
+def export_questions(batch_size):
+    for question in iter_questions(batch_size):
+        yield json.dumps(question) + '\n'
+
+
+def stream_category_questions(category_id, batch_size):
+    # The same JSON object as the paginated response, but written
+    # piece by piece: the array is emitted while the rows come in
+    # and the total is only known (and sent) at the end
+    yield '{"success": true, "current_category": %d, "questions": [' \
+        % category_id
+    total = 0
+    for question in iter_questions(
+            batch_size, Question.category == category_id):
+        if total:
+            yield ', '
+        yield json.dumps(question)
+        total += 1
+    yield '], "total_questions": %d}\n' % total
+
+
+def read_ids(body):
+    # The "ids" of a DELETE / PATCH body: a list of 1 to MAX_BATCH_IDS
+    # integers, the duplicates are dropped (the order is kept)
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not 0 < len(ids) <= MAX_BATCH_IDS:
+        raise ValueError('ids must be a list of 1 to {} ids'.format(
+            MAX_BATCH_IDS))
+    if not all(isinstance(question_id, int) and
+               not isinstance(question_id, bool) for question_id in ids):
+        raise ValueError('ids must be integers')
+    return list(dict.fromkeys(ids))
+
+
+def read_changes(body):
+    # {column: value} for PATCH /questions, None if there is nothing
+    # valid to change
+    changes = {}
+    for field in BATCH_UPDATE_FIELDS:
+        if body.get(field) is None:
+            continue
+        try:
+            changes[field] = int(body[field])
+        except (TypeError, ValueError):
+            return None
+    if 'category' in changes and db.session.query(Category.id).filter(
+            Category.id == changes['category']).first() is None:
+        return None
+    return changes or None
+
+
+def outcomes(ids, done, status):
+    # One {"id", "status"} per requested id, in the request order
+    done = set(done)
+    return [{'id': question_id,
+             'status': status if question_id in done else 'not_found'}
+            for question_id in ids]
+
+
+def delete_question_ids(ids):
+    deleted = Question.delete_many(ids)
+    return outcomes(ids, [question_id for question_id, _ in deleted],
+                    'deleted')
+
+
+def update_question_ids(ids, changes):
+    return outcomes(ids, Question.update_many(ids, changes), 'updated')
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+from flask import current_app
+from models import get_data_version
+
+'''
+ResponseCache
+    a small in-process LRU cache for the read endpoints (the
+    category map, pages of formatted questions, category listings)
+    Every entry belongs to a data version (models.data_version),
+    as soon as a write bumps the version the whole cache is
+    dropped, so a read never sees data older than the last write
+    https://docs.python.org/3/library/collections.html#collections.OrderedDict
+'''
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = get_data_version()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self):
+        version = get_data_version()
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        return version
+
+    def get(self, key):
+        with self.lock:
+            self._check_version()
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            # Most recently used entries go to the end
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def set(self, key, value, version):
+        # "version" is the data version read *before* the value was
+        # computed, if a write happened in between we don't keep it
+        with self.lock:
+            if self._check_version() != version:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_set(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            version = get_data_version()
+            value = compute()
+            self.set(key, value, version)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def init_cache(app, max_entries):
+    app.extensions['response_cache'] = ResponseCache(max_entries)
+    return app.extensions['response_cache']
+
+
+def get_cache():
+    return current_app.extensions['response_cache']
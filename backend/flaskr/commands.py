@@ -0,0 +1,120 @@
+import os
+import click
+from sqlalchemy import text
+from models import db, Question, Category, create_schema, \
+    bump_data_version, run_question_hooks
+from .search import setup_search
+from .migrations import migrate
+from .counts import reconcile_counts
+from .external_writes import mark_external_write
+
+'''
+CLI commands (run them from the backend folder with FLASK_APP=flaskr)
+    flask init-db       creates the tables and the search index,
+                        then runs the migrations
+    flask migrate       runs the migrations not applied yet
+    flask load-trivia   loads the questions of trivia.psql into any
+                        database (SQLite included), for tests and demos
+    flask reconcile-counts
+                        counts the questions again and fixes the
+                        question_counts table (see counts.py)
+https://flask.palletsprojects.com/en/1.1.x/cli/#custom-commands
+'''
+
+TRIVIA_DUMP = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'trivia.psql')
+
+
+def init_db(app):
+    create_schema(app)
+    with app.app_context():
+        setup_search(db.engine)
+        return migrate(db.engine)
+
+
+def read_dump_tables(path):
+    # Reads the "COPY table (columns) FROM stdin;" blocks of a
+    # pg_dump file: {table: [row dict, ...]}, \N is NULL
+    # https://www.postgresql.org/docs/current/sql-copy.html
+    tables = {}
+    rows = columns = None
+    with open(path, encoding='utf-8') as dump:
+        for line in dump:
+            line = line.rstrip('\n')
+            if rows is not None:
+                if line == '\\.':
+                    rows = None
+                    continue
+                values = [None if value == '\\N' else value
+                          for value in line.split('\t')]
+                rows.append(dict(zip(columns, values)))
+            elif line.startswith('COPY '):
+                table = line.split()[1].split('.')[-1]
+                columns = [column.strip() for column in line[
+                    line.index('(') + 1:line.index(')')].split(',')]
+                rows = tables.setdefault(table, [])
+    return tables
+
+
+def load_trivia_dump(app, path=TRIVIA_DUMP):
+    tables = read_dump_tables(path)
+    with app.app_context():
+        for model in (Category, Question):
+            rows = tables.get(model.__tablename__, [])
+            if rows:
+                db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+
+        if db.engine.dialect.name == 'postgresql':
+            # The ids came from the dump, the sequences have to
+            # continue after them
+            for table in ('categories', 'questions'):
+                db.session.execute(text(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "(SELECT max(id) FROM {0}))".format(table)))
+            db.session.commit()
+
+        bump_data_version()
+        run_question_hooks('reload', None, None)
+        # The running apps are other processes
+        mark_external_write('questions')
+    return {table: len(rows) for table, rows in tables.items()}
+
+
+def register_commands(app):
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        init_db(app)
+        click.echo('Created the tables and the search index')
+
+    @app.cli.command('migrate')
+    def migrate_command():
+        with app.app_context():
+            ran = migrate(db.engine)
+        for version, name in ran:
+            click.echo('Applied {} {}'.format(version, name))
+        if not ran:
+            click.echo('The schema is up to date')
+
+    @app.cli.command('reconcile-counts')
+    def reconcile_counts_command():
+        with app.app_context():
+            with db.engine.begin() as connection:
+                drift = reconcile_counts(connection)
+            if drift:
+                bump_data_version([])
+                mark_external_write('counts')
+        for category, (stored, counted) in sorted(drift.items()):
+            click.echo('category {}: {} stored, {} counted'.format(
+                category, stored, counted))
+        if not drift:
+            click.echo('The question counts are right')
+
+    @app.cli.command('load-trivia')
+    @click.argument('path', default=TRIVIA_DUMP)
+    def load_trivia_command(path):
+        counts = load_trivia_dump(app, path)
+        for table, count in counts.items():
+            click.echo('{}: {} rows'.format(table, count))
@@ -0,0 +1,124 @@
+import gzip
+from flask import request
+from .cache import ResponseCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+    compresses the JSON / text responses with brotli or gzip,
+    whichever the client prefers in Accept-Encoding (brotli wins a
+    tie, it only works if the brotli package is installed). Bodies
+    under COMPRESSION_MIN_SIZE bytes are sent as they are, the
+    compressed bytes would save less than they cost
+    A response with an ETag (the conditional endpoints) is the same
+    for a URL until the data changes, so its compressed bodies are
+    kept in a ResponseCache and compressed again only after a write
+    The ETag of a compressed body gets the encoding appended
+    ("...-gzip"), a strong ETag names one exact sequence of bytes
+    https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Accept-Encoding
+    https://www.rfc-editor.org/rfc/rfc9110#section-8.8.3
+'''
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson',
+                          'text/plain', 'text/html')
+
+
+def gzip_compress(body, level):
+    # mtime=0 so the same body always gives the same bytes
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def brotli_compress(body, level):
+    return brotli.compress(body, quality=level)
+
+
+class Compressor:
+
+    def __init__(self, app):
+        self.min_size = app.config['COMPRESSION_MIN_SIZE']
+        self.levels = {'gzip': app.config['COMPRESSION_LEVEL'],
+                       'br': app.config['COMPRESSION_BROTLI_LEVEL']}
+        # In order of preference
+        self.encoders = []
+        if brotli is not None:
+            self.encoders.append(('br', brotli_compress))
+        self.encoders.append(('gzip', gzip_compress))
+        self.cache = ResponseCache(
+            app.config['COMPRESSION_CACHE_ENTRIES'])
+
+    def encoding(self):
+        # The preferred encoding among the ones the client accepts,
+        # None for the identity
+        accepted = request.accept_encodings
+        best, best_quality = None, 0
+        for name, compress in self.encoders:
+            quality = accepted.quality(name)
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    def compress(self, name, body):
+        for encoder_name, compress in self.encoders:
+            if encoder_name == name:
+                return compress(body, self.levels[name])
+
+    def cached_compress(self, name, body, etag):
+        # The key is the URL, the ETag and the encoding, the cache
+        # is dropped with the data version like the response cache
+        key = (request.full_path, etag, name)
+        return self.cache.get_or_set(
+            key, lambda: self.compress(name, body))
+
+    def process(self, response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        name = self.encoding()
+        etag, weak = response.get_etag()
+
+        if response.status_code == 304:
+            # The client has the body of the encoding it asks for,
+            # it gets back the ETag of that variant
+            if name and etag and request.if_none_match.contains(
+                    '{}-{}'.format(etag, name)):
+                response.set_etag('{}-{}'.format(etag, name))
+            return response
+
+        if (name is None or response.status_code != 200
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+
+        if etag and request.method in ('GET', 'HEAD'):
+            compressed = self.cached_compress(name, body, etag)
+            response.set_etag('{}-{}'.format(etag, name), weak)
+        else:
+            compressed = self.compress(name, body)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = name
+        return response
+
+
+def etag_variants(etag):
+    # The ETags a client may hold for one body: the identity one
+    # and the compressed ones
+    return [etag] + ['{}-{}'.format(etag, name)
+                     for name in ('br', 'gzip')]
+
+
+def init_compression(app):
+    compressor = Compressor(app)
+    app.extensions['compressor'] = compressor
+
+    @app.after_request
+    def compress_response(response):
+        return compressor.process(response)
+
+    return compressor
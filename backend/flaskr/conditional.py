@@ -0,0 +1,85 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import request, make_response
+from models import get_data_version, get_data_modified
+from .compression import etag_variants
+
+'''
+conditional
+    decorator for the read endpoints that adds ETag / Last-Modified
+    and answers 304 Not Modified when the client already has the
+    current version, in that case the view doesn't run at all (no
+    query, no serialization, no body)
+    https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
+    https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/304
+'''
+
+# The data version starts at 0 in every process, so the ETag also
+# carries an id of the process, a restarted server never matches
+# the ETags handed out by the previous one
+PROCESS_TAG = uuid.uuid4().hex[:12]
+
+
+def current_etag():
+    # The response of a URL only changes when the data changes, so
+    # the version is enough (the ETag is always scoped to the URL)
+    return '{}-{}'.format(PROCESS_TAG, get_data_version())
+
+
+def settled(last_modified):
+    # Another write can still happen in the second of last_modified,
+    # with the same HTTP date. Until that second is over the date
+    # doesn't tell the versions apart: it isn't sent, and an
+    # If-Modified-Since alone never gives a 304 (RFC 7232, 2.2.2)
+    return datetime.now(timezone.utc) >= last_modified + timedelta(
+        seconds=1)
+
+
+def not_modified(etag, last_modified):
+    # If-None-Match wins over If-Modified-Since (RFC 7232, 6.)
+    # (any encoding of the body, see compression.py)
+    if request.if_none_match:
+        return any(request.if_none_match.contains(variant)
+                   for variant in etag_variants(etag))
+    if_modified_since = request.if_modified_since
+    if if_modified_since and settled(last_modified):
+        # Older Werkzeug versions return a naive UTC datetime
+        if if_modified_since.tzinfo is None:
+            if_modified_since = if_modified_since.replace(
+                tzinfo=timezone.utc)
+        return last_modified <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if settled(last_modified):
+        response.last_modified = last_modified
+    # Cached copies may be kept, but they have to be revalidated
+    # on each use, that's what makes the polling cheap
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+
+        # Both are read before the view runs: if a write sneaks in
+        # while it runs, the next request simply gets a new body
+        etag = current_etag()
+        last_modified = get_data_modified()
+
+        if not_modified(etag, last_modified):
+            response = make_response('', 304)
+            return set_validators(response, etag, last_modified)
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+
+    return wrapper
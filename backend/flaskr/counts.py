@@ -0,0 +1,212 @@
+import multiprocessing
+import threading
+import time
+from flask import current_app
+from sqlalchemy import Table, Column, Integer, MetaData, select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from models import db, bump_data_version
+from .cache import get_cache
+from .external_writes import mark_external_write
+
+'''
+Question counts
+    question_counts holds how many questions each category has
+    (category 0: the questions without one). Triggers on questions
+    keep it current in the same transaction as the write, whatever
+    made it (the models, the bulk and batch endpoints, plain SQL),
+    so the totals of GET /questions and GET /categories/<id>/questions
+    and the counts of GET /categories are read from a handful of rows
+    instead of a COUNT over the questions
+    What the triggers can't see (TRUNCATE, a restore with the
+    triggers disabled) is fixed by reconcile_counts: "flask
+    reconcile-counts" (from cron) or, in the app, every
+    COUNTS_RECONCILE_INTERVAL seconds by one of the processes
+    Migration 2 (flaskr/migrations.py) creates it all. Without it the
+    counts are counted from the questions (and a warning logged)
+    https://www.postgresql.org/docs/current/plpgsql-trigger.html
+    https://www.sqlite.org/lang_createtrigger.html
+    https://www.sqlite.org/lang_upsert.html
+'''
+
+NO_CATEGORY = 0
+
+question_counts = Table(
+    'question_counts', MetaData(),
+    Column('category', Integer, primary_key=True),
+    Column('questions', Integer, nullable=False))
+
+CREATE_TABLE = (
+    "CREATE TABLE IF NOT EXISTS question_counts ("
+    "category INTEGER PRIMARY KEY, questions INTEGER NOT NULL)")
+
+# One more question in the category of NEW / one less in OLD's, the
+# same SQL on both databases (UPSERT: SQLite 3.24+, PostgreSQL 9.5+)
+COUNT_NEW = (
+    "INSERT INTO question_counts (category, questions) "
+    "VALUES (COALESCE(NEW.category, 0), 1) "
+    "ON CONFLICT (category) DO UPDATE "
+    "SET questions = question_counts.questions + 1")
+COUNT_OLD = (
+    "UPDATE question_counts SET questions = questions - 1 "
+    "WHERE category = COALESCE(OLD.category, 0)")
+
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS question_counts_insert "
+    "AFTER INSERT ON questions BEGIN " + COUNT_NEW + "; END",
+    "CREATE TRIGGER IF NOT EXISTS question_counts_delete "
+    "AFTER DELETE ON questions BEGIN " + COUNT_OLD + "; END",
+    "CREATE TRIGGER IF NOT EXISTS question_counts_update "
+    "AFTER UPDATE OF category ON questions "
+    "WHEN OLD.category IS NOT NEW.category BEGIN "
+    + COUNT_OLD + "; " + COUNT_NEW + "; END",
+]
+
+PG_TRIGGERS = [
+    "CREATE OR REPLACE FUNCTION question_counts_update() "
+    "RETURNS trigger AS $$ BEGIN "
+    "IF TG_OP = 'UPDATE' AND "
+    "OLD.category IS NOT DISTINCT FROM NEW.category THEN "
+    "RETURN NULL; END IF; "
+    "IF TG_OP <> 'INSERT' THEN " + COUNT_OLD + "; END IF; "
+    "IF TG_OP <> 'DELETE' THEN " + COUNT_NEW + "; END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS question_counts_update ON questions",
+    "CREATE TRIGGER question_counts_update "
+    "AFTER INSERT OR DELETE OR UPDATE OF category ON questions "
+    "FOR EACH ROW EXECUTE PROCEDURE question_counts_update()",
+]
+
+COUNT_QUESTIONS = (
+    "SELECT COALESCE(category, 0), count(*) FROM questions "
+    "GROUP BY COALESCE(category, 0)")
+RECOUNT = (
+    "INSERT INTO question_counts (category, questions) " +
+    COUNT_QUESTIONS)
+# pg_try_advisory_xact_lock key of the in-app reconcile
+RECONCILE_LOCK = 7151
+
+
+def setup_counts(connection):
+    # The table and its triggers, nothing happens if they are there
+    connection.execute(text(CREATE_TABLE))
+    if connection.dialect.name == 'postgresql':
+        triggers = PG_TRIGGERS
+    else:
+        triggers = SQLITE_TRIGGERS
+    for statement in triggers:
+        connection.execute(text(statement))
+
+
+def stored_counts(connection):
+    return dict(connection.execute(select(
+        question_counts.c.category, question_counts.c.questions)).all())
+
+
+def reconcile_counts(connection):
+    # Counts the questions again (one scan of the (category, id)
+    # index) and replaces question_counts, returns {category:
+    # (stored, counted)} of the categories that were wrong
+    if connection.dialect.name == 'postgresql':
+        # The writes wait for the recount, or one committed while it
+        # runs would be counted twice (or not at all)
+        connection.execute(text("LOCK TABLE questions IN SHARE MODE"))
+    stored = stored_counts(connection)
+    # On SQLite this DELETE takes the write lock, nobody can write
+    # until the commit
+    connection.execute(question_counts.delete())
+    connection.execute(text(RECOUNT))
+    counted = stored_counts(connection)
+    return {category: (stored.get(category, 0), counted.get(category, 0))
+            for category in set(stored) | set(counted)
+            if stored.get(category, 0) != counted.get(category, 0)}
+
+
+class CountReconciler:
+    # Runs reconcile_counts in a background thread every interval
+    # seconds (0 never, the default: "flask reconcile-counts" from
+    # cron), started by a request that reads the counts. One process
+    # runs it per interval: the time of the next run is in shared
+    # memory, made before gunicorn forks the workers (preload_app),
+    # and on PostgreSQL an advisory lock keeps the other hosts out
+    # while it runs
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_run = multiprocessing.Value(
+            'd', time.time() + interval) if interval else None
+        self.running = threading.Lock()
+
+    def due(self):
+        # True for the one process that takes this run
+        now = time.time()
+        with self.next_run.get_lock():
+            if now < self.next_run.value:
+                return False
+            self.next_run.value = now + self.interval
+            return True
+
+    def maybe_start(self, app):
+        if not self.interval or not self.due() or \
+                not self.running.acquire(blocking=False):
+            return
+        threading.Thread(target=self.run, args=(app,), daemon=True).start()
+
+    def run(self, app):
+        try:
+            with app.app_context():
+                with db.engine.begin() as connection:
+                    if connection.dialect.name == 'postgresql' and \
+                            not connection.execute(text(
+                                "SELECT pg_try_advisory_xact_lock(:key)"),
+                                {'key': RECONCILE_LOCK}).scalar():
+                        # Another host is at it
+                        return
+                    drift = reconcile_counts(connection)
+                if drift:
+                    app.logger.warning('question counts were wrong '
+                                       '{category: (stored, counted)}: %s',
+                                       drift)
+                    # The cached counts are stale, the questions
+                    # didn't change. The other hosts read the mark
+                    bump_data_version([])
+                    mark_external_write('counts')
+        except Exception:
+            app.logger.exception('reconciling the question counts failed')
+        finally:
+            self.running.release()
+
+
+def load_counts():
+    try:
+        return stored_counts(db.session)
+    except (OperationalError, ProgrammingError):
+        # No question_counts table: migration 2 didn't run
+        db.session.rollback()
+        current_app.logger.warning(
+            'the question_counts table is missing (run "flask '
+            'migrate"), counting the questions')
+        return dict(db.session.execute(text(COUNT_QUESTIONS)).all())
+
+
+def read_counts():
+    # {category: questions} (only the categories that have some),
+    # from the cache until the next write
+    app = current_app._get_current_object()
+    reconciler = app.extensions.get('count_reconciler')
+    if reconciler is not None:
+        reconciler.maybe_start(app)
+    return get_cache().get_or_set(('question_counts',), load_counts)
+
+
+def total_questions():
+    return sum(read_counts().values())
+
+
+def category_total(category_id):
+    return read_counts().get(category_id, 0)
+
+
+def init_counts(app):
+    app.extensions['count_reconciler'] = CountReconciler(
+        app.config['COUNTS_RECONCILE_INTERVAL'])
+    return app.extensions['count_reconciler']
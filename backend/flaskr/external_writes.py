@@ -0,0 +1,112 @@
+import multiprocessing
+import time
+from flask import current_app
+from sqlalchemy import Table, Column, Integer, String, MetaData, \
+    select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from models import db, bump_data_version, run_question_hooks
+
+'''
+External writes
+    the data version (models.data_version) is in the memory of the
+    app's processes, a write made by another process ("flask
+    load-trivia", "flask reconcile-counts" from cron, the reconcile
+    of another host) doesn't move it, and the workers would keep
+    serving their cached bodies and 304s. Such a write adds one to
+    its row of the external_writes table (migration 4):
+    - 'questions': the questions changed, the caches are dropped and
+      the quiz and suggest indexes built again (a 'reload')
+    - 'counts': only question_counts changed, the caches are dropped
+    Every EXTERNAL_WRITES_POLL_INTERVAL seconds one request of one
+    worker reads the table (a handful of rows on the primary) and
+    bumps the data version when a row moved. The time of the next
+    read and the rows seen are in shared memory, made before gunicorn
+    forks the workers (preload_app) like CountReconciler's, so one
+    worker reads and bumps for all of them
+    The ASGI app (asgi.py) doesn't read it, restart it instead
+'''
+
+KINDS = ('questions', 'counts')
+
+external_writes = Table(
+    'external_writes', MetaData(),
+    Column('kind', String(16), primary_key=True),
+    Column('serial', Integer, nullable=False))
+
+# The same SQL on both databases (see counts.COUNT_NEW)
+MARK = (
+    "INSERT INTO external_writes (kind, serial) VALUES (:kind, 1) "
+    "ON CONFLICT (kind) DO UPDATE "
+    "SET serial = external_writes.serial + 1")
+
+
+def mark_external_write(kind):
+    # Tells the running apps about a write they didn't make, in its
+    # own transaction: without the table (migration 4 didn't run)
+    # they only see it after a restart or their next write, False
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(MARK), {'kind': kind})
+        return True
+    except (OperationalError, ProgrammingError):
+        current_app.logger.warning(
+            'the external_writes table is missing (run "flask '
+            'migrate"), restart the app to see this write')
+        return False
+
+
+class ExternalWriteWatcher:
+
+    def __init__(self, interval):
+        self.interval = interval
+        # The first request reads the table, to know where it starts
+        self.next_poll = multiprocessing.Value('d', 0.0)
+        # The serial of each kind seen last, -1 before the first read
+        self.seen = multiprocessing.Array('q', [-1] * len(KINDS),
+                                          lock=False)
+
+    def due(self):
+        # True for the one process that takes this read
+        now = time.time()
+        with self.next_poll.get_lock():
+            if now < self.next_poll.value:
+                return False
+            self.next_poll.value = now + self.interval
+            return True
+
+    def poll(self):
+        if not self.interval or not self.due():
+            return
+        try:
+            with db.engine.connect() as connection:
+                serials = dict(connection.execute(select(
+                    external_writes.c.kind,
+                    external_writes.c.serial)).all())
+        except (OperationalError, ProgrammingError):
+            current_app.logger.debug('reading external_writes failed',
+                                     exc_info=True)
+            return
+        with self.next_poll.get_lock():
+            moved = []
+            for position, kind in enumerate(KINDS):
+                serial = serials.get(kind, 0)
+                if self.seen[position] not in (-1, serial):
+                    moved.append(kind)
+                self.seen[position] = serial
+        if 'questions' in moved:
+            bump_data_version()
+            run_question_hooks('reload', None, None)
+        elif moved:
+            # The questions didn't change
+            bump_data_version([])
+
+
+def init_external_writes(app):
+    watcher = app.extensions['external_writes'] = ExternalWriteWatcher(
+        app.config['EXTERNAL_WRITES_POLL_INTERVAL'])
+
+    @app.before_request
+    def poll_external_writes():
+        watcher.poll()
+
+    return watcher
@@ -0,0 +1,107 @@
+import json
+import re
+from flask import current_app, jsonify as flask_jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON providers
+    jsonify() below replaces flask.jsonify in the views. It sends
+    the same bytes (sorted keys, compact, \\uXXXX escapes, final
+    newline), but the encoding is done by the provider named by
+    JSON_PROVIDER in config.py:
+    - 'json': flask.jsonify itself (the standard library)
+    - 'orjson': orjson, several times faster on the list endpoints
+    Another one can be added with register_json_provider(name,
+    dumps), dumps(data) has to return the compact JSON as bytes.
+    Pretty printed responses (DEBUG) always go through flask.jsonify
+    https://github.com/ijl/orjson
+'''
+
+# What json.dumps(ensure_ascii=True) escapes and orjson writes as
+# UTF-8: everything above "~" (DEL included)
+NOT_ASCII = re.compile(r'[^\x00-\x7e]')
+NOT_ASCII_BYTES = re.compile(rb'[^\x00-\x7e]')
+
+
+def escape_character(match):
+    code = ord(match.group())
+    if code > 0xFFFF:
+        # Outside of the BMP it's a surrogate pair, like json.dumps
+        code -= 0x10000
+        return '\\u{:04x}\\u{:04x}'.format(
+            0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return '\\u{:04x}'.format(code)
+
+
+def stdlib_dumps(data):
+    return json.dumps(data, sort_keys=True,
+                      separators=(',', ':')).encode('ascii')
+
+
+def str_keys(data):
+    # orjson sorts the keys as strings ("10" before "2") while
+    # json.dumps sorts the ints first, the dicts with keys that
+    # aren't strings (the category map) are encoded by json.dumps
+    # and put in as they are
+    if isinstance(data, dict):
+        if not all(isinstance(key, str) for key in data):
+            return orjson.Fragment(stdlib_dumps(data))
+        return {key: str_keys(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [str_keys(value) for value in data]
+    return data
+
+
+def orjson_dumps(data):
+    try:
+        encoded = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        encoded = orjson.dumps(str_keys(data),
+                               option=orjson.OPT_SORT_KEYS)
+    if NOT_ASCII_BYTES.search(encoded):
+        # Only inside strings, escaped the way json.dumps does it
+        encoded = NOT_ASCII.sub(
+            escape_character, encoded.decode('utf-8')).encode('ascii')
+    return encoded
+
+
+# name -> dumps, None means flask.jsonify
+json_providers = {'json': None}
+if orjson is not None:
+    json_providers['orjson'] = orjson_dumps
+
+
+def register_json_provider(name, dumps):
+    json_providers[name] = dumps
+
+
+def init_json_provider(app):
+    name = app.config['JSON_PROVIDER']
+    if name not in json_providers:
+        app.logger.warning('JSON provider %s is not available, using '
+                           'the standard library', name)
+        name = 'json'
+    app.extensions['json_dumps'] = json_providers[name]
+    return json_providers[name]
+
+
+def jsonify(*args, **kwargs):
+    app = current_app
+    dumps = app.extensions.get('json_dumps')
+    if dumps is None or app.debug or \
+            app.config.get('JSONIFY_PRETTYPRINT_REGULAR'):
+        return flask_jsonify(*args, **kwargs)
+    if args and kwargs:
+        raise TypeError('jsonify() takes args or kwargs, not both')
+    data = args[0] if len(args) == 1 else (args or kwargs)
+    try:
+        encoded = dumps(data)
+    except TypeError:
+        # A type only Flask's encoder knows (dates, ...)
+        return flask_jsonify(*args, **kwargs)
+    return app.response_class(encoded + b'\n',
+                              mimetype='application/json')
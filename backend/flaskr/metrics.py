@@ -0,0 +1,298 @@
+import threading
+import time
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from models import pool_stats
+
+'''
+Metrics
+    per route latency histograms, response counts by status and the
+    requests in flight (before_request / after_request), plus the
+    number of SQL statements and the time spent in the database by
+    each request (SQLAlchemy engine events)
+    Everything is served at GET /metrics in the Prometheus text
+    format, so a scraper can graph it
+    https://prometheus.io/docs/instrumenting/exposition_formats/
+    https://docs.sqlalchemy.org/en/13/core/events.html#sqlalchemy.events.ConnectionEvents
+'''
+
+# Upper bounds (seconds) of the latency buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the "SQL statements per request" buckets, a
+# request that runs a lot of statements is usually an N+1
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        # Prometheus buckets are cumulative
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield name + '_bucket', dict(labels, le=str(bound)), \
+                cumulative
+        yield name + '_bucket', dict(labels, le='+Inf'), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.statements = {}
+        self.db_seconds = {}
+        self.responses = {}
+        self.in_flight = 0
+        # Functions returning more metrics, as a list of
+        # (name, type, help, [(labels, value), ...])
+        self.collectors = []
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def observe(self, method, endpoint, status, seconds,
+                statements, db_seconds):
+        key = (method, endpoint)
+        with self.lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.statements[key] = Histogram(STATEMENT_BUCKETS)
+                self.db_seconds[key] = 0.0
+            self.latency[key].observe(seconds)
+            self.statements[key].observe(statements)
+            self.db_seconds[key] += db_seconds
+            status_key = (method, endpoint, str(status))
+            self.responses[status_key] = \
+                self.responses.get(status_key, 0) + 1
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sample_name, labels, value in samples:
+                lines.append('{}{} {}'.format(
+                    sample_name, format_labels(labels), value))
+
+        with self.lock:
+            family('trivia_http_request_duration_seconds', 'histogram',
+                   'Time to answer a request (until the headers)',
+                   [sample for (method, endpoint), histogram
+                    in sorted(self.latency.items())
+                    for sample in histogram.samples(
+                        'trivia_http_request_duration_seconds',
+                        {'method': method, 'endpoint': endpoint})])
+            family('trivia_http_responses_total', 'counter',
+                   'Responses by status',
+                   [('trivia_http_responses_total',
+                     {'method': method, 'endpoint': endpoint,
+                      'status': status}, count)
+                    for (method, endpoint, status), count
+                    in sorted(self.responses.items())])
+            family('trivia_http_requests_in_flight', 'gauge',
+                   'Requests being answered right now',
+                   [('trivia_http_requests_in_flight', {},
+                     self.in_flight)])
+            family('trivia_db_statements_per_request', 'histogram',
+                   'SQL statements run by one request',
+                   [sample for (method, endpoint), histogram
+                    in sorted(self.statements.items())
+                    for sample in histogram.samples(
+                        'trivia_db_statements_per_request',
+                        {'method': method, 'endpoint': endpoint})])
+            family('trivia_db_seconds_total', 'counter',
+                   'Time spent running SQL statements',
+                   [('trivia_db_seconds_total',
+                     {'method': method, 'endpoint': endpoint}, seconds)
+                    for (method, endpoint), seconds
+                    in sorted(self.db_seconds.items())])
+            collectors = list(self.collectors)
+
+        for collector in collectors:
+            for name, kind, help_text, samples in collector():
+                family(name, kind, help_text,
+                       [(name, labels, value)
+                        for labels, value in samples])
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels.items()) + '}'
+
+
+def request_endpoint():
+    # The route template ("/questions/<int:question_id>") and not
+    # the path, so there is one series per route and not per id
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement_start(conn, cursor, statement, parameters,
+                          context, executemany):
+    conn.info.setdefault('metrics_started', []).append(
+        time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_statement_end(conn, cursor, statement, parameters,
+                        context, executemany):
+    started = conn.info['metrics_started'].pop()
+    if has_request_context() and 'metrics_started' in g:
+        g.db_statements += 1
+        g.db_seconds += time.perf_counter() - started
+
+
+@event.listens_for(Engine, 'handle_error')
+def count_statement_error(exception_context):
+    # A failed statement never gets its after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and \
+            connection.info.get('metrics_started'):
+        connection.info['metrics_started'].pop()
+
+
+def cache_collector(app):
+    def collect():
+        cache = app.extensions['response_cache']
+        return [('trivia_cache_requests_total', 'counter',
+                 'Response cache lookups',
+                 [({'result': 'hit'}, cache.hits),
+                  ({'result': 'miss'}, cache.misses)])]
+    return collect
+
+
+def search_cache_collector(app):
+    def collect():
+        stats = app.extensions['search_cache'].stats()
+        return [('trivia_search_cache_requests_total', 'counter',
+                 'Search cache lookups',
+                 [({'result': 'hit'}, stats['hits']),
+                  ({'result': 'miss'}, stats['misses']),
+                  ({'result': 'coalesced'}, stats['coalesced'])]),
+                ('trivia_search_cache_expired_total', 'counter',
+                 'Search cache entries dropped after SEARCH_CACHE_TTL',
+                 [({}, stats['expired'])]),
+                ('trivia_search_cache_entries', 'gauge',
+                 'Pages in the search cache',
+                 [({}, stats['entries'])])]
+    return collect
+
+
+def pool_collector(app):
+    def collect():
+        stats = pool_stats(app)
+        return [('trivia_db_pool_checked_out', 'gauge',
+                 'Connections in use (QueuePool only)',
+                 [({'engine': name}, pool['checkedout'])
+                  for name, pool in sorted(stats.items())
+                  if 'checkedout' in pool])]
+    return collect
+
+
+def quiz_session_collector(app):
+    def collect():
+        sessions = app.extensions.get('quiz_sessions')
+        return [('trivia_quiz_sessions', 'gauge',
+                 'Quiz sessions in memory',
+                 [({}, len(sessions) if sessions is not None else 0)])]
+    return collect
+
+
+def admission_collector(app):
+    def collect():
+        admission = app.extensions.get('admission')
+        if admission is None:
+            return []
+        with admission.lock:
+            rejected = sorted(admission.rejected.items())
+            running = admission.running
+        return [('trivia_admission_rejected_total', 'counter',
+                 'Requests refused by the admission control',
+                 [({'reason': reason, 'endpoint': endpoint}, count)
+                  for (reason, endpoint), count in rejected]),
+                ('trivia_admission_running', 'gauge',
+                 'Expensive requests holding a slot',
+                 [({}, running)])]
+    return collect
+
+
+def init_metrics(app):
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.db_statements = 0
+        g.db_seconds = 0.0
+        metrics.request_started()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_started' in g:
+            metrics.observe(
+                request.method, request_endpoint(),
+                response.status_code,
+                time.perf_counter() - g.metrics_started,
+                g.db_statements, g.db_seconds)
+            g.metrics_recorded = True
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(error):
+        if 'metrics_started' not in g:
+            return
+        # after_request doesn't run when a view raises an error
+        # nobody handled, it is still a (500) response
+        if not g.get('metrics_recorded'):
+            metrics.observe(
+                request.method, request_endpoint(), 500,
+                time.perf_counter() - g.metrics_started,
+                g.db_statements, g.db_seconds)
+        metrics.request_finished()
+
+    metrics.register_collector(cache_collector(app))
+    metrics.register_collector(search_cache_collector(app))
+    metrics.register_collector(pool_collector(app))
+    metrics.register_collector(quiz_session_collector(app))
+    metrics.register_collector(admission_collector(app))
+    return metrics
+
+
+def get_metrics():
+    return current_app.extensions['metrics']
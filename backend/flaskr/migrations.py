@@ -0,0 +1,141 @@
+from datetime import datetime, timezone
+from sqlalchemy import Table, Column, Integer, String, MetaData, \
+    inspect, text
+from .counts import setup_counts, reconcile_counts
+from .quiz_sessions import quiz_sessions
+from .external_writes import external_writes
+
+'''
+Versioned schema migrations
+    every migration is a function that takes a connection, they run
+    in order and the ones already applied are recorded in the
+    schema_migrations table, so "flask migrate" (and "flask init-db")
+    only runs the new ones. A migration has to work on a database
+    that create_all just made with the current models too (it then
+    has nothing or little to do)
+    Plain SQL that works on PostgreSQL and SQLite (3.35+ for
+    DROP COLUMN) like search.py, there is no Alembic here
+    https://www.sqlite.org/lang_altertable.html
+    https://www.postgresql.org/docs/current/sql-altertable.html
+'''
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('applied_at', String, nullable=False))
+
+# (category, id): the category listings (WHERE category = ? ORDER
+# BY id, with LIMIT / OFFSET or id > ?), their COUNT and the scan of
+# the quiz index all read only this index, and it also serves the
+# foreign key lookups when a category is deleted
+CATEGORY_INDEX = 'ix_questions_category_id'
+
+
+def question_columns(connection):
+    return {column['name']: column
+            for column in inspect(connection).get_columns('questions')}
+
+
+def category_integer_fk(connection):
+    # questions.category was a String holding the id of the category
+    # (or, in some old rows, its type), it becomes an INTEGER foreign
+    # key to categories.id with an index on (category, id)
+    category = question_columns(connection)['category']
+    if not isinstance(category['type'], Integer):
+        # A new column (ADD COLUMN can carry the REFERENCES on both
+        # databases), filled from the old one, then swapped in
+        connection.execute(text(
+            "ALTER TABLE questions ADD COLUMN category_id INTEGER "
+            "REFERENCES categories (id) "
+            "ON UPDATE CASCADE ON DELETE SET NULL"))
+        # The categories side is cast to text and not the questions
+        # side, a category that isn't a number can't break the cast
+        connection.execute(text(
+            "UPDATE questions SET category_id = ("
+            "SELECT categories.id FROM categories "
+            "WHERE CAST(categories.id AS VARCHAR) = "
+            "TRIM(questions.category))"))
+        connection.execute(text(
+            "UPDATE questions SET category_id = ("
+            "SELECT min(categories.id) FROM categories "
+            "WHERE categories.type = questions.category) "
+            "WHERE category_id IS NULL"))
+        connection.execute(text(
+            "ALTER TABLE questions DROP COLUMN category"))
+        connection.execute(text(
+            "ALTER TABLE questions RENAME COLUMN category_id TO category"))
+    elif not any(foreign_key['referred_table'] == 'categories'
+                 for foreign_key in inspect(
+                     connection).get_foreign_keys('questions')):
+        # Already an integer (PostgreSQL restored from an old dump),
+        # only the constraint is missing. SQLite can't add one to an
+        # existing column, create_all always made it with the column
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text(
+                "UPDATE questions SET category = NULL "
+                "WHERE category NOT IN (SELECT id FROM categories)"))
+            connection.execute(text(
+                "ALTER TABLE questions ADD CONSTRAINT "
+                "questions_category_fkey FOREIGN KEY (category) "
+                "REFERENCES categories (id) "
+                "ON UPDATE CASCADE ON DELETE SET NULL"))
+
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS {} "
+        "ON questions (category, id)".format(CATEGORY_INDEX)))
+    if connection.dialect.name == 'postgresql':
+        # Fresh statistics for the planner after the rewrite
+        connection.execute(text("ANALYZE questions"))
+
+
+def question_counts(connection):
+    # The question_counts table, its triggers (see counts.py) and
+    # the counts of the questions already there
+    setup_counts(connection)
+    reconcile_counts(connection)
+
+
+def quiz_session_table(connection):
+    # The table of the 'database' quiz session store (see
+    # quiz_sessions.py), with its index on expires
+    quiz_sessions.create(connection, checkfirst=True)
+
+
+def external_write_table(connection):
+    # The serials of the writes the app didn't make (see
+    # external_writes.py)
+    external_writes.create(connection, checkfirst=True)
+
+
+# (version, name, migration), append only
+MIGRATIONS = [
+    (1, 'category_integer_fk', category_integer_fk),
+    (2, 'question_counts', question_counts),
+    (3, 'quiz_sessions', quiz_session_table),
+    (4, 'external_writes', external_write_table),
+]
+
+
+def applied_versions(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return {row[0] for row in connection.execute(
+        schema_migrations.select())}
+
+
+def migrate(engine):
+    # Runs the migrations that aren't applied yet, one transaction
+    # each, returns the (version, name) that ran
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+    ran = []
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, name=name,
+                applied_at=datetime.now(timezone.utc).isoformat()))
+        ran.append((version, name))
+    return ran
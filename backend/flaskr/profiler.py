@@ -0,0 +1,227 @@
+import json
+import re
+import time
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+'''
+QueryProfiler (development only, QUERY_PROFILER in config.py)
+    records every SQL statement of a request with its time and its
+    plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN (FORMAT JSON) on
+    PostgreSQL), then reports at the end of the request:
+    - unbounded loads: a SELECT without LIMIT that loads more than
+      QUERY_PROFILER_ROW_THRESHOLD rows (the planner's estimate on
+      PostgreSQL, SQLite has none and its rows are counted)
+    - repeated statements: the same SQL run QUERY_PROFILER_REPEAT
+      times or more in one request (the N+1 pattern)
+    - sequential scans: the plan reads a whole table
+    The report goes to the log, and to the X-Query-Profile header
+    when QUERY_PROFILER_HEADER is True
+    https://www.sqlite.org/eqp.html
+    https://www.postgresql.org/docs/current/using-explain.html
+'''
+
+LIMIT = re.compile(r'\bLIMIT\b', re.IGNORECASE)
+# "SCAN questions" is a full table scan, "SCAN questions USING
+# INDEX ..." or "SEARCH ..." use an index
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+
+
+def explain(connection, statement, parameters):
+    # Runs EXPLAIN on the raw DBAPI cursor (it doesn't go through
+    # SQLAlchemy, so it isn't recorded itself), returns
+    # (list of scanned tables, estimated rows or None)
+    # SQLite doesn't estimate, a statement without LIMIT runs again
+    # as a count(*): the reads of the views are mostly tuples now,
+    # not ORM objects, their rows_loaded can't tell
+    # It runs on the request's own connection: on PostgreSQL a failed
+    # statement aborts the transaction, and the next statement of the
+    # request would fail too, so EXPLAIN runs in a savepoint that is
+    # rolled back when it fails (in autocommit there is nothing to
+    # abort). A failure is logged at debug level
+    dialect = connection.dialect.name
+    dbapi_connection = connection.connection
+    cursor = dbapi_connection.cursor()
+    # True while the savepoint is open
+    savepoint = False
+    try:
+        if dialect == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement,
+                           parameters)
+            scans = []
+            for row in cursor.fetchall():
+                match = SQLITE_FULL_SCAN.match(row[-1])
+                if match:
+                    scans.append(match.group(1))
+            rows = None
+            if not LIMIT.search(statement):
+                cursor.execute('SELECT count(*) FROM (' + statement +
+                               ')', parameters)
+                rows = cursor.fetchone()[0]
+            return scans, rows
+        if dialect == 'postgresql':
+            if not getattr(dbapi_connection, 'autocommit', False):
+                cursor.execute('SAVEPOINT query_profiler')
+                savepoint = True
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement,
+                           parameters)
+            plan = cursor.fetchone()[0]
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT query_profiler')
+                savepoint = False
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            plan = plan[0]['Plan']
+            return postgres_seq_scans(plan), plan.get('Plan Rows')
+    except Exception:
+        current_app.logger.debug('EXPLAIN failed: %s', statement,
+                                 exc_info=True)
+        if savepoint:
+            cursor.execute('ROLLBACK TO SAVEPOINT query_profiler')
+            cursor.execute('RELEASE SAVEPOINT query_profiler')
+    finally:
+        cursor.close()
+    return [], None
+
+
+def postgres_seq_scans(plan):
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        scans.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        scans.extend(postgres_seq_scans(child))
+    return scans
+
+
+class QueryProfiler:
+
+    def __init__(self, app):
+        self.app = app
+        self.row_threshold = app.config['QUERY_PROFILER_ROW_THRESHOLD']
+        self.repeat_threshold = app.config['QUERY_PROFILER_REPEAT']
+        self.header = app.config['QUERY_PROFILER_HEADER']
+
+    def start(self):
+        g.query_profile = []
+        g.query_profile_loaded = 0
+
+    def record(self, connection, statement, parameters, executemany,
+               seconds):
+        entry = {'statement': statement,
+                 'ms': round(seconds * 1000, 3),
+                 'scans': [], 'estimated_rows': None,
+                 'rows_loaded': 0}
+        if not executemany and \
+                statement.lstrip().upper().startswith('SELECT'):
+            entry['scans'], entry['estimated_rows'] = explain(
+                connection, statement, parameters)
+        g.query_profile.append(entry)
+
+    def report(self):
+        statements = g.query_profile
+        counts = {}
+        for entry in statements:
+            counts[entry['statement']] = \
+                counts.get(entry['statement'], 0) + 1
+
+        repeated = [{'statement': statement, 'times': times}
+                    for statement, times in counts.items()
+                    if times >= self.repeat_threshold]
+        seq_scans = sorted({table for entry in statements
+                            for table in entry['scans']})
+        # Without a LIMIT, a load is "unbounded" when the planner
+        # expects (SQLite: counted) a lot of rows, or when it
+        # hydrated a lot of ORM objects
+        unbounded = [
+            entry['statement'] for entry in statements
+            if entry['statement'].lstrip().upper().startswith('SELECT')
+            and not LIMIT.search(entry['statement'])
+            and max(entry['estimated_rows'] or 0, entry['rows_loaded'])
+            > self.row_threshold]
+
+        return {
+            'endpoint': request.endpoint,
+            'statements': len(statements),
+            'db_ms': round(sum(entry['ms'] for entry in statements), 3),
+            'orm_rows_loaded': g.query_profile_loaded,
+            'repeated': repeated,
+            'seq_scans': seq_scans,
+            'unbounded': unbounded,
+        }
+
+
+def init_profiler(app):
+    profiler = QueryProfiler(app)
+    app.extensions['query_profiler'] = profiler
+
+    @app.before_request
+    def start_query_profile():
+        profiler.start()
+
+    @app.after_request
+    def report_query_profile(response):
+        if current_profiler() is None:
+            return response
+        report = profiler.report()
+        flagged = report['repeated'] or report['seq_scans'] or \
+            report['unbounded']
+        log = app.logger.warning if flagged else app.logger.info
+        log('query profile %s %s: %s', request.method, request.path,
+            json.dumps(report))
+        if profiler.header:
+            response.headers['X-Query-Profile'] = json.dumps({
+                'statements': report['statements'],
+                'db_ms': report['db_ms'],
+                'orm_rows_loaded': report['orm_rows_loaded'],
+                'repeated': len(report['repeated']),
+                'seq_scans': report['seq_scans'],
+                'unbounded': len(report['unbounded'])})
+        return response
+
+    return profiler
+
+
+def current_profiler():
+    # The profiler of the app answering the current request, when
+    # it has one and the request is being profiled
+    if has_request_context() and 'query_profile' in g:
+        return current_app.extensions.get('query_profiler')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def profile_statement_start(conn, cursor, statement, parameters,
+                            context, executemany):
+    if current_profiler() is not None:
+        conn.info.setdefault('profile_started', []).append(
+            time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def profile_statement_end(conn, cursor, statement, parameters,
+                          context, executemany):
+    profiler = current_profiler()
+    if profiler is not None and conn.info.get('profile_started'):
+        seconds = time.perf_counter() - \
+            conn.info['profile_started'].pop()
+        profiler.record(conn, statement, parameters, executemany,
+                        seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def profile_statement_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and \
+            connection.info.get('profile_started'):
+        connection.info['profile_started'].pop()
+
+
+@event.listens_for(Mapper, 'load')
+def count_loaded_row(target, context):
+    # The objects are built from the rows of the last statement
+    if current_profiler() is not None:
+        g.query_profile_loaded += 1
+        if g.query_profile:
+            g.query_profile[-1]['rows_loaded'] += 1
@@ -0,0 +1,270 @@
+import random
+import threading
+from flask import current_app, has_app_context
+from models import db, Question, QUESTION_COLUMNS, question_hooks, \
+    get_data_version, changes_since, last_changes
+
+'''
+QuizIndex
+    keeps the ids of the questions grouped by category in memory
+    so POST /quizzes can pick a random question without scanning
+    the questions table, only the chosen row is loaded from the db
+    It knows the data version it is current for: the writes it
+    didn't see (another worker process, see models.share_data_version)
+    are read from the change log (models.changes_since), it is built
+    again only when the log can't tell (bulk writes, category deletes)
+'''
+
+# quiz_category id 0 means "All" in the frontend
+ALL_CATEGORIES = 0
+
+
+def category_key(category):
+    # The frontend sends the ids as numbers or as strings, so
+    # we use one key type
+    return str(category)
+
+
+def index_key(quiz_category):
+    return ALL_CATEGORIES if quiz_category == ALL_CATEGORIES \
+        else category_key(quiz_category)
+
+
+class QuizIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        self.version = None
+        # category key -> list of ids, and id -> position in that
+        # list, the position lets us remove an id in O(1) by
+        # swapping it with the last one
+        # https://docs.python.org/3/library/random.html#random.choice
+        self.ids = {}
+        self.positions = {}
+
+    def build(self):
+        # One scan of (id, category) at the first quiz request,
+        # after that the index is kept current by the hooks
+        version = get_data_version()
+        self.load(db.session.query(Question.id, Question.category).all(),
+                  version)
+
+    def load(self, rows, version):
+        # rows are (id, category) pairs read at data version version
+        # (read before the query), the async app (asgi.py) queries
+        # them itself and hands them over
+        with self.lock:
+            self.ids = {}
+            self.positions = {}
+            for question_id, category in rows:
+                self._add(question_id, category)
+            self.built = True
+            self.version = version
+
+    def current(self):
+        return self.built and self.version == get_data_version()
+
+    def ensure_built(self):
+        if not self.current() and not (self.built and self.catch_up()):
+            self.build()
+
+    def catch_up(self):
+        # Applies the changes logged since self.version, False when
+        # the log can't tell and it has to be built again
+        with self.lock:
+            version, changes = changes_since(self.version)
+            if changes is None:
+                return False
+            for question_id, (action, category) in \
+                    last_changes(changes).items():
+                self._forget(question_id)
+                if action != 'delete':
+                    self._add(question_id, category)
+            self.version = version
+            return True
+
+    def _synced(self):
+        # After add / remove for the write that just bumped the data
+        # version: the index follows it only if it was current right
+        # before, a write in between that it missed leaves it stale
+        version = get_data_version()
+        if self.version == version - 1:
+            self.version = version
+
+    def _add(self, question_id, category):
+        for key in (ALL_CATEGORIES, category_key(category)):
+            positions = self.positions.setdefault(key, {})
+            if question_id in positions:
+                continue
+            ids = self.ids.setdefault(key, [])
+            positions[question_id] = len(ids)
+            ids.append(question_id)
+
+    def _remove(self, question_id, category):
+        for key in (ALL_CATEGORIES, category_key(category)):
+            if question_id in self.positions.get(key, {}):
+                self._remove_from(key, question_id)
+
+    def _remove_from(self, key, question_id):
+        positions = self.positions[key]
+        position = positions.pop(question_id)
+        ids = self.ids[key]
+        last = ids.pop()
+        if last != question_id:
+            ids[position] = last
+            positions[last] = position
+
+    def add(self, question_id, category):
+        with self.lock:
+            self._add(question_id, category)
+            self._synced()
+
+    def remove(self, question_id, category):
+        with self.lock:
+            self._remove(question_id, category)
+            self._synced()
+
+    def unchanged(self):
+        # A write that changed no category, only the version
+        with self.lock:
+            self._synced()
+
+    def move(self, question_id, category):
+        # The question is now in category (the old one isn't known,
+        # every category but "All" is looked at)
+        with self.lock:
+            for key in list(self.positions):
+                if key != ALL_CATEGORIES and \
+                        question_id in self.positions[key]:
+                    self._remove_from(key, question_id)
+            self._add(question_id, category)
+            self._synced()
+
+    def draw_ids(self, quiz_category, previous_questions, count):
+        # Up to count distinct random ids of the category that aren't
+        # in previous_questions, fewer (or none) when there aren't
+        # that many left. The client may send the ids as strings
+        # ("20"), a malformed one raises ValueError / TypeError (422)
+        key = index_key(quiz_category)
+        previous = {int(question_id) for question_id in previous_questions}
+
+        with self.lock:
+            ids = self.ids.get(key, [])
+            if not ids:
+                return []
+
+            # Most of the time the previous questions and the ones we
+            # draw are a small part of the category, so a few random
+            # picks find new ones (O(count) expected)
+            if (len(previous) + count) * 2 < len(ids):
+                drawn = []
+                while len(drawn) < count:
+                    question_id = random.choice(ids)
+                    if question_id not in previous:
+                        previous.add(question_id)
+                        drawn.append(question_id)
+                return drawn
+
+            # Near the end of the quiz picking at random would miss
+            # a lot, so we look at what is left instead
+            remaining = [question_id for question_id in ids
+                         if question_id not in previous]
+            return random.sample(remaining, min(count, len(remaining)))
+
+    def draw_id(self, quiz_category, previous_questions):
+        # Returns a random id of the category that isn't in
+        # previous_questions, or None when there is nothing left
+        drawn = self.draw_ids(quiz_category, previous_questions, 1)
+        return drawn[0] if drawn else None
+
+    def sample(self, quiz_category, size):
+        # Up to size random ids of the category, in a random order
+        # (a quiz session deck), O(size) and not O(category)
+        self.ensure_built()
+        with self.lock:
+            ids = self.ids.get(index_key(quiz_category), [])
+            return random.sample(ids, min(size, len(ids)))
+
+    def draw(self, quiz_category, previous_questions):
+        # Picks an id and loads just that row (a QUESTION_COLUMNS
+        # tuple, see models.format_question_row), if the row was
+        # deleted behind our back we forget it and try again
+        self.ensure_built()
+        while True:
+            question_id = self.draw_id(
+                quiz_category, previous_questions)
+            if question_id is None:
+                return None
+            question = db.session.query(*QUESTION_COLUMNS).filter(
+                Question.id == question_id).first()
+            if question is not None:
+                return question
+            self.forget(question_id)
+
+    def draw_many(self, quiz_category, previous_questions, count):
+        # Up to count distinct questions (QUESTION_COLUMNS tuples) in
+        # one IN query for the whole batch, in the order they were
+        # drawn. The ids deleted behind our back are forgotten and
+        # replaced by new draws
+        self.ensure_built()
+        excluded = list(previous_questions)
+        questions = []
+        while len(questions) < count:
+            drawn = self.draw_ids(
+                quiz_category, excluded, count - len(questions))
+            if not drawn:
+                break
+            rows = {row.id: row for row in db.session.query(
+                *QUESTION_COLUMNS).filter(Question.id.in_(drawn))}
+            for question_id in drawn:
+                if question_id in rows:
+                    questions.append(rows[question_id])
+                else:
+                    self.forget(question_id)
+            excluded.extend(drawn)
+        return questions
+
+    def forget(self, question_id):
+        # Removes an id from every category, when we don't know
+        # its category any more (the row is gone)
+        with self.lock:
+            self._forget(question_id)
+
+    def _forget(self, question_id):
+        for key in list(self.positions):
+            if question_id in self.positions[key]:
+                self._remove_from(key, question_id)
+
+
+def init_quiz_index(app):
+    app.extensions['quiz_index'] = QuizIndex()
+    return app.extensions['quiz_index']
+
+
+def get_quiz_index():
+    return current_app.extensions['quiz_index']
+
+
+def update_quiz_index(action, question_id, category):
+    # Registered in models.question_hooks, it runs right after a
+    # question is inserted, deleted or moved to another category
+    if not has_app_context():
+        return
+    index = current_app.extensions.get('quiz_index')
+    if index is None or not index.built:
+        return
+    if action == 'insert':
+        index.add(question_id, category)
+    elif action == 'delete':
+        index.remove(question_id, category)
+    elif action == 'update':
+        index.move(question_id, category)
+    elif action == 'unchanged':
+        index.unchanged()
+    elif action == 'reload':
+        # Built again on the next quiz request
+        index.built = False
+
+
+question_hooks.append(update_quiz_index)
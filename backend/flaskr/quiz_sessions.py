@@ -0,0 +1,218 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import Table, Column, Integer, String, Text, Float, \
+    Index, MetaData, func, select
+from models import db, Question, QUESTION_COLUMNS
+
+'''
+Quiz sessions
+    POST /quizzes/sessions snapshots a shuffled deck of question
+    ids of the category (taken from the quiz index, no query), then
+    every POST /quizzes/sessions/<id>/next pops the next id of the
+    deck: O(1), and the client doesn't send previous_questions
+    Where the sessions live is QUIZ_SESSION_BACKEND:
+    - 'memory' (QuizSessionStore), in this process: only for a
+      single process, another worker doesn't know the session
+      (gunicorn.conf.py refuses to start several workers with it)
+    - 'database' (DatabaseQuizSessionStore), the quiz_sessions table
+      of the primary (migration 3), any worker serves any session
+    - a session nobody used for QUIZ_SESSION_TTL seconds is dropped
+    - in memory, at most QUIZ_SESSION_MAX sessions, the least
+      recently used one goes first, and a deck has at most
+      QUIZ_SESSION_DECK_SIZE ids, so the memory has a fixed upper
+      bound
+    https://docs.python.org/3/library/secrets.html
+'''
+
+
+class QuizSession:
+
+    def __init__(self, quiz_category, deck, expires):
+        self.quiz_category = quiz_category
+        # Popped from the end
+        self.deck = deck
+        self.expires = expires
+
+
+class QuizSessionStore:
+
+    def __init__(self, max_sessions, ttl, deck_size):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.deck_size = deck_size
+        self.lock = threading.Lock()
+        # session id -> QuizSession, least recently used first
+        self.sessions = OrderedDict()
+
+    def _expire(self, now):
+        # The least recently used sessions are the first to expire
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.expires > now:
+                break
+            del self.sessions[session_id]
+
+    def start(self, quiz_category, deck):
+        # deck is a shuffled list of at most deck_size question ids
+        # (QuizIndex.sample)
+        session_id = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            self.sessions[session_id] = QuizSession(
+                quiz_category, deck, now + self.ttl)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id, len(deck)
+
+    def get(self, session_id):
+        # The session (its TTL starts again), None if it expired
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.expires = now + self.ttl
+                self.sessions.move_to_end(session_id)
+            return session
+
+    def pop(self, session_id):
+        # (next question id or None when the deck is empty,
+        # questions left), KeyError if there is no such session
+        with self.lock:
+            session = self.sessions[session_id]
+            question_id = session.deck.pop() if session.deck else None
+            return question_id, len(session.deck)
+
+    def end(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+quiz_sessions = Table(
+    'quiz_sessions', MetaData(),
+    Column('id', String, primary_key=True),
+    Column('quiz_category', Integer, nullable=False),
+    # The question ids, comma separated, in the order they are served
+    Column('deck', Text, nullable=False),
+    # How many of them were served
+    Column('position', Integer, nullable=False),
+    # time.time() when it expires, the clock every worker shares
+    Column('expires', Float, nullable=False),
+    Index('ix_quiz_sessions_expires', 'expires'))
+
+
+def deck_ids(deck):
+    return [int(question_id) for question_id in deck.split(',')] \
+        if deck else []
+
+
+class DatabaseQuizSessionStore:
+    # QuizSessionStore in the quiz_sessions table, on the primary
+    # (db.engine) even in the read only endpoints. Every call is one
+    # short transaction, pop is a single UPDATE of the position so two
+    # workers serving the same session never get the same question.
+    # The expired rows are deleted by start, the TTL is the bound
+    # here (QUIZ_SESSION_MAX is for the memory store)
+
+    def __init__(self, ttl, deck_size):
+        self.ttl = ttl
+        self.deck_size = deck_size
+
+    def start(self, quiz_category, deck):
+        session_id = secrets.token_urlsafe(16)
+        now = time.time()
+        with db.engine.begin() as connection:
+            connection.execute(quiz_sessions.delete().where(
+                quiz_sessions.c.expires <= now))
+            connection.execute(quiz_sessions.insert().values(
+                id=session_id, quiz_category=quiz_category,
+                deck=','.join(str(question_id) for question_id in deck),
+                position=0, expires=now + self.ttl))
+        return session_id, len(deck)
+
+    def get(self, session_id):
+        now = time.time()
+        selected = (quiz_sessions.c.id == session_id) & \
+            (quiz_sessions.c.expires > now)
+        with db.engine.begin() as connection:
+            row = connection.execute(select(
+                quiz_sessions.c.quiz_category, quiz_sessions.c.deck,
+                quiz_sessions.c.position).where(selected)).first()
+            if row is None:
+                return None
+            connection.execute(quiz_sessions.update().where(
+                selected).values(expires=now + self.ttl))
+        quiz_category, deck, position = row
+        return QuizSession(quiz_category, deck_ids(deck)[position:],
+                           now + self.ttl)
+
+    def pop(self, session_id):
+        now = time.time()
+        with db.engine.begin() as connection:
+            # The UPDATE locks the row until the commit
+            updated = connection.execute(quiz_sessions.update().where(
+                (quiz_sessions.c.id == session_id) &
+                (quiz_sessions.c.expires > now)).values(
+                    position=quiz_sessions.c.position + 1,
+                    expires=now + self.ttl))
+            if not updated.rowcount:
+                raise KeyError(session_id)
+            deck, position = connection.execute(select(
+                quiz_sessions.c.deck, quiz_sessions.c.position).where(
+                    quiz_sessions.c.id == session_id)).first()
+        deck = deck_ids(deck)
+        if position > len(deck):
+            return None, 0
+        return deck[position - 1], len(deck) - position
+
+    def end(self, session_id):
+        with db.engine.begin() as connection:
+            return connection.execute(quiz_sessions.delete().where(
+                quiz_sessions.c.id == session_id)).rowcount > 0
+
+    def __len__(self):
+        with db.engine.connect() as connection:
+            return connection.execute(select(func.count()).where(
+                quiz_sessions.c.expires > time.time())).scalar()
+
+
+# name -> factory(app) returning a store, like the rate limit
+# backends of admission.py
+quiz_session_backends = {
+    'memory': lambda app: QuizSessionStore(
+        app.config['QUIZ_SESSION_MAX'], app.config['QUIZ_SESSION_TTL'],
+        app.config['QUIZ_SESSION_DECK_SIZE']),
+    'database': lambda app: DatabaseQuizSessionStore(
+        app.config['QUIZ_SESSION_TTL'],
+        app.config['QUIZ_SESSION_DECK_SIZE']),
+}
+
+
+def next_question(store, session_id):
+    # The next question of the deck (a QUESTION_COLUMNS row) and how
+    # many are left, the ids deleted since the start are skipped
+    while True:
+        question_id, left = store.pop(session_id)
+        if question_id is None:
+            return None, left
+        question = db.session.query(*QUESTION_COLUMNS).filter(
+            Question.id == question_id).first()
+        if question is not None:
+            return question, left
+
+
+def init_quiz_sessions(app):
+    app.extensions['quiz_sessions'] = quiz_session_backends[
+        app.config['QUIZ_SESSION_BACKEND']](app)
+    return app.extensions['quiz_sessions']
+
+
+def get_quiz_sessions():
+    return current_app.extensions['quiz_sessions']
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import g, current_app
+from models import get_data_version, get_data_modified
+
+'''
+read_only
+    decorator for the endpoints that only read, their queries are
+    sent to the read replica when one is configured (see
+    RoutingSession in models.py)
+    A replica can be a little behind the primary. What a read
+    returns is cached and gets an ETag for the current data version
+    (cache.py, conditional.py), so a read that missed the last write
+    would be served as current until the next write. For
+    DATABASE_REPLICA_LAG seconds after a write the reads go to the
+    primary instead, set it above the usual lag of the replica
+'''
+
+
+def replica_behind():
+    # The data version and its time are shared by the workers (see
+    # models.share_data_version), a write in any of them counts.
+    # Version 0: nothing was written since the start
+    if not get_data_version():
+        return False
+    lag = timedelta(seconds=current_app.config['DATABASE_REPLICA_LAG'])
+    return datetime.now(timezone.utc) - get_data_modified() < lag
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = not replica_behind()
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,183 @@
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import signal
+import tempfile
+import threading
+from flask import g, request, current_app
+
+'''
+Sampling profiler (production, PROFILE_* in config.py)
+    runs cProfile on a fraction of the requests (PROFILE_SAMPLE_RATE),
+    and on every request sent with the PROFILE_TOKEN in the
+    PROFILE_HEADER header. The stats are added up per endpoint in
+    memory and can be read:
+    - at GET /admin/profiles (same header), DELETE clears them
+    - as .prof files in PROFILE_DUMP_DIR when the process gets
+      PROFILE_SIGNAL (kill -URG <pid>), to open with pstats or
+      snakeviz. The handler only wakes up a dump thread: dump()
+      takes the lock the interrupted code may be holding
+    Gunicorn resets the signals it uses itself in its workers
+    (GUNICORN_SIGNALS), one of them would kill the worker
+    When nothing is configured, init_sampling adds no hook at all, so
+    the requests don't pay anything
+    https://docs.python.org/3/library/profile.html
+'''
+
+# What GET /admin/profiles can sort the functions by
+SORT_KEYS = {'cumulative': 3, 'tottime': 2, 'calls': 1}
+
+# Back to their default action in every gunicorn worker
+# https://docs.gunicorn.org/en/stable/signals.html
+GUNICORN_SIGNALS = ('SIGHUP', 'SIGQUIT', 'SIGINT', 'SIGTERM', 'SIGTTIN',
+                    'SIGTTOU', 'SIGUSR1', 'SIGUSR2', 'SIGWINCH')
+
+
+class SamplingProfiler:
+
+    def __init__(self, app):
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.header = app.config['PROFILE_HEADER']
+        self.token = app.config['PROFILE_TOKEN']
+        self.dump_dir = app.config['PROFILE_DUMP_DIR'] or \
+            tempfile.gettempdir()
+        # {endpoint: pstats.Stats}, {endpoint: profiled requests}
+        self.stats = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.logger = app.logger
+        # Set by the PROFILE_SIGNAL handler, see watch_signal
+        self.dump_wanted = None
+        # cProfile can't profile two requests at the same time (one
+        # profiler per process since Python 3.12), a request that
+        # comes while another one is profiled isn't
+        self.running = threading.Lock()
+
+    def authorized(self):
+        sent = request.headers.get(self.header)
+        return bool(self.token and sent) and \
+            hmac.compare_digest(sent, self.token)
+
+    def wanted(self):
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        return self.header in request.headers and self.authorized()
+
+    def start(self):
+        if not self.wanted() or not self.running.acquire(blocking=False):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, coverage) is active
+            self.running.release()
+            return
+        g.sampling_profile = profile
+
+    def stop(self):
+        profile = g.pop('sampling_profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self.running.release()
+        endpoint = request.endpoint or 'unmatched'
+        with self.lock:
+            if endpoint in self.stats:
+                self.stats[endpoint].add(profile)
+            else:
+                self.stats[endpoint] = pstats.Stats(profile)
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def summary(self, sort='cumulative', limit=20):
+        column = SORT_KEYS[sort]
+        profiles = {}
+        with self.lock:
+            for endpoint, stats in self.stats.items():
+                rows = sorted(stats.stats.items(),
+                              key=lambda item: item[1][column],
+                              reverse=True)[:limit]
+                profiles[endpoint] = {
+                    'requests': self.requests[endpoint],
+                    'total_seconds': round(stats.total_tt, 6),
+                    'functions': [{
+                        'function': pstats.func_std_string(function),
+                        'calls': calls,
+                        'tottime': round(tottime, 6),
+                        'cumtime': round(cumtime, 6)
+                    } for function, (primitive, calls, tottime, cumtime,
+                                     callers) in rows]
+                }
+        return profiles
+
+    def dump(self):
+        # One <endpoint>.prof file per endpoint, returns their paths
+        os.makedirs(self.dump_dir, exist_ok=True)
+        paths = []
+        with self.lock:
+            for endpoint, stats in self.stats.items():
+                path = os.path.join(self.dump_dir, 'trivia-{}-{}.prof'.format(
+                    os.getpid(), endpoint))
+                stats.dump_stats(path)
+                paths.append(path)
+        return paths
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.requests = {}
+
+    def watch_signal(self):
+        # The thread that dumps when the signal handler sets
+        # dump_wanted. Threads don't survive a fork, every (gunicorn)
+        # worker starts its own
+        self.dump_wanted = threading.Event()
+        threading.Thread(target=self.dump_when_wanted,
+                         daemon=True).start()
+
+    def dump_when_wanted(self):
+        while True:
+            self.dump_wanted.wait()
+            self.dump_wanted.clear()
+            try:
+                self.dump()
+            except Exception:
+                self.logger.exception('dumping the profiles failed')
+
+
+def init_sampling(app):
+    profiler = SamplingProfiler(app)
+    app.extensions['sampling_profiler'] = profiler
+
+    if profiler.sample_rate or profiler.token:
+        @app.before_request
+        def start_sampling_profile():
+            profiler.start()
+
+        # teardown_request runs even when the view raised an error
+        @app.teardown_request
+        def stop_sampling_profile(error):
+            profiler.stop()
+
+    name = app.config['PROFILE_SIGNAL']
+    if name in GUNICORN_SIGNALS:
+        app.logger.warning('PROFILE_SIGNAL %s is reset by gunicorn in '
+                           'its workers, use SIGURG for example', name)
+    if name and hasattr(signal, name):
+        try:
+            signal.signal(getattr(signal, name),
+                          lambda signum, frame: profiler.dump_wanted.set())
+        except ValueError:
+            # Signals can only be handled in the main thread
+            app.logger.warning('can not handle %s outside of the main '
+                               'thread', name)
+        else:
+            profiler.watch_signal()
+            os.register_at_fork(after_in_child=profiler.watch_signal)
+    return profiler
+
+
+def get_sampling_profiler():
+    return current_app.extensions['sampling_profiler']
@@ -0,0 +1,167 @@
+import re
+from sqlalchemy import text, or_
+from models import db, Question, QUESTION_COLUMNS
+
+'''
+Full text search
+    PostgreSQL: a tsvector column (search_vector) kept up to date
+    by a trigger and indexed with GIN
+    https://www.postgresql.org/docs/current/textsearch-tables.html
+    SQLite: an FTS5 virtual table (questions_fts) kept up to date
+    by triggers, so the same feature can be tested locally
+    https://www.sqlite.org/fts5.html
+    Both match the question and the answer and rank the results,
+    any other database falls back to LIKE
+    Both match the same way: every word of the search is a prefix
+    of a word of the question or the answer ("astro" finds
+    "astronomy"), see sqlite_match_query / pg_match_query. On
+    PostgreSQL the prefixes are stemmed like the words of the
+    search_vector, and the stop words ("the", "of") are left out
+'''
+
+PG_SETUP = [
+    "ALTER TABLE questions ADD COLUMN search_vector tsvector",
+    "UPDATE questions SET search_vector = to_tsvector("
+    "'pg_catalog.english', coalesce(question, '') || ' ' || "
+    "coalesce(answer, ''))",
+    "CREATE INDEX questions_search_idx ON questions "
+    "USING GIN (search_vector)",
+    # tsvector_update_trigger is built in, it recomputes the column
+    # on every insert / update of the row
+    "CREATE TRIGGER questions_search_update BEFORE INSERT OR UPDATE "
+    "ON questions FOR EACH ROW EXECUTE PROCEDURE "
+    "tsvector_update_trigger(search_vector, 'pg_catalog.english', "
+    "question, answer)",
+]
+
+PG_SEARCH = """
+    SELECT id FROM questions,
+        to_tsquery('pg_catalog.english', :term) query
+    WHERE search_vector @@ query
+    ORDER BY ts_rank(search_vector, query) DESC, id
+    LIMIT :limit OFFSET :offset
+"""
+
+PG_COUNT = """
+    SELECT count(*) FROM questions
+    WHERE search_vector @@ to_tsquery('pg_catalog.english', :term)
+"""
+
+# content='questions' makes it an "external content" table: the
+# text stays in questions, FTS5 only stores the index
+SQLITE_SETUP = [
+    "CREATE VIRTUAL TABLE questions_fts USING fts5("
+    "question, answer, content='questions', content_rowid='id')",
+    "CREATE TRIGGER questions_fts_insert AFTER INSERT ON questions BEGIN "
+    "INSERT INTO questions_fts(rowid, question, answer) "
+    "VALUES (new.id, new.question, new.answer); END",
+    "CREATE TRIGGER questions_fts_delete AFTER DELETE ON questions BEGIN "
+    "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+    "VALUES ('delete', old.id, old.question, old.answer); END",
+    "CREATE TRIGGER questions_fts_update AFTER UPDATE ON questions BEGIN "
+    "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+    "VALUES ('delete', old.id, old.question, old.answer); "
+    "INSERT INTO questions_fts(rowid, question, answer) "
+    "VALUES (new.id, new.question, new.answer); END",
+    # Indexing the rows that were there before the table existed
+    "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')",
+]
+
+# bm25() is smaller for better matches, so ascending order
+SQLITE_SEARCH = """
+    SELECT rowid FROM questions_fts WHERE questions_fts MATCH :term
+    ORDER BY bm25(questions_fts), rowid
+    LIMIT :limit OFFSET :offset
+"""
+
+SQLITE_COUNT = """
+    SELECT count(*) FROM questions_fts WHERE questions_fts MATCH :term
+"""
+
+
+def setup_search(engine):
+    # Creates the search column / table the first time, it does
+    # nothing if they are already there
+    dialect = engine.dialect.name
+    with engine.begin() as connection:
+        if dialect == 'postgresql':
+            exists = connection.execute(text(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'questions' "
+                "AND column_name = 'search_vector'")).first()
+            statements = PG_SETUP
+        elif dialect == 'sqlite':
+            exists = connection.execute(text(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE name = 'questions_fts'")).first()
+            statements = SQLITE_SETUP
+        else:
+            return
+        if not exists:
+            for statement in statements:
+                connection.execute(text(statement))
+
+
+def search_words(search_term):
+    return re.findall(r'\w+', search_term)
+
+
+def sqlite_match_query(search_term):
+    # User input can't go straight into MATCH (quotes, AND, NEAR,
+    # ... are FTS5 syntax), so every word becomes a quoted prefix
+    # search: astro -> "astro"*
+    return ' '.join('"{}"*'.format(word)
+                    for word in search_words(search_term))
+
+
+def pg_match_query(search_term):
+    # The same for to_tsquery (whose syntax is & | ! <-> ...): the
+    # words become prefix terms that all have to match,
+    # mona lisa -> mona:* & lisa:*
+    return ' & '.join('{}:*'.format(word)
+                      for word in search_words(search_term))
+
+
+def search_question_ids(search_term, limit, offset):
+    # Returns (ids of the current page in ranking order, total)
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        term = pg_match_query(search_term)
+        search, count = PG_SEARCH, PG_COUNT
+    elif dialect == 'sqlite':
+        term = sqlite_match_query(search_term)
+        search, count = SQLITE_SEARCH, SQLITE_COUNT
+    else:
+        return like_search_ids(search_term, limit, offset)
+    if not term:
+        return [], 0
+
+    ids = [row[0] for row in db.session.execute(
+        text(search),
+        {'term': term, 'limit': limit, 'offset': offset})]
+    total = db.session.execute(text(count), {'term': term}).scalar()
+    return ids, total
+
+
+def like_search_ids(search_term, limit, offset):
+    # Fallback for the databases without full text search
+    pattern = '%{}%'.format(search_term)
+    query = db.session.query(Question.id).filter(or_(
+        Question.question.ilike(pattern),
+        Question.answer.ilike(pattern)))
+    ids = [row[0] for row in query.order_by(
+        Question.id).limit(limit).offset(offset)]
+    return ids, query.count()
+
+
+def search_questions_page(search_term, limit, offset):
+    # Loads the rows (QUESTION_COLUMNS) of the page and keeps the
+    # ranking order
+    ids, total = search_question_ids(search_term, limit, offset)
+    if not ids:
+        return [], total
+    questions = {question.id: question for question in
+                 db.session.query(*QUESTION_COLUMNS).filter(
+                     Question.id.in_(ids))}
+    return [questions[question_id] for question_id in ids
+            if question_id in questions], total
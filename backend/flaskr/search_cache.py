@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from models import get_data_version
+
+'''
+SearchCache (SEARCH_CACHE_* in config.py)
+    the search box sends the same few terms over and over, so the
+    pages of POST /questions/search are kept in an LRU cache keyed
+    on (normalized term, page, per_page):
+    - "Astronaut ", "astronaut" and "ASTRONAUT" are the same search
+      (normalize_search_term), the query runs with the normalized
+      term so they also get the same results
+    - like ResponseCache, the whole cache is dropped as soon as a
+      write bumps the data version. An entry also expires after
+      SEARCH_CACHE_TTL seconds, for the writes the version doesn't
+      see (plain SQL, another host)
+    - single flight: while a search runs, the requests for the same
+      key wait for its result instead of running it again
+    - hits, misses (searches that ran), coalesced (requests that
+      waited for one) and expired entries are counted, see
+      GET /stats/search-cache and GET /metrics
+    join / finish don't care what a flight is, search() uses a
+    threading.Event, the ASGI app (asgi.py) an asyncio Future
+    https://pkg.go.dev/golang.org/x/sync/singleflight
+'''
+
+
+def normalize_search_term(search_term):
+    # Whitespace collapsed and lower case. Not casefold(): it turns
+    # "ß" into "ss", which the full text search doesn't match
+    return ' '.join(search_term.split()).lower()
+
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SearchCache:
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (value, monotonic time it expires)
+        self.entries = OrderedDict()
+        # key -> the flight of the search that is running
+        self.flights = {}
+        self.version = get_data_version()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+
+    def _check_version(self):
+        version = get_data_version()
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        return version
+
+    def join(self, key, new_flight):
+        # Returns one of
+        # (value, None, None): it was in the cache
+        # (None, flight, None): someone runs it, wait for the flight
+        # (None, flight, version): run it, then call finish
+        with self.lock:
+            version = self._check_version()
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if time.monotonic() < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value, None, None
+                del self.entries[key]
+                self.expired += 1
+            if key in self.flights:
+                self.coalesced += 1
+                return None, self.flights[key], None
+            self.misses += 1
+            flight = self.flights[key] = new_flight()
+            return None, flight, version
+
+    def finish(self, key, value, version):
+        # value is None when the search failed, nothing is kept then.
+        # Nor when a write happened while it ran
+        with self.lock:
+            self.flights.pop(key, None)
+            if value is None or not self.max_entries or \
+                    self._check_version() != version:
+                return
+            expires = time.monotonic() + self.ttl if self.ttl \
+                else float('inf')
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def search(self, key, compute):
+        value, flight, version = self.join(key, Flight)
+        if flight is None:
+            return value
+        if version is None:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            self.finish(key, flight.value, version)
+            flight.done.set()
+        return flight.value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'expired': self.expired,
+                # Coalesced requests didn't run a query either
+                'hit_rate': round((self.hits + self.coalesced) / lookups,
+                                  4) if lookups else None,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def init_search_cache(app):
+    app.extensions['search_cache'] = SearchCache(
+        app.config['SEARCH_CACHE_MAX_ENTRIES'],
+        app.config['SEARCH_CACHE_TTL'])
+    return app.extensions['search_cache']
+
+
+def get_search_cache():
+    return current_app.extensions['search_cache']
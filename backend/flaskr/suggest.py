@@ -0,0 +1,327 @@
+import heapq
+import re
+import threading
+from flask import current_app, has_app_context
+from models import db, Question, question_hooks, get_data_version, \
+    changes_since, last_changes
+
+'''
+SuggestIndex (SUGGEST_* in config.py)
+    type-ahead for GET /questions/suggest?prefix=, answered from
+    memory without a query. Every word of every question goes into a
+    trie of its first SUGGEST_MAX_PREFIX characters, and each node
+    keeps the SUGGEST_TOP_K best questions of its subtree (shortest
+    question first, then the oldest), so a one word prefix is a walk
+    down the trie and a slice of that list
+    - a longer prefix than the trie is deep looks at the questions of
+      the deepest node and checks their words
+    - with several words, the questions of the word that matches the
+      fewest are checked for the other ones
+    - insert / delete hooks keep it current: a delete recomputes the
+      lists of its nodes from their children, bottom up, nothing is
+      read again. Like QuizIndex, it knows the data version it is
+      current for and catches up with the writes of the other workers
+      from the change log (only the inserted texts are read)
+    - single flight, like the search cache: one request builds it,
+      the ones that come meanwhile wait for it the first time and
+      keep using the old trie after that
+    Memory: the text of every question, one id per (question, word),
+    and at most SUGGEST_TOP_K ids per trie node, which the depth
+    limit keeps to SUGGEST_MAX_PREFIX nodes per distinct word at most
+    https://en.wikipedia.org/wiki/Trie
+'''
+
+WORD = re.compile(r'\w+')
+
+
+def words_of(text):
+    return WORD.findall(text.lower())
+
+
+class Node:
+    __slots__ = ('children', 'ids', 'top', 'size')
+
+    def __init__(self):
+        self.children = {}
+        # Questions with a word that ends here (or is cut here, at
+        # the depth limit)
+        self.ids = set()
+        # The best SUGGEST_TOP_K ids of the subtree, best first
+        self.top = []
+        # (question, word) pairs in the subtree
+        self.size = 0
+
+
+class SuggestIndex:
+
+    def __init__(self, max_prefix, top_k):
+        self.max_prefix = max_prefix
+        self.top_k = top_k
+        self.lock = threading.Lock()
+        # Held by the request that builds it
+        self.building = threading.Lock()
+        self.built = False
+        self.version = None
+        self.root = Node()
+        # id -> question text, and id -> its rank (smaller is better)
+        self.texts = {}
+        self.ranks = {}
+
+    def build(self):
+        # One scan of (id, question) at the first request (or at the
+        # warm-up). The trie is filled first and the top lists are
+        # computed at the end, bottom up, once per node
+        version = get_data_version()
+        rows = db.session.query(Question.id, Question.question).all()
+        root, texts, ranks = Node(), {}, {}
+        for question_id, text in rows:
+            text = text or ''
+            texts[question_id] = text
+            ranks[question_id] = (len(text), question_id)
+            for word in set(words_of(text)):
+                node = root
+                for char in word[:self.max_prefix]:
+                    node = node.children.setdefault(char, Node())
+                    node.size += 1
+                node.ids.add(question_id)
+        self._fill_tops(root, ranks)
+        with self.lock:
+            self.root, self.texts, self.ranks = root, texts, ranks
+            self.built = True
+            self.version = version
+
+    def _fill_tops(self, root, ranks):
+        # Children before their parent, without recursion (the trie
+        # is as deep as SUGGEST_MAX_PREFIX, but that is a setting)
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(node.children.values())
+        for node in reversed(order):
+            node.top = self._best(node, ranks)
+
+    def _best(self, node, ranks):
+        # The top of a subtree is in the node's own ids or in the top
+        # of one of its children
+        candidates = set(node.ids)
+        for child in node.children.values():
+            candidates.update(child.top)
+        return heapq.nsmallest(self.top_k, candidates,
+                               key=ranks.__getitem__)
+
+    def current(self):
+        return self.built and self.version == get_data_version()
+
+    def ensure_built(self):
+        if self.current() or (self.built and self.catch_up()):
+            return
+        # Never built (version None): nothing to answer with, wait
+        if not self.building.acquire(blocking=self.version is None):
+            return
+        try:
+            # It may have been built while we waited
+            if not self.current():
+                self.build()
+        finally:
+            self.building.release()
+
+    def catch_up(self):
+        # QuizIndex.catch_up. The texts never change, only the ones of
+        # the questions it doesn't have yet are read, in one query
+        # before the lock is taken
+        since = self.version
+        version, changes = changes_since(since)
+        if changes is None:
+            return False
+        changes = last_changes(changes)
+        missing = [question_id for question_id, (action, _) in
+                   changes.items()
+                   if action != 'delete' and question_id not in self.texts]
+        texts = dict(db.session.query(Question.id, Question.question)
+                     .filter(Question.id.in_(missing))) if missing \
+            else {}
+        with self.lock:
+            # Someone else caught up (or a hook synced it) meanwhile
+            if self.version != since:
+                return True
+            for question_id, (action, _) in changes.items():
+                if action == 'delete':
+                    self._remove(question_id)
+                elif question_id in texts:
+                    self._add(question_id, texts[question_id])
+            self.version = version
+            return True
+
+    def _synced(self):
+        # Same as QuizIndex._synced
+        version = get_data_version()
+        if self.version == version - 1:
+            self.version = version
+
+    def _path(self, word):
+        # The nodes of the word, creating the missing ones
+        path = []
+        node = self.root
+        for char in word[:self.max_prefix]:
+            node = node.children.setdefault(char, Node())
+            path.append(node)
+        return path
+
+    def add(self, question_id, text):
+        with self.lock:
+            self._add(question_id, text)
+            self._synced()
+
+    def _add(self, question_id, text):
+        if question_id in self.texts:
+            self._remove(question_id)
+        text = text or ''
+        rank = (len(text), question_id)
+        self.texts[question_id] = text
+        self.ranks[question_id] = rank
+        for word in set(words_of(text)):
+            path = self._path(word)
+            path[-1].ids.add(question_id)
+            for node in path:
+                node.size += 1
+                if question_id in node.top:
+                    continue
+                if len(node.top) < self.top_k or \
+                        rank < self.ranks[node.top[-1]]:
+                    node.top.append(question_id)
+                    node.top.sort(key=self.ranks.__getitem__)
+                    del node.top[self.top_k:]
+
+    def remove(self, question_id):
+        with self.lock:
+            self._remove(question_id)
+            self._synced()
+
+    def unchanged(self):
+        # A write that changed no text (a category, a difficulty),
+        # only the version
+        with self.lock:
+            self._synced()
+
+    def _remove(self, question_id):
+        text = self.texts.get(question_id)
+        if text is None:
+            return
+        for word in set(words_of(text)):
+            path = self._path(word)
+            path[-1].ids.discard(question_id)
+            for node in path:
+                node.size -= 1
+            # Bottom up, a node's list is rebuilt from its children's
+            # lists, which must be right already
+            for depth in range(len(path) - 1, -1, -1):
+                node = path[depth]
+                if node.size == 0:
+                    parent = path[depth - 1] if depth else self.root
+                    del parent.children[word[depth]]
+                elif question_id in node.top:
+                    node.top.remove(question_id)
+                    # It was full: the next best one may be anywhere
+                    # in the subtree
+                    if len(node.top) == self.top_k - 1:
+                        node.top = self._best(node, self.ranks)
+        del self.texts[question_id]
+        del self.ranks[question_id]
+
+    def _find(self, word):
+        node = self.root
+        for char in word[:self.max_prefix]:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _subtree_ids(self, node):
+        ids = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            ids.update(node.ids)
+            stack.extend(node.children.values())
+        return ids
+
+    def _matches(self, question_id, prefixes):
+        # Every prefix starts one of the question's words
+        words = words_of(self.texts[question_id])
+        return all(any(word.startswith(prefix) for word in words)
+                   for prefix in prefixes)
+
+    def suggest(self, prefix, limit):
+        # Up to limit (at most SUGGEST_TOP_K) [(id, question)], the
+        # best ones first, whose words start with the words of prefix
+        self.ensure_built()
+        prefixes = words_of(prefix)
+        if not prefixes:
+            return []
+        limit = min(limit, self.top_k)
+        with self.lock:
+            nodes = [self._find(word) for word in prefixes]
+            if None in nodes:
+                return []
+            if len(prefixes) == 1 and len(prefixes[0]) <= self.max_prefix:
+                ids = nodes[0].top[:limit]
+            else:
+                # The word with the fewest matches picks the
+                # candidates, in rank order: the top list first, the
+                # whole subtree only when that isn't enough
+                node, word = min(zip(nodes, prefixes),
+                                 key=lambda pair: pair[0].size)
+                # Its subtree matches it already, unless it was cut
+                checked = [prefix for prefix in prefixes
+                           if prefix != word or
+                           len(word) > self.max_prefix]
+                ids = [question_id for question_id in node.top
+                       if self._matches(question_id, checked)][:limit]
+                if len(ids) < limit and len(node.top) == self.top_k:
+                    candidates = sorted(self._subtree_ids(node),
+                                        key=self.ranks.__getitem__)
+                    ids = []
+                    for question_id in candidates:
+                        if self._matches(question_id, checked):
+                            ids.append(question_id)
+                            if len(ids) == limit:
+                                break
+            return [(question_id, self.texts[question_id])
+                    for question_id in ids]
+
+
+def init_suggest_index(app):
+    app.extensions['suggest_index'] = SuggestIndex(
+        app.config['SUGGEST_MAX_PREFIX'], app.config['SUGGEST_TOP_K'])
+    return app.extensions['suggest_index']
+
+
+def get_suggest_index():
+    return current_app.extensions['suggest_index']
+
+
+def update_suggest_index(action, question_id, category):
+    # Registered in models.question_hooks like update_quiz_index.
+    # The hooks don't carry the text, an insert reads it by primary
+    # key. A category change ('update') doesn't change any word, nor
+    # does a difficulty change ('unchanged')
+    if not has_app_context():
+        return
+    index = current_app.extensions.get('suggest_index')
+    if index is None or not index.built:
+        return
+    if action == 'insert':
+        index.add(question_id, db.session.query(Question.question).filter(
+            Question.id == question_id).scalar())
+    elif action == 'delete':
+        index.remove(question_id)
+    elif action in ('update', 'unchanged'):
+        index.unchanged()
+    elif action == 'reload':
+        # Built again on the next suggest request
+        index.built = False
+
+
+question_hooks.append(update_suggest_index)
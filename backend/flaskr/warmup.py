@@ -0,0 +1,61 @@
+import time
+from models import db, app_engines
+from .quiz_index import get_quiz_index
+from .suggest import get_suggest_index
+
+'''
+Worker warm-up (WARMUP_* in config.py)
+    a freshly forked worker has empty pools, an unbuilt quiz index and
+    empty caches, so its first requests pay for all of it. warm_up(app)
+    does that work before the worker accepts traffic (gunicorn calls
+    it from post_worker_init, see gunicorn.conf.py):
+    - opens WARMUP_CONNECTIONS connections on every engine and gives
+      them back, they stay in the pool
+    - builds the quiz index and the suggest index
+    - requests WARMUP_PATHS once, which fills the response cache
+    https://docs.gunicorn.org/en/stable/settings.html#post-worker-init
+'''
+
+
+def warm_pools(app, connections):
+    # Checked out all at once, or the pool would hand the same one
+    # back every time
+    for engine in app_engines(app).values():
+        opened = []
+        try:
+            for _ in range(connections):
+                opened.append(engine.connect())
+        finally:
+            for connection in opened:
+                connection.close()
+
+
+def warm_up(app):
+    # Returns {step: seconds} (for the log)
+    timings = {}
+
+    started = time.perf_counter()
+    warm_pools(app, app.config['WARMUP_CONNECTIONS'])
+    timings['pools'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with app.app_context():
+        get_quiz_index().ensure_built()
+        db.session.remove()
+    timings['quiz_index'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with app.app_context():
+        get_suggest_index().ensure_built()
+        db.session.remove()
+    timings['suggest_index'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    client = app.test_client()
+    for path in app.config['WARMUP_PATHS']:
+        response = client.get(path)
+        if response.status_code != 200:
+            app.logger.warning('warm-up of %s answered %s', path,
+                               response.status_code)
+    timings['paths'] = time.perf_counter() - started
+    return timings
@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+from models import dispose_engines, share_data_version
+
+'''
+gunicorn settings (gunicorn -c gunicorn.conf.py from the backend
+folder), every value can be changed with the environment variables
+below or on the command line
+    - preload_app: wsgi.py is imported once in the master and the
+      workers are forked from it, they start faster and share the
+      memory of the code
+    - the data version (models.share_data_version) is put in shared
+      memory before the fork, so a write in a worker makes the caches
+      and ETags of every worker change. The question changes are
+      logged next to it, the quiz and suggest indexes of the other
+      workers catch up from the log instead of being built again
+    - the quiz sessions are in the database (QUIZ_SESSION_BACKEND,
+      wsgi.py sets it), any worker serves any session: with the
+      'memory' store and several workers gunicorn doesn't start
+    - post_fork: the worker drops the connections of the pools it got
+      from the master without closing them (they aren't its own)
+    - post_worker_init: warm-up (flaskr/warmup.py) before the worker
+      takes its first request
+    Memory per worker: the response cache, the quiz index, the rate
+    limit buckets (RATE_LIMIT_BACKEND) and the metrics
+    Gunicorn uses SIGUSR1 / SIGUSR2 (and HUP, TTIN, TTOU, WINCH)
+    itself, PROFILE_SIGNAL has to be another one (SIGURG for example)
+    threads * workers connections at most reach the database, keep
+    threads under DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW
+    https://docs.gunicorn.org/en/stable/settings.html
+    https://docs.gunicorn.org/en/stable/design.html#how-many-workers
+'''
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('TRIVIA_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get(
+    'TRIVIA_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Threads per worker, the requests mostly wait on the database
+worker_class = 'gthread'
+threads = int(os.environ.get('TRIVIA_THREADS', 4))
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# A worker is replaced after this many requests (jittered so they
+# don't all restart at once), it bounds slow leaks
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def on_starting(server):
+    share_data_version()
+    from wsgi import app
+    if server.cfg.workers > 1 and \
+            app.config['QUIZ_SESSION_BACKEND'] == 'memory':
+        # A session would only be known by the worker that started it
+        server.log.error('QUIZ_SESSION_BACKEND is "memory" with %s '
+                         'workers, use "database" or 1 worker',
+                         server.cfg.workers)
+        raise SystemExit(1)
+
+
+def post_fork(server, worker):
+    from wsgi import app
+    dispose_engines(app, close=False)
+
+
+def post_worker_init(worker):
+    from wsgi import app
+    from flaskr.warmup import warm_up
+    timings = warm_up(app)
+    worker.log.info('worker %s warmed up: %s', worker.pid, ', '.join(
+        '{} {:.0f} ms'.format(step, seconds * 1000)
+        for step, seconds in timings.items()))
@@ -1,30 +1,297 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, \
+    create_engine, select
+from sqlalchemy import orm
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
+import multiprocessing
+import threading
+from datetime import datetime, timezone
 from config import *
 
 
-database_path = "postgres://{}:{}@{}/{}".format(
-    database_info["user_name"],
-    database_info["password"],
-    database_info["port"],
-    database_info["database_name"])
+database_path = DATABASE_PATH
+
+'''
+RoutingSession
+    the Flask-SQLAlchemy session, except that while a read only
+    endpoint runs (g.read_only, see flaskr/replica.py) the queries
+    go to the 'replica' bind when one is configured, writes
+    (flushes) always go to the primary
+    https://docs.sqlalchemy.org/en/13/orm/persistence_techniques.html#custom-vertical-partitioning
+'''
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        binds = self.app.config.get('SQLALCHEMY_BINDS') or {}
+        if (not self._flushing and 'replica' in binds
+                and has_app_context() and g.get('read_only')):
+            return db.get_engine(self.app, bind='replica')
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(
+            class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def engine_options(database_path, config):
+    # Options for create_engine, the pool sizes are left out for
+    # SQLite, Flask-SQLAlchemy picks its own pool for it
+    # https://docs.sqlalchemy.org/en/13/core/pooling.html
+    options = {
+        'pool_pre_ping': config.get(
+            'DATABASE_POOL_PRE_PING', DATABASE_POOL_PRE_PING),
+        'pool_recycle': config.get(
+            'DATABASE_POOL_RECYCLE', DATABASE_POOL_RECYCLE),
+    }
+    if not database_path.startswith('sqlite'):
+        options['pool_size'] = config.get(
+            'DATABASE_POOL_SIZE', DATABASE_POOL_SIZE)
+        options['max_overflow'] = config.get(
+            'DATABASE_MAX_OVERFLOW', DATABASE_MAX_OVERFLOW)
+        options['pool_timeout'] = config.get(
+            'DATABASE_POOL_TIMEOUT', DATABASE_POOL_TIMEOUT)
+    statement_timeout = config.get(
+        'DATABASE_STATEMENT_TIMEOUT', DATABASE_STATEMENT_TIMEOUT)
+    if statement_timeout and database_path.startswith('postgres'):
+        # Server side limit (in ms) for every statement
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(
+                statement_timeout)}
+    return options
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    replica_path is an optional read replica of database_path
+    It doesn't create the tables any more, that's create_schema
+    (or "flask init-db")
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_path=None):
+    if replica_path is None:
+        replica_path = app.config.get(
+            'DATABASE_REPLICA_PATH', DATABASE_REPLICA_PATH)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, app.config)
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {'replica': replica_path}
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+def create_schema(app):
+    # Creates the tables that don't exist yet
+    with app.app_context():
+        db.create_all()
+
+
+def app_engines(app):
+    # name -> engine, the primary and the replica when there is one
+    engines = {'primary': db.get_engine(app)}
+    if 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        engines['replica'] = db.get_engine(app, bind='replica')
+    return engines
+
+
+def dispose_engines(app, close=True):
+    # Empties the connection pools. After a fork the child calls it
+    # with close=False: the connections it inherited are dropped
+    # without being closed, they still belong to the parent (closing
+    # them would end the parent's sessions on the server), and the
+    # child opens its own ones
+    # https://docs.sqlalchemy.org/en/14/core/pooling.html#using-connection-pools-with-multiprocessing-or-os-fork
+    for engine in app_engines(app).values():
+        engine.dispose(close=close)
+
+
+def pool_stats(app):
+    # What the connection pool of each engine is doing right now
+    stats = {}
+    for name, engine in app_engines(app).items():
+        pool = engine.pool
+        stats[name] = {'pool': type(pool).__name__,
+                       'status': pool.status()}
+        # Only the QueuePool counts its connections
+        for counter in ('size', 'checkedin', 'checkedout',
+                        'overflow'):
+            if hasattr(pool, counter):
+                stats[name][counter] = getattr(pool, counter)()
+    return stats
+
+
+'''
+data_version
+    a counter bumped on every write made through the models
+    (insert / update / delete below), the caches compare it with
+    the version they were filled at to know they are stale
+    It lives in this process. With several worker processes forked
+    from one master (gunicorn, see gunicorn.conf.py) the master calls
+    share_data_version() before the fork: the version and its time
+    then live in shared memory, a write in one worker makes the
+    caches of all of them stale and they all send the same ETags
+    https://docs.python.org/3/library/multiprocessing.html#shared-ctypes-objects
+change_log
+    the question changes of the last versions (a ring buffer shared
+    like the version), so the in-memory indexes of a worker catch up
+    with the writes of the other ones (changes_since) instead of
+    reading every question again. A write that doesn't say what it
+    changed (changes=None: bulk inserts, categories, the dump) logs a
+    'reload', and the indexes are built again after it
+'''
+data_version = 0
+data_version_lock = threading.Lock()
+# When the version last moved (the process start for version 0),
+# it is what the API sends as Last-Modified
+data_modified = datetime.now(timezone.utc).replace(microsecond=0)
+# [version, data_modified as a POSIX timestamp] in shared memory,
+# None while the version is only in this process
+shared_data_version = None
+
+# [entries logged, highest version with entries overwritten] then
+# CHANGE_LOG_SIZE slots of (version, action, question id, category),
+# -1 for a None id or category
+CHANGE_LOG_SIZE = 4096
+CHANGE_ACTIONS = ('reload', 'insert', 'delete', 'update')
+change_log = [0, 0] + [0] * (4 * CHANGE_LOG_SIZE)
+# The same list in shared memory, next to shared_data_version (and
+# guarded by its lock)
+shared_change_log = None
+
+
+def now_modified():
+    # The real time of the write. HTTP dates are in seconds, several
+    # versions can share one: the ETag tells them apart, and
+    # conditional.py doesn't send a Last-Modified before its second
+    # is over
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def share_data_version():
+    global shared_data_version, shared_change_log
+    with data_version_lock:
+        if shared_data_version is None:
+            shared_change_log = multiprocessing.Array(
+                'q', change_log, lock=False)
+            shared_data_version = multiprocessing.Array(
+                'q', [data_version, int(data_modified.timestamp())])
+    return shared_data_version
+
+
+def log_changes(log, version, changes):
+    # changes is a list of (action, question_id, category), None when
+    # the write doesn't know (or there are more than the log keeps)
+    if changes is None or len(changes) > CHANGE_LOG_SIZE:
+        changes = [('reload', None, None)]
+    for action, question_id, category in changes:
+        slot = 2 + 4 * (log[0] % CHANGE_LOG_SIZE)
+        if log[0] >= CHANGE_LOG_SIZE:
+            log[1] = max(log[1], log[slot])
+        log[slot:slot + 4] = [
+            version, CHANGE_ACTIONS.index(action),
+            -1 if question_id is None else question_id,
+            -1 if category is None else category]
+        log[0] += 1
+
+
+def bump_data_version(changes=None):
+    # changes: what the write did to the questions (see log_changes),
+    # [] for a write that changed none
+    global data_version, data_modified
+    with data_version_lock:
+        if shared_data_version is not None:
+            with shared_data_version.get_lock():
+                data_version = shared_data_version[0] + 1
+                data_modified = now_modified()
+                log_changes(shared_change_log, data_version, changes)
+                shared_data_version[0] = data_version
+                shared_data_version[1] = int(data_modified.timestamp())
+            return data_version
+        data_version += 1
+        data_modified = now_modified()
+        log_changes(change_log, data_version, changes)
+        return data_version
+
+
+def changes_since(version):
+    # (current version, the question changes after version, oldest
+    # first), the changes are None when the log can't tell: a
+    # 'reload' in between, or they were overwritten already
+    if shared_data_version is not None:
+        lock, log = shared_data_version.get_lock(), shared_change_log
+    else:
+        lock, log = data_version_lock, change_log
+    with lock:
+        current = get_data_version()
+        if version is None or version > current or log[1] > version:
+            return current, None
+        changes = []
+        count = log[0]
+        for entry in range(count - 1,
+                           max(count - CHANGE_LOG_SIZE, 0) - 1, -1):
+            slot = 2 + 4 * (entry % CHANGE_LOG_SIZE)
+            logged, action, question_id, category = log[slot:slot + 4]
+            if logged <= version:
+                break
+            if action == 0:
+                return current, None
+            changes.append((CHANGE_ACTIONS[action],
+                            None if question_id == -1 else question_id,
+                            None if category == -1 else category))
+    changes.reverse()
+    return current, changes
+
+
+def last_changes(changes):
+    # question id -> (action, category) of its last change
+    return {question_id: (action, category)
+            for action, question_id, category in changes}
+
+
+def get_data_version():
+    if shared_data_version is not None:
+        return shared_data_version[0]
+    return data_version
+
+
+def get_data_modified():
+    if shared_data_version is not None:
+        return datetime.fromtimestamp(shared_data_version[1],
+                                      timezone.utc)
+    return data_modified
+
+
+'''
+question_hooks
+    functions appended to this list are called as
+    hook(action, question_id, category) right after a question
+    is committed ('insert') or deleted ('delete'), this is how the
+    in-memory indexes (like the quiz index) stay up to date
+    After bulk writes they get ('reload', None, None) and have to
+    rebuild from the database, ('update', question_id, category)
+    means the question moved to that category and ('unchanged',
+    None, None) that the version moved for a write they don't keep
+    (a difficulty)
+'''
+question_hooks = []
+
+
+def run_question_hooks(action, question_id, category):
+    for hook in question_hooks:
+        hook(action, question_id, category)
 
 
 '''
@@ -49,9 +316,18 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    # The id of the category, like the foreign key of trivia.psql
+    # (an existing database is converted by migration 1, see
+    # flaskr/migrations.py)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
+    # Listings / counts by category and the quiz index only read
+    # this index
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),)
+
     def __init__(
             self,
             question,
@@ -66,13 +342,93 @@ class Question(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        bump_data_version([('insert', self.id, self.category)])
+        run_question_hooks('insert', self.id, self.category)
 
     def update(self):
         db.session.commit()
+        bump_data_version()
 
     def delete(self):
+        # Keeping the id and category, after the commit the
+        # object is gone
+        question_id, category = self.id, self.category
         db.session.delete(self)
         db.session.commit()
+        bump_data_version([('delete', question_id, category)])
+        run_question_hooks('delete', question_id, category)
+
+    @staticmethod
+    def insert_many(rows, notify=True):
+        # rows is a list of dicts (question, answer, category,
+        # difficulty), they all go in one executemany and one commit
+        # https://docs.sqlalchemy.org/en/13/core/tutorial.html#executing-multiple-statements
+        # notify=False leaves inserted_many to the caller, when
+        # several calls are one write
+        db.session.execute(Question.__table__.insert(), rows)
+        db.session.commit()
+        if notify:
+            Question.inserted_many()
+
+    @staticmethod
+    def inserted_many():
+        # The ids aren't known, the indexes are built again
+        bump_data_version()
+        run_question_hooks('reload', None, None)
+
+    @staticmethod
+    def delete_many(ids):
+        # One DELETE ... WHERE id IN (...) and one commit, returns the
+        # (id, category) of the rows that were deleted
+        table = Question.__table__
+        selected = table.c.id.in_(ids)
+        if db.engine.dialect.full_returning:
+            # PostgreSQL: the statement itself says what it deleted
+            rows = db.session.execute(table.delete().where(
+                selected).returning(table.c.id, table.c.category)).all()
+        else:
+            # SQLite (RETURNING needs SQLAlchemy 2.0): the rows are
+            # read first, in the same transaction
+            rows = db.session.execute(select(
+                table.c.id, table.c.category).where(selected)).all()
+            if rows:
+                db.session.execute(table.delete().where(selected))
+        db.session.commit()
+        if rows:
+            bump_data_version([('delete', question_id, category)
+                               for question_id, category in rows])
+            for question_id, category in rows:
+                run_question_hooks('delete', question_id, category)
+        return rows
+
+    @staticmethod
+    def update_many(ids, values):
+        # One UPDATE ... SET values WHERE id IN (...) and one commit,
+        # returns the ids of the rows that were updated
+        table = Question.__table__
+        selected = table.c.id.in_(ids)
+        if db.engine.dialect.full_returning:
+            updated = [row[0] for row in db.session.execute(
+                table.update().where(selected).values(
+                    **values).returning(table.c.id))]
+        else:
+            updated = [row[0] for row in db.session.execute(
+                select(table.c.id).where(selected))]
+            if updated:
+                db.session.execute(
+                    table.update().where(selected).values(**values))
+        db.session.commit()
+        if updated and 'category' in values:
+            bump_data_version([('update', question_id, values['category'])
+                               for question_id in updated])
+            for question_id in updated:
+                run_question_hooks(
+                    'update', question_id, values['category'])
+        elif updated:
+            # Only the difficulty: no index has to change
+            bump_data_version([])
+            run_question_hooks('unchanged', None, None)
+        return updated
 
     def format(self):
         return {
@@ -84,6 +440,26 @@ class Question(db.Model):
         }
 
 
+# The columns of Question.format(), in its order, for the read
+# paths: db.session.query(*QUESTION_COLUMNS) gives plain tuples,
+# without building a Question (identity map, instance state) for
+# each row
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+
+
+def format_question_row(row):
+    # Question.format() for a row of QUESTION_COLUMNS
+    question_id, question, answer, category, difficulty = row
+    return {
+        'id': question_id,
+        'question': question,
+        'answer': answer,
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
 '''
 Category
 
@@ -101,14 +477,18 @@ class Category(db.Model):
 
     def update(self):
         db.session.commit()
+        # No question changed (the indexes don't keep the types)
+        bump_data_version([])
 
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        bump_data_version([])
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        bump_data_version()
 
     def format(self):
         return {
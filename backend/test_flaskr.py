@@ -1,9 +1,49 @@
 import os
+import gzip
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine, func, inspect, text
+from starlette.testclient import TestClient
+from werkzeug.http import http_date
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import create_asgi_app
+from flaskr.commands import load_trivia_dump
+from flaskr.migrations import migrate
+from flaskr.quiz_index import ALL_CATEGORIES
+from flaskr.quiz_sessions import QuizSessionStore, DatabaseQuizSessionStore
+from flaskr.warmup import warm_up
+from flaskr.external_writes import mark_external_write
+from flaskr.counts import stored_counts, reconcile_counts, read_counts, \
+    CountReconciler
+from flaskr.profiler import explain
+from flaskr.search import sqlite_match_query, pg_match_query
+from flaskr.search_cache import SearchCache, normalize_search_term
+from flaskr.suggest import SuggestIndex
+import models
+from models import Question
+
+
+def make_app(database_path='sqlite://', load=True, **settings):
+    # The app of a test: its own database (in memory by default)
+    # with the tables and, unless load is False, the data of
+    # trivia.psql. settings override anything else
+    config = {
+        'TESTING': True,
+        'DATABASE_PATH': database_path,
+        'CREATE_SCHEMA_ON_START': True
+    }
+    config.update(settings)
+    app = create_app(config)
+    if load:
+        load_trivia_dump(app)
+    return app
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -11,23 +51,24 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        # Every test gets its own in-memory SQLite database with
+        # the data of trivia.psql, no Postgres needed
+        self.app = create_app({
+            'TESTING': True,
+            'DATABASE_PATH': 'sqlite://',
+            'CREATE_SCHEMA_ON_START': True
+        })
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format(
-            'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        load_trivia_dump(self.app)
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        # binds the app to the current context (the tests insert
+        # questions directly with the models)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        self.app_context.pop()
 
     """
     TODO (done)
@@ -58,6 +99,73 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'])
 
+    def test_get_categories_not_modified(self):
+        # Sending back the ETag we got, nothing changed in between
+        # so the answer is 304 without a body
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+
+        res = self.client().get(
+            '/categories', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_external_write_drops_the_caches(self):
+        # "flask reconcile-counts" run by cron is another process, it
+        # doesn't move the data version of the app, only its mark
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        version = models.get_data_version()
+        watcher = self.app.extensions['external_writes']
+        with self.app.app_context():
+            self.assertTrue(mark_external_write('counts'))
+
+        # Until the next read of the table
+        res = self.client().get(
+            '/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        watcher.next_poll.value = 0
+        res = self.client().get(
+            '/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(models.changes_since(version),
+                         (version + 1, []))
+
+        # "flask load-trivia": the indexes are built again
+        with self.app.app_context():
+            mark_external_write('questions')
+        watcher.next_poll.value = 0
+        self.client().get('/categories')
+        self.assertEqual(models.changes_since(version + 1),
+                         (version + 2, None))
+
+    def test_last_modified_is_the_write_time(self):
+        for number in range(3):
+            self.client().post('/questions', json={
+                'question': 'Burst {}?'.format(number), 'answer': 'Yes',
+                'difficulty': 1, 'category': 1})
+        # A burst of writes doesn't push the date into the future
+        now = datetime.now(timezone.utc)
+        self.assertTrue(models.get_data_modified() <= now)
+
+        # Within the second of the write, only the ETag is sent
+        models.data_modified = now.replace(microsecond=0)
+        res = self.client().get('/categories')
+        self.assertNotIn('Last-Modified', res.headers)
+        res = self.client().get('/categories', headers={
+            'If-Modified-Since': http_date(now + timedelta(seconds=5))})
+        self.assertEqual(res.status_code, 200)
+
+        models.data_modified -= timedelta(seconds=2)
+        res = self.client().get('/categories')
+        last_modified = res.headers['Last-Modified']
+        res = self.client().get('/categories', headers={
+            'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 304)
+
     def test_get_null_categories(self):
         # To test this we have to try a path that probably doesn't even exist
         # Setting response: that the client is getting this
@@ -91,6 +199,35 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['categories'])
 
+    def test_get_questions_per_page(self):
+        # Asking for a smaller page than the default one
+        res = self.client().get('/questions?page=1&per_page=5')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions_list']), 5)
+        self.assertTrue(data['total_questions'] > 5)
+
+    def test_get_questions_after_id(self):
+        # Keyset pagination: every id in the page comes after the
+        # cursor and the next_cursor is the last id of the page
+        res = self.client().get('/questions?after_id=0&per_page=3')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        ids = [question['id'] for question in data['questions_list']]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(data['next_cursor'], ids[-1])
+
+    def test_page_below_one_is_a_bad_request(self):
+        for url in ('/questions?page=0', '/categories/1/questions?page=-1'):
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
     def test_get_category_questions_success(self):
         # Setting response: that the client is getting this
         # endpoint /categories/1/questions
@@ -108,6 +245,40 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'])
 
+    def test_get_questions_not_stale_after_insert(self):
+        # The first call fills the cache, the insert has to drop it
+        res = self.client().get('/questions')
+        total_before = json.loads(res.data)['total_questions']
+
+        test_question = Question(
+            question='Is this question cached?',
+            answer='No',
+            difficulty=1,
+            category=1)
+        test_question.insert()
+
+        res = self.client().get('/questions')
+        data = json.loads(res.data)
+        test_question.delete()
+
+        self.assertEqual(data['total_questions'], total_before + 1)
+
+    def test_get_category_questions_stream(self):
+        # The streamed body is the same JSON object, with all the
+        # questions of the category
+        res = self.client().get('/categories/1/questions?stream=true')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), data['total_questions'])
+        self.assertEqual(data['current_category'], 1)
+
+        # Same status as the paginated mode
+        res = self.client().get('/categories/1000/questions?stream=true')
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['success'], False)
+
     def test_get_category_null_questions(self):
         # Setting response: that the client is getting this endpoint /categories/10000000/questions
         # It doesn't exist so it's gonna raise the 404 error
@@ -188,6 +359,52 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_bulk_create_questions(self):
+        # Two good rows and one without an answer, the good ones
+        # are created and the bad one is reported by its number
+        test_rows = [
+            {'question': 'Bulk question 1?', 'answer': 'Yes',
+             'difficulty': 1, 'category': 1},
+            {'question': 'Bulk question 2?', 'difficulty': 1,
+             'category': 1},
+            {'question': 'Bulk question 3?', 'answer': 'Yes',
+             'difficulty': 2, 'category': 2},
+        ]
+
+        res = self.client().post('/questions/bulk', json=test_rows)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [2])
+
+    def test_bulk_batch_retried_row_by_row(self):
+        # The database refuses the second row (too big for an
+        # INTEGER), the batch is retried one row at a time
+        test_rows = [
+            {'question': 'Bulk question {}?'.format(number),
+             'answer': 'Yes', 'difficulty': difficulty, 'category': 1}
+            for number, difficulty in enumerate([1, 2 ** 70, 3])]
+        version = models.get_data_version()
+
+        res = self.client().post('/questions/bulk', json=test_rows)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [2])
+        # One write for the batch
+        self.assertEqual(models.get_data_version(), version + 1)
+
+    def test_export_questions(self):
+        # Every line of the export is one question
+        res = self.client().get('/questions/export')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(lines) > 0)
+        self.assertIn('answer', json.loads(lines[0]))
+
     def test_search_questions_found(self):
 
         new_question_search = {
@@ -206,6 +423,33 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']) > 0)
         self.assertTrue(data['total_questions'] > 0)
 
+    def test_search_questions_matches_answer(self):
+        # The full text search looks at the answers too
+        res = self.client().post('/questions/search?per_page=5',
+                                 json={'search_term': 'Mona Lisa'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertTrue(len(data['questions']) <= 5)
+        self.assertIn('Mona Lisa', [question['answer']
+                                    for question in data['questions']])
+
+    def test_search_words_are_prefixes(self):
+        # "mon lis" finds the Mona Lisa, and PostgreSQL gets the same
+        # prefix terms as SQLite, without the query syntax
+        res = self.client().post('/questions/search',
+                                 json={'search_term': 'mon lis'})
+        data = json.loads(res.data)
+        self.assertIn('Mona Lisa', [question['answer']
+                                    for question in data['questions']])
+
+        self.assertEqual(sqlite_match_query('Mona "Lisa'),
+                         '"Mona"* "Lisa"*')
+        self.assertEqual(pg_match_query('Mona & !Lisa:'),
+                         'Mona:* & Lisa:*')
+        self.assertEqual(pg_match_query('?!'), '')
+
     def test_search_questions_404(self):
         new_question_search = {'search_term': ''}
 
@@ -222,6 +466,326 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(
             data['message'], 'Resource Not Found')
 
+    def test_get_pool_stats(self):
+        res = self.client().get('/stats/pool')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('primary', data['pools'])
+
+    def test_get_metrics(self):
+        # After a GET /questions its latency and status are counted
+        self.client().get('/questions')
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'trivia_http_responses_total{method="GET",'
+            'endpoint="/questions",status="200"} 1', text)
+        self.assertIn('trivia_db_statements_per_request_count', text)
+
+    def test_query_profile_header(self):
+        # The category filter uses the (category, id) index, it
+        # doesn't read the whole questions table
+        self.app.extensions['query_profiler'].header = True
+        res = self.client().get('/categories/1/questions')
+        report = json.loads(res.headers['X-Query-Profile'])
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(report['statements'] > 0)
+        self.assertNotIn('questions', report['seq_scans'])
+
+    def test_query_profile_flags_unbounded_loads(self):
+        # /categories reads the 6 categories and their 6 counts
+        # without a LIMIT
+        profiler = self.app.extensions['query_profiler']
+        profiler.header = True
+        profiler.row_threshold = 5
+        res = self.client().get('/categories')
+        report = json.loads(res.headers['X-Query-Profile'])
+        self.assertEqual(report['unbounded'], 2)
+
+        profiler.row_threshold = 6
+        self.app.extensions['response_cache'].clear()
+        res = self.client().get('/categories')
+        report = json.loads(res.headers['X-Query-Profile'])
+        self.assertEqual(report['unbounded'], 0)
+
+    def test_failed_explain_is_logged(self):
+        # The comment hides the ")" of the count(*) around it, the
+        # statement itself runs, and so does the next one
+        with models.db.engine.connect() as connection:
+            with self.assertLogs(self.app.logger, 'DEBUG'):
+                self.assertEqual(explain(
+                    connection, 'SELECT id FROM questions -- all', ()),
+                    ([], None))
+            self.assertTrue(connection.execute(text(
+                'SELECT count(*) FROM questions')).scalar())
+
+    def test_query_profiler_follows_debug(self):
+        app = make_app(load=False, CREATE_SCHEMA_ON_START=False,
+                       DEBUG=False)
+        self.assertFalse(app.config['QUERY_PROFILER'])
+        self.assertNotIn('query_profiler', app.extensions)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGURG'), 'needs SIGURG')
+    def test_profile_signal_while_locked(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.addCleanup(signal.signal, signal.SIGURG, signal.SIG_DFL)
+        app = make_app(load=False, PROFILE_TOKEN='secret',
+                       PROFILE_SIGNAL='SIGURG', PROFILE_DUMP_DIR=folder)
+        app.test_client().get('/categories',
+                              headers={'X-Profile-Token': 'secret'})
+        profiler = app.extensions['sampling_profiler']
+        # The signal comes while the stats are being updated: the
+        # handler returns, the dump waits for the lock
+        with profiler.lock:
+            os.kill(os.getpid(), signal.SIGURG)
+            time.sleep(0.05)
+            self.assertEqual(os.listdir(folder), [])
+        for _ in range(100):
+            if os.listdir(folder):
+                break
+            time.sleep(0.01)
+        self.assertEqual(os.listdir(folder), [
+            'trivia-{}-get_categories.prof'.format(os.getpid())])
+
+    def test_sampled_profile_by_token(self):
+        app = make_app(load=False, PROFILE_TOKEN='secret')
+        client = app.test_client()
+        client.get('/categories', headers={'X-Profile-Token': 'secret'})
+        client.get('/categories')
+
+        res = client.get('/admin/profiles?limit=5',
+                         headers={'X-Profile-Token': 'secret'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['profiles']['get_categories']['requests'], 1)
+        self.assertEqual(
+            len(data['profiles']['get_categories']['functions']), 5)
+        self.assertEqual(client.get('/admin/profiles').status_code, 403)
+
+    def test_orjson_sends_same_bytes(self):
+        responses = []
+        for provider in ('json', 'orjson'):
+            app = make_app(DEBUG=False, JSON_PROVIDER=provider)
+            client = app.test_client()
+            responses.append([client.get(url).data for url in (
+                '/categories', '/questions?page=2',
+                '/categories/2/questions')])
+        self.assertEqual(responses[0], responses[1])
+
+    def test_gzip_response_has_own_etag(self):
+        res = self.client().get('/questions',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        data = json.loads(gzip.decompress(res.data))
+        self.assertEqual(data['success'], True)
+
+        res = self.client().get('/questions', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_quiz_session_deck(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data)
+        session_id = data['session_id']
+        total = Question.query.filter(Question.category == 1).count()
+        self.assertEqual(data['questions_left'], total)
+
+        # Every question of the category comes once, then None
+        seen = []
+        for _ in range(total + 1):
+            res = self.client().post(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            question = json.loads(res.data)['question']
+            if question is None:
+                break
+            self.assertEqual(question['category'], 1)
+            seen.append(question['id'])
+        self.assertEqual(len(seen), total)
+        self.assertEqual(len(set(seen)), total)
+
+        res = self.client().delete('/quizzes/sessions/' + session_id)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post(
+            '/quizzes/sessions/{}/next'.format(session_id))
+        self.assertEqual(res.status_code, 404)
+
+    def test_quiz_sessions_are_bounded(self):
+        store = QuizSessionStore(max_sessions=2, ttl=60, deck_size=3)
+        first, size = store.start(1, [1, 2, 3])
+        store.start(1, [4])
+        store.start(1, [5])
+        # The least recently used one made room
+        self.assertIsNone(store.get(first))
+        self.assertEqual(len(store), 2)
+
+        store = QuizSessionStore(max_sessions=2, ttl=0, deck_size=3)
+        expired, size = store.start(1, [1])
+        self.assertIsNone(store.get(expired))
+
+    def test_batch_update_questions(self):
+        res = self.client().patch('/questions', json={
+            'ids': [2, 4, 9999], 'category': 6, 'difficulty': 5})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+        self.assertEqual(data['results'], [
+            {'id': 2, 'status': 'updated'},
+            {'id': 4, 'status': 'updated'},
+            {'id': 9999, 'status': 'not_found'}])
+        question = Question.query.get(4)
+        self.assertEqual((question.category, question.difficulty), (6, 5))
+
+        # The quiz of the new category has them
+        res = self.client().post('/quizzes', json={
+            'quiz_category': {'id': 6}, 'count': 50})
+        ids = [question['id'] for question in
+               json.loads(res.data)['questions']]
+        self.assertIn(2, ids)
+        self.assertIn(4, ids)
+
+    def test_difficulty_update_keeps_the_indexes(self):
+        self.client().post('/quizzes', json={'quiz_category': {'id': 0}})
+        self.client().get('/questions/suggest?prefix=what')
+        quiz_index = self.app.extensions['quiz_index']
+        suggest_index = self.app.extensions['suggest_index']
+        ids, root = quiz_index.ids, suggest_index.root
+
+        res = self.client().patch('/questions', json={
+            'ids': [2, 4], 'difficulty': 5})
+        self.assertEqual(json.loads(res.data)['updated'], 2)
+        # Still current, neither was built again
+        self.assertTrue(quiz_index.current())
+        self.assertTrue(suggest_index.current())
+        self.assertIs(quiz_index.ids, ids)
+        self.assertIs(suggest_index.root, root)
+
+    def test_batch_update_unknown_category(self):
+        res = self.client().patch('/questions', json={
+            'ids': [2], 'category': 1000})
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Question.query.get(2).category, 5)
+
+    def test_batch_delete_questions(self):
+        res = self.client().delete('/questions', json={
+            'ids': [2, 4, 9999, 2]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(data['results'], [
+            {'id': 2, 'status': 'deleted'},
+            {'id': 4, 'status': 'deleted'},
+            {'id': 9999, 'status': 'not_found'}])
+        self.assertIsNone(Question.query.get(2))
+
+    def test_batch_delete_needs_ids(self):
+        res = self.client().delete('/questions', json={'ids': 'all'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_question_counts_follow_writes(self):
+        def counted():
+            return {str(category): count for category, count in
+                    models.db.session.query(
+                        Question.category,
+                        func.count(Question.id)).group_by(
+                        Question.category)}
+
+        self.client().post('/questions', json={
+            'question': 'Counted?', 'answer': 'Yes',
+            'difficulty': 1, 'category': 1})
+        self.client().patch('/questions', json={
+            'ids': [2, 4], 'category': 6})
+        self.client().delete('/questions', json={'ids': [5, 9]})
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(data['question_counts'], counted())
+
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'],
+                         Question.query.count())
+
+    def test_search_cache_normalizes_terms(self):
+        res = self.client().post('/questions/search',
+                                 json={'search_term': 'Mona Lisa'})
+        first = json.loads(res.data)
+        res = self.client().post('/questions/search',
+                                 json={'search_term': '  mona   LISA '})
+        second = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(first, second)
+
+        res = self.client().get('/stats/search-cache')
+        stats = json.loads(res.data)['search_cache']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_search_cache_invalidated_by_writes(self):
+        search = {'search_term': 'Mona Lisa'}
+        res = self.client().post('/questions/search', json=search)
+        total = json.loads(res.data)['total_questions']
+
+        self.client().post('/questions', json={
+            'question': 'Who stole the Mona Lisa in 1911?',
+            'answer': 'Vincenzo Peruggia', 'difficulty': 3,
+            'category': 2})
+        res = self.client().post('/questions/search', json=search)
+        self.assertEqual(json.loads(res.data)['total_questions'],
+                         total + 1)
+        self.assertEqual(
+            self.app.extensions['search_cache'].stats()['hits'], 0)
+
+    def test_suggest_questions(self):
+        res = self.client().get('/questions/suggest?prefix=Socc')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        # The shortest question first
+        self.assertEqual([s['question'] for s in data['suggestions']], [
+            'Which country won the first ever soccer World Cup in 1930?',
+            'Which is the only team to play in every soccer World Cup '
+            'tournament?'])
+
+        res = self.client().get('/questions/suggest?prefix=soccer+fir')
+        data = json.loads(res.data)
+        self.assertEqual(len(data['suggestions']), 1)
+
+        res = self.client().get('/questions/suggest')
+        self.assertEqual(res.status_code, 400)
+
+    def test_suggest_index_follows_writes(self):
+        self.client().get('/questions/suggest?prefix=soccer')
+        index = self.app.extensions['suggest_index']
+        root = index.root
+
+        res = self.client().post('/questions', json={
+            'question': 'Who won the soccer World Cup?',
+            'answer': 'France', 'difficulty': 1, 'category': 6})
+        created = json.loads(res.data)['created']
+        res = self.client().get('/questions/suggest?prefix=soccer&limit=1')
+        self.assertEqual(json.loads(res.data)['suggestions'], [
+            {'id': created, 'question': 'Who won the soccer World Cup?'}])
+
+        self.client().delete('/questions/{}'.format(created))
+        res = self.client().get('/questions/suggest?prefix=soccer')
+        self.assertNotIn(created, [suggestion['id'] for suggestion in
+                                   json.loads(res.data)['suggestions']])
+        # Kept up to date by the hooks, not built again
+        self.assertIs(index.root, root)
+
     def test_play_quiz_success(self):
         test_round_data = {
             'quiz_category': {'type': 'Art', 'id': 7}}
@@ -235,10 +799,79 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        self.assertIsNone(data['question'])
+
+    def test_play_quiz_never_repeats(self):
+        # Playing a whole category, every question comes once and
+        # then the quiz ends with question = None
+        previous_questions = []
+        while True:
+            res = self.client().post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'type': 'Science', 'id': 1}})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            if data['question'] is None:
+                break
+            self.assertNotIn(
+                data['question']['id'], previous_questions)
+            previous_questions.append(data['question']['id'])
+
+        self.assertTrue(len(previous_questions) > 0)
+
+    def test_play_quiz_batch(self):
+        # One call with "count" brings back the rest of the category,
+        # without the previous questions and without repeats
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        first = json.loads(res.data)['question']['id']
+
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [first], 'count': 50,
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data)
+        ids = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(ids) > 0)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertNotIn(first, ids)
+        for question in data['questions']:
+            self.assertEqual(question['category'], 1)
+
+    def test_play_quiz_previous_questions_as_strings(self):
+        # "20" is question 20, all but one of the category sent as
+        # strings leave only that one to draw
+        res = self.client().post('/quizzes', json={
+            'count': 50, 'quiz_category': {'type': 'Science', 'id': 1}})
+        ids = [question['id']
+               for question in json.loads(res.data)['questions']]
+
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [str(i) for i in ids[1:]],
+            'count': 50, 'quiz_category': {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         ids[:1])
+
+        # A malformed id is unprocessable
+        res = self.client().post('/quizzes', json={
+            'previous_questions': ['twenty'],
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        self.assertEqual(res.status_code, 422)
 
     def test_play_unprosessable_quiz(self):
+        # A category that has no question (or doesn't exist, like 7
+        # in test_play_quiz_success) is a quiz with nothing to play,
+        # a 200 with a null question. A category id that isn't a
+        # number can't be played
         test_data = {'quiz_category': {
-            'type': 'Art', 'id': 7}}
+            'type': 'Art', 'id': 'Art'}}
 
         res = self.client().post('/quizzes', json=test_data)
         # Loading data using JSON.loads, To know more check the links below:
@@ -248,8 +881,565 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable')
+
+        res = self.client().post('/quizzes', json={})
+        self.assertEqual(res.status_code, 422)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """The read only endpoints read from the replica"""
+
+    def setUp(self):
+        # Two SQLite files: the primary and a copy of it that
+        # plays the replica
+        self.folder = tempfile.mkdtemp()
+        primary = os.path.join(self.folder, 'primary.db')
+        replica = os.path.join(self.folder, 'replica.db')
+
+        make_app('sqlite:///' + primary)
+        shutil.copy(primary, replica)
+        self.replica = replica
+
+        self.app = make_app(
+            'sqlite:///' + primary, load=False,
+            CREATE_SCHEMA_ON_START=False,
+            DATABASE_REPLICA_PATH='sqlite:///' + replica)
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_reads_go_to_replica(self):
+        with self.app.app_context():
+            total = Question.query.count()
+        # A row only the replica has
+        with sqlite3.connect(self.replica) as connection:
+            connection.execute(
+                "INSERT INTO questions (question, answer, category, "
+                "difficulty) VALUES ('Only on the replica?', 'Yes', 1, 1)")
+
+        # Loading the dump in setUp was a write, past its lag window
+        self.app.config['DATABASE_REPLICA_LAG'] = 0
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], total + 1)
+
+    def test_reads_after_a_write_are_fresh(self):
+        # The write goes to the primary only (the replica here is a
+        # copy that never catches up)
+        res = self.client().post('/questions', json={
+            'question': 'Only on the primary?',
+            'answer': 'Yes',
+            'difficulty': 1,
+            'category': 1})
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            total = Question.query.count()
+
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], total)
+        # Past the lag window, what was cached is still the fresh one
+        self.app.config['DATABASE_REPLICA_LAG'] = 0
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], total)
+
+
+class AsyncAppTestCase(unittest.TestCase):
+    """The ASGI app answers like the Flask app"""
+
+    def setUp(self):
+        # aiosqlite and the Flask app share one SQLite file
+        self.folder = tempfile.mkdtemp()
+        database_path = 'sqlite:///' + os.path.join(
+            self.folder, 'trivia.db')
+        flask_app = make_app(database_path)
+        self.flask_app = flask_app
+        self.flask_client = flask_app.test_client()
+        self.client = TestClient(
+            create_asgi_app({'DATABASE_PATH': database_path}))
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        shutil.rmtree(self.folder)
+
+    def test_same_json_as_flask(self):
+        for url in ('/categories', '/questions?page=2',
+                    '/questions?after_id=5', '/categories/1/questions',
+                    '/categories/1000/questions', '/questions?page=0',
+                    '/categories/1/questions?page=0'):
+            res = self.client.get(url)
+            flask_res = self.flask_client.get(url)
+            self.assertEqual(res.status_code, flask_res.status_code)
+            self.assertEqual(res.json(), json.loads(flask_res.data))
+
+    def test_create_play_and_delete(self):
+        res = self.client.post('/questions', json={
+            'question': 'Async?', 'answer': 'Yes',
+            'difficulty': 1, 'category': 1})
+        created = res.json()['created']
+
+        res = self.client.post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'id': 1}})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['question']['category'], 1)
+
+        res = self.client.delete('/questions/{}'.format(created))
+        self.assertEqual(res.json(), {'success': True, 'deleted': created})
+        res = self.client.delete('/questions/{}'.format(created))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.json()['message'], 'resource not found')
+
+    def test_delete_question_without_category(self):
+        with self.flask_app.app_context():
+            question = Question(question='Orphan?', answer='Yes',
+                                category=None, difficulty=1)
+            question.insert()
+            question_id = question.id
+
+        res = self.client.delete('/questions/{}'.format(question_id))
+        self.assertEqual(res.json(),
+                         {'success': True, 'deleted': question_id})
+
+
+class MigrationTestCase(unittest.TestCase):
+    """Migration 1 turns the String category into an integer FK"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(
+            self.folder, 'old.db'))
+        # The schema the old models created
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE categories (id INTEGER PRIMARY KEY, "
+                "type VARCHAR)"))
+            connection.execute(text(
+                "CREATE TABLE questions (id INTEGER PRIMARY KEY, "
+                "question VARCHAR, answer VARCHAR, category VARCHAR, "
+                "difficulty INTEGER)"))
+            connection.execute(text(
+                "INSERT INTO categories VALUES (1, 'Science'), (2, 'Art')"))
+            connection.execute(text(
+                "INSERT INTO questions VALUES (1, 'Q1', 'A1', '1', 1), "
+                "(2, 'Q2', 'A2', 'Art', 2), (3, 'Q3', 'A3', '99', 3)"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.folder)
+
+    def test_category_becomes_integer_fk(self):
+        self.assertEqual(migrate(self.engine), [
+            (1, 'category_integer_fk'), (2, 'question_counts'),
+            (3, 'quiz_sessions'), (4, 'external_writes')])
+        self.assertEqual(migrate(self.engine), [])
+
+        schema = inspect(self.engine)
         self.assertEqual(
-            data['message'], 'Unprossessable entity')
+            schema.get_foreign_keys('questions')[0]['referred_table'],
+            'categories')
+        self.assertIn(['category', 'id'], [
+            index['column_names']
+            for index in schema.get_indexes('questions')])
+        with self.engine.connect() as connection:
+            rows = dict(connection.execute(text(
+                "SELECT id, category FROM questions")).fetchall())
+        # An id, a type, and a category that doesn't exist
+        self.assertEqual(rows, {1: 1, 2: 2, 3: None})
+
+    def test_question_counts_are_reconciled(self):
+        migrate(self.engine)
+        with self.engine.begin() as connection:
+            self.assertEqual(stored_counts(connection), {0: 1, 1: 1, 2: 1})
+            # Kept by the triggers
+            connection.execute(text(
+                "INSERT INTO questions (question, answer, category, "
+                "difficulty) VALUES ('Q4', 'A4', 2, 1)"))
+            connection.execute(text(
+                "UPDATE questions SET category = 1 WHERE id = 3"))
+            self.assertEqual(stored_counts(connection), {0: 0, 1: 2, 2: 2})
+            # A write the triggers didn't see
+            connection.execute(text(
+                "UPDATE question_counts SET questions = 7 "
+                "WHERE category = 1"))
+
+        with self.engine.begin() as connection:
+            self.assertEqual(reconcile_counts(connection), {1: (7, 2)})
+            self.assertEqual(stored_counts(connection), {1: 2, 2: 2})
+
+    def test_counts_without_the_counts_table(self):
+        # Migration 2 didn't run: the questions are counted
+        app = create_app({'DATABASE_PATH': str(self.engine.url)})
+        with app.app_context():
+            with self.assertLogs(app.logger, 'WARNING'):
+                self.assertEqual(read_counts(),
+                                 {'1': 1, 'Art': 1, '99': 1})
+        models.dispose_engines(app)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_one_process_reconciles(self):
+        reconciler = CountReconciler(60)
+        reconciler.next_run.value = 0
+        pid = os.fork()
+        if pid == 0:
+            # The worker takes this run
+            os._exit(0 if reconciler.due() else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertFalse(reconciler.due())
+        self.assertIsNone(CountReconciler(0).next_run)
+
+
+class AdmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # A bucket of 2 that takes a minute to refill a token
+        self.app = make_app(RATE_LIMIT_CLIENT=(1 / 60, 2),
+                            ADMISSION_MAX_CONCURRENT=1, ADMISSION_WAIT=0)
+        self.client = self.app.test_client()
+
+    def test_client_rate_limit(self):
+        for _ in range(2):
+            self.assertEqual(
+                self.client.get('/categories').status_code, 200)
+        res = self.client.get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(int(res.headers['Retry-After']) >= 1)
+        # The metrics aren't limited and count the refused request
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('trivia_admission_rejected_total{'
+                      'reason="client_rate",endpoint="get_categories"} 1',
+                      metrics)
+
+    def test_client_behind_proxy(self):
+        admission = self.app.extensions['admission']
+        admission.client_header = 'X-Forwarded-For'
+        admission.trusted_proxies = 1
+
+        def get(forwarded_for):
+            return self.client.get('/categories', headers={
+                'X-Forwarded-For': forwarded_for}).status_code
+
+        self.assertEqual(get('10.0.0.1, 1.1.1.1'), 200)
+        self.assertEqual(get('10.0.0.2, 1.1.1.1'), 200)
+        # What the client wrote itself doesn't give it a new bucket
+        self.assertEqual(get('10.0.0.3, 1.1.1.1'), 429)
+        self.assertEqual(get('1.1.1.1, 2.2.2.2'), 200)
+
+    def test_expensive_routes_concurrency_cap(self):
+        # Another request holds the only slot
+        admission = self.app.extensions['admission']
+        admission.slots.acquire()
+        res = self.client.post('/questions/search',
+                               json={'search_term': 'title'})
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+        admission.slots.release()
+        res = self.client.post('/questions/search',
+                               json={'search_term': 'title'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(admission.running, 0)
+
+
+class DeploymentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        models.shared_data_version = None
+        models.shared_change_log = None
+
+    def test_write_from_another_worker_rebuilds_quiz_index(self):
+        self.assertEqual(warm_up(self.app).keys(),
+                         {'pools', 'quiz_index', 'suggest_index', 'paths'})
+        # A row written by another process: only the data version
+        # moves here, no hook runs
+        with self.app.app_context():
+            models.db.session.execute(text(
+                "INSERT INTO questions (id, question, answer, category, "
+                "difficulty) VALUES (1000, 'Elsewhere?', 'Yes', 6, 1)"))
+            models.db.session.commit()
+        models.bump_data_version()
+
+        res = self.client.post('/quizzes', json={
+            'quiz_category': {'id': 6}, 'count': 50})
+        ids = [question['id'] for question in
+               json.loads(res.data)['questions']]
+        self.assertIn(1000, ids)
+
+    def test_write_from_another_worker_is_caught_up(self):
+        warm_up(self.app)
+        quiz_index = self.app.extensions['quiz_index']
+        suggest_index = self.app.extensions['suggest_index']
+        ids, root = quiz_index.ids, suggest_index.root
+        # The other worker logged what it wrote
+        with self.app.app_context():
+            models.db.session.execute(text(
+                "INSERT INTO questions (id, question, answer, category, "
+                "difficulty) VALUES (1000, 'Elsewhere?', 'Yes', 6, 1)"))
+            models.db.session.commit()
+        models.bump_data_version([('insert', 1000, 6)])
+
+        res = self.client.post('/quizzes', json={
+            'quiz_category': {'id': 6}, 'count': 50})
+        self.assertIn(1000, [question['id'] for question in
+                             json.loads(res.data)['questions']])
+        res = self.client.get('/questions/suggest?prefix=elsew')
+        self.assertEqual([question['id'] for question in
+                          json.loads(res.data)['suggestions']], [1000])
+        # Neither index was built again
+        self.assertIs(quiz_index.ids, ids)
+        self.assertIs(suggest_index.root, root)
+        self.assertTrue(quiz_index.current())
+        self.assertTrue(suggest_index.current())
+
+    def test_change_log_tells_when_it_can_not(self):
+        version = models.bump_data_version([('delete', 5, 4)])
+        self.assertEqual(models.changes_since(version - 1),
+                         (version, [('delete', 5, 4)]))
+        models.bump_data_version()
+        self.assertEqual(models.changes_since(version),
+                         (version + 1, None))
+        latest = models.bump_data_version(
+            [('update', 5, 1)] * models.CHANGE_LOG_SIZE)
+        # The entries of version and version + 1 were overwritten
+        self.assertEqual(models.changes_since(version - 1),
+                         (latest, None))
+        self.assertEqual(len(models.changes_since(version + 1)[1]),
+                         models.CHANGE_LOG_SIZE)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_forked_worker_changes_are_caught_up(self):
+        models.share_data_version()
+        warm_up(self.app)
+        quiz_index = self.app.extensions['quiz_index']
+        ids = quiz_index.ids
+
+        pid = os.fork()
+        if pid == 0:
+            # The worker deletes question 5 (its row is in the
+            # worker's copy of the in-memory database only)
+            models.bump_data_version([('delete', 5, 4)])
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        with self.app.app_context():
+            quiz_index.ensure_built()
+        self.assertIs(quiz_index.ids, ids)
+        self.assertNotIn(5, quiz_index.positions[ALL_CATEGORIES])
+        self.assertTrue(quiz_index.current())
+
+    def test_quiz_sessions_shared_by_workers(self):
+        # Two apps on one SQLite file play two worker processes
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        database_path = 'sqlite:///' + os.path.join(folder, 'trivia.db')
+        first = make_app(database_path, QUIZ_SESSION_BACKEND='database')
+        second = make_app(database_path, load=False,
+                          CREATE_SCHEMA_ON_START=False,
+                          QUIZ_SESSION_BACKEND='database')
+
+        res = first.test_client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data)
+        session_id, total = data['session_id'], data['questions_left']
+        seen = []
+        for number in range(total):
+            app = (first, second)[number % 2]
+            res = app.test_client().post(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            data = json.loads(res.data)
+            self.assertEqual(data['questions_left'], total - number - 1)
+            seen.append(data['question']['id'])
+        self.assertEqual(len(set(seen)), total)
+        res = second.test_client().post(
+            '/quizzes/sessions/{}/next'.format(session_id))
+        self.assertIsNone(json.loads(res.data)['question'])
+
+        res = second.test_client().delete(
+            '/quizzes/sessions/' + session_id)
+        self.assertEqual(res.status_code, 200)
+        res = first.test_client().post(
+            '/quizzes/sessions/{}/next'.format(session_id))
+        self.assertEqual(res.status_code, 404)
+        for app in (first, second):
+            models.dispose_engines(app)
+
+    def test_database_quiz_sessions_expire(self):
+        with self.app.app_context():
+            store = DatabaseQuizSessionStore(ttl=60, deck_size=3)
+            session_id, size = store.start(1, [7, 8])
+            self.assertEqual(store.get(session_id).deck, [7, 8])
+            self.assertEqual(store.pop(session_id), (7, 1))
+            self.assertEqual(len(store), 1)
+            store.ttl = 0
+            store.get(session_id)
+            self.assertIsNone(store.get(session_id))
+            self.assertRaises(KeyError, store.pop, session_id)
+            self.assertTrue(store.end(session_id))
+            self.assertEqual(len(store), 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_data_version_shared_with_forked_workers(self):
+        models.share_data_version()
+        version = models.get_data_version()
+        etag = self.client.get('/categories').headers['ETag']
+
+        pid = os.fork()
+        if pid == 0:
+            # The worker writes
+            models.bump_data_version()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(models.get_data_version(), version + 1)
+        res = self.client.get('/categories',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+
+class SearchCacheTestCase(unittest.TestCase):
+
+    def test_identical_searches_run_once(self):
+        cache = SearchCache(16, 0)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['result'], 1
+
+        results = []
+
+        def search():
+            results.append(cache.search(('title', 1, 10), compute))
+
+        leader = threading.Thread(target=search)
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=search) for _ in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        # The waiters have joined the flight before it lands
+        while cache.stats()['coalesced'] < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + waiters:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [(['result'], 1)] * 4)
+        self.assertEqual(cache.search(('title', 1, 10), compute),
+                         (['result'], 1))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'],
+                          stats['coalesced']), (1, 1, 3))
+
+    def test_failed_search_is_not_kept(self):
+        cache = SearchCache(16, 0)
+
+        def fail():
+            raise RuntimeError('database is gone')
+
+        with self.assertRaises(RuntimeError):
+            cache.search(('title', 1, 10), fail)
+        self.assertEqual(cache.search(('title', 1, 10), lambda: 'ok'),
+                         'ok')
+        self.assertEqual(cache.flights, {})
+
+    def test_entries_expire_and_are_evicted(self):
+        cache = SearchCache(2, 0.05)
+        for term in ('a', 'b', 'c'):
+            cache.search((term, 1, 10), lambda: term)
+        # "a" was the least recently used one
+        self.assertEqual(list(cache.entries), [('b', 1, 10), ('c', 1, 10)])
+
+        time.sleep(0.1)
+        self.assertEqual(cache.search(('b', 1, 10), lambda: 'new'), 'new')
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_normalize_search_term(self):
+        self.assertEqual(normalize_search_term(' Mona\t  LISA\n'),
+                         'mona lisa')
+        self.assertEqual(normalize_search_term('Straße'), 'straße')
+
+
+class SuggestIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Two questions per trie node, three characters deep
+        self.index = SuggestIndex(3, 2)
+        self.index.built = True
+        self.index.version = models.get_data_version()
+        for question_id, question in [(1, 'Stars?'), (2, 'Star wars?'),
+                                      (3, 'A start of stars?'),
+                                      (4, 'Stamps and stars, then?')]:
+            self.index.add(question_id, question)
+
+    def suggested(self, prefix):
+        return [question_id for question_id, _ in
+                self.index.suggest(prefix, 2)]
+
+    def test_best_of_prefix(self):
+        self.assertEqual(self.suggested('st'), [1, 2])
+        # Longer than the trie is deep
+        self.assertEqual(self.suggested('start'), [3])
+        self.assertEqual(self.suggested('wars star'), [2])
+        self.assertEqual(self.suggested('moon'), [])
+
+    def test_one_request_builds(self):
+        index = SuggestIndex(3, 2)
+        release = threading.Event()
+        builds = []
+
+        def build():
+            builds.append(threading.current_thread())
+            release.wait()
+            index.built = True
+            index.version = models.get_data_version()
+        index.build = build
+
+        threads = [threading.Thread(target=index.ensure_built)
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(builds), 1)
+
+        # Stale: one rebuilds, the others keep the old trie
+        models.bump_data_version()
+        release.clear()
+        builder = threading.Thread(target=index.ensure_built)
+        builder.start()
+        time.sleep(0.05)
+        index.ensure_built()
+        self.assertEqual(len(builds), 2)
+        release.set()
+        builder.join()
+        self.assertTrue(index.current())
+
+    def test_remove_brings_up_the_next_best(self):
+        self.index.remove(1)
+        self.assertEqual(self.suggested('st'), [2, 3])
+        self.index.remove(2)
+        self.index.remove(3)
+        self.assertEqual(self.suggested('sta'), [4])
+        self.index.remove(4)
+        self.assertEqual(self.index.root.children, {})
 
 
 # Make the tests conveniently executable
@@ -0,0 +1,36 @@
+import os
+from flask import Config
+from flaskr import create_app
+from models import dispose_engines
+
+'''
+Production entry point
+    the WSGI app for a pre-fork server, with gunicorn (its settings,
+    hooks included, are in gunicorn.conf.py). From the backend folder:
+
+    gunicorn -c gunicorn.conf.py
+
+    config.py is the development configuration, here DEBUG and the
+    query profiler are off and the quiz sessions are in the database
+    (the workers share them). Anything else can be changed in a python
+    file named by the TRIVIA_SETTINGS environment variable, written
+    like config.py, for example:
+
+    DATABASE_PATH = 'postgresql://trivia:secret@db:5432/trivia'
+    RATE_LIMIT_CLIENT_HEADER = 'X-Forwarded-For'
+
+    https://flask.palletsprojects.com/en/2.2.x/config/#configuring-from-python-files
+'''
+
+settings = {'DEBUG': False, 'QUERY_PROFILER': False,
+            'QUIZ_SESSION_BACKEND': 'database'}
+overrides = Config(os.path.dirname(os.path.abspath(__file__)))
+overrides.from_envvar('TRIVIA_SETTINGS', silent=True)
+settings.update(overrides)
+
+app = create_app(settings)
+
+# With preload_app the app is built in the gunicorn master before it
+# forks the workers, anything create_app connected (init_db) is
+# closed here so no socket is inherited
+dispose_engines(app)